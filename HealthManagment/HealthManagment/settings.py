@@ -13,6 +13,7 @@ from pathlib import Path
 from decouple import config, Csv
 import os
 from datetime import timedelta
+from celery.schedules import crontab
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 DJANGO_ENV = config('DJANGO_ENV', default='development')
@@ -109,6 +110,102 @@ DATABASES = {
     }
 }
 
+# Cache (set REDIS_BACKEND to share cached data between workers)
+REDIS_BACKEND = config('REDIS_BACKEND', default='')
+if REDIS_BACKEND:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_BACKEND,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+# Whether the default cache is shared between worker processes. Without it, state other
+# workers must see (blacklist generation, token versions) is read from the database.
+SHARED_CACHE = bool(REDIS_BACKEND)
+
+# Stale admin and doctor dashboard snapshots are rebuilt by celery beat every
+# DASHBOARD_REBUILD_INTERVAL_SECONDS; a request only rebuilds one the task has not
+# caught up with for DASHBOARD_STALE_SECONDS
+DASHBOARD_REBUILD_INTERVAL_SECONDS = config('DASHBOARD_REBUILD_INTERVAL_SECONDS', default=30, cast=int)
+DASHBOARD_STALE_SECONDS = config('DASHBOARD_STALE_SECONDS', default=300, cast=int)
+# Resolved group permissions per user (shared cache timeout / in-process TTL, seconds, and
+# the most users each process keeps). Without SHARED_CACHE only the in-process layer is
+# used, so permission changes reach other workers within PERMISSION_CACHE_LOCAL_TTL.
+PERMISSION_CACHE_TIMEOUT = config('PERMISSION_CACHE_TIMEOUT', default=300, cast=int)
+PERMISSION_CACHE_LOCAL_TTL = config('PERMISSION_CACHE_LOCAL_TTL', default=30, cast=int)
+PERMISSION_CACHE_LOCAL_SIZE = config('PERMISSION_CACHE_LOCAL_SIZE', default=10000, cast=int)
+# Users cached for token-authenticated requests that read fields not carried as claims (seconds);
+# only used with SHARED_CACHE, otherwise token versions and users are read from the database
+IDENTITY_CACHE_TIMEOUT = config('IDENTITY_CACHE_TIMEOUT', default=60, cast=int)
+# In-process bloom filter in front of the refresh token blacklist, and its hourly pruning
+TOKEN_BLACKLIST_FILTER_CAPACITY = config('TOKEN_BLACKLIST_FILTER_CAPACITY', default=100000, cast=int)
+TOKEN_BLACKLIST_FILTER_ERROR_RATE = config('TOKEN_BLACKLIST_FILTER_ERROR_RATE', default=0.001, cast=float)
+# Reloads re-read rows blacklisted this many seconds before the newest one seen, so rows
+# committed late are not missed
+TOKEN_BLACKLIST_FILTER_OVERLAP = config('TOKEN_BLACKLIST_FILTER_OVERLAP', default=60, cast=int)
+TOKEN_PRUNE_BATCH_SIZE = config('TOKEN_PRUNE_BATCH_SIZE', default=1000, cast=int)
+TOKEN_PRUNE_MAX_BATCHES = config('TOKEN_PRUNE_MAX_BATCHES', default=50, cast=int)
+
+# Celery (run with: celery -A HealthManagment.celery worker -B)
+CELERY_BROKER_URL = config('CELERY_BROKER_URL', default=REDIS_BACKEND or 'redis://localhost:6379/0')
+CELERY_TIMEZONE = 'Asia/Kolkata'
+PUSH_OUTBOX_INTERVAL_SECONDS = config('PUSH_OUTBOX_INTERVAL_SECONDS', default=10, cast=int)
+CELERY_BEAT_SCHEDULE = {
+    'deliver-pending-notifications': {
+        'task': 'notification.tasks.deliver_pending_notifications',
+        'schedule': PUSH_OUTBOX_INTERVAL_SECONDS,
+    },
+    'transcode-voice-notes': {
+        'task': 'users.tasks.transcode_voice_notes',
+        'schedule': config('AUDIO_TRANSCODE_INTERVAL_SECONDS', default=30, cast=int),
+    },
+    'rebuild-dashboards': {
+        'task': 'users.tasks.rebuild_dashboards',
+        'schedule': DASHBOARD_REBUILD_INTERVAL_SECONDS,
+    },
+    'refresh-patient-cohorts': {
+        'task': 'users.tasks.refresh_patient_cohorts',
+        'schedule': crontab(hour=0, minute=5),
+    },
+    'close-adherence-day': {
+        'task': 'users.tasks.close_adherence_day',
+        'schedule': crontab(hour=0, minute=15),
+    },
+    'enrich-meal-portions': {
+        'task': 'users.tasks.enrich_meal_portions',
+        'schedule': config('NUTRITION_ENRICH_INTERVAL_SECONDS', default=30, cast=int),
+    },
+    'retry-otp-sms': {
+        'task': 'users.tasks.retry_otp_sms',
+        'schedule': config('SMS_RETRY_INTERVAL_SECONDS', default=15, cast=int),
+    },
+    'prune-token-blacklist': {
+        'task': 'users.tasks.prune_token_blacklist',
+        'schedule': crontab(minute=30),
+    },
+    'prune-sync-tombstones': {
+        'task': 'patient.tasks.prune_sync_tombstones',
+        'schedule': crontab(hour=1, minute=0),
+    },
+    'questionnaire-round-reminder': {
+        'task': 'notification.tasks.questionnaire_round_reminder',
+        'schedule': crontab(hour=config('QUESTIONNAIRE_REMINDER_HOUR', default=9, cast=int), minute=0),
+    },
+}
+
+# Push delivery (use notification.backends.FakeMessagingBackend for local testing)
+PUSH_MESSAGING_BACKEND = config('PUSH_MESSAGING_BACKEND', default='notification.backends.FirebaseMessagingBackend')
+PUSH_OUTBOX_BATCH_SIZE = config('PUSH_OUTBOX_BATCH_SIZE', default=500, cast=int)
+PUSH_MAX_ATTEMPTS = config('PUSH_MAX_ATTEMPTS', default=5, cast=int)
+PUSH_OUTBOX_CLAIM_TIMEOUT = 300
+REMINDER_CHUNK_SIZE = config('REMINDER_CHUNK_SIZE', default=2000, cast=int)
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
@@ -119,7 +216,7 @@ AUTH_PASSWORD_VALIDATORS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'users.jwt_auth.StatelessJWTAuthentication',
     ),
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
@@ -147,6 +244,40 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'mediafiles')
 
+# Media storage: users.storage.LocalUploadStorage (MEDIA_ROOT) or users.s3_storage.S3MediaStorage
+# (S3 / MinIO, set AWS_S3_ENDPOINT_URL for MinIO)
+MEDIA_STORAGE_BACKEND = config('MEDIA_STORAGE_BACKEND', default='users.storage.LocalUploadStorage')
+STORAGES = {
+    'default': {'BACKEND': MEDIA_STORAGE_BACKEND},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+AWS_STORAGE_BUCKET_NAME = config('AWS_STORAGE_BUCKET_NAME', default='')
+AWS_S3_ENDPOINT_URL = config('AWS_S3_ENDPOINT_URL', default=None)
+AWS_S3_REGION_NAME = config('AWS_S3_REGION_NAME', default=None)
+AWS_ACCESS_KEY_ID = config('AWS_ACCESS_KEY_ID', default=None)
+AWS_SECRET_ACCESS_KEY = config('AWS_SECRET_ACCESS_KEY', default=None)
+AWS_S3_FILE_OVERWRITE = False
+AWS_DEFAULT_ACL = None
+AWS_QUERYSTRING_AUTH = True
+# Uploads above this size are spooled to a temp file instead of memory before streaming to storage
+FILE_UPLOAD_MAX_MEMORY_SIZE = config('FILE_UPLOAD_MAX_MEMORY_SIZE', default=1024 * 1024, cast=int)
+PRESIGNED_UPLOAD_EXPIRES = config('PRESIGNED_UPLOAD_EXPIRES', default=900, cast=int)
+PRESIGNED_UPLOAD_MAX_SIZE = config('PRESIGNED_UPLOAD_MAX_SIZE', default=25 * 1024 * 1024, cast=int)
+
+# Voice note transcoding (ffmpeg with libopus must be installed on the worker)
+FFMPEG_BINARY = config('FFMPEG_BINARY', default='ffmpeg')
+AUDIO_TRANSCODE_BITRATE_KBPS = config('AUDIO_TRANSCODE_BITRATE_KBPS', default=16, cast=int)
+AUDIO_TRANSCODE_TIMEOUT = config('AUDIO_TRANSCODE_TIMEOUT', default=120, cast=int)
+AUDIO_TRANSCODE_BATCH_SIZE = config('AUDIO_TRANSCODE_BATCH_SIZE', default=20, cast=int)
+AUDIO_TRANSCODE_MAX_ATTEMPTS = 3
+# Background nutrition enrichment of meal portions (users.nutrition)
+NUTRITION_ENRICH_BATCH_SIZE = config('NUTRITION_ENRICH_BATCH_SIZE', default=50, cast=int)
+NUTRITION_ENRICH_CONCURRENCY = config('NUTRITION_ENRICH_CONCURRENCY', default=4, cast=int)
+NUTRITION_CACHE_TTL_DAYS = config('NUTRITION_CACHE_TTL_DAYS', default=90, cast=int)
+NUTRITION_NEGATIVE_TTL_DAYS = config('NUTRITION_NEGATIVE_TTL_DAYS', default=7, cast=int)
+NUTRITION_MAX_ATTEMPTS = config('NUTRITION_MAX_ATTEMPTS', default=5, cast=int)
+NUTRITION_CLAIM_TIMEOUT = 300
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -165,11 +296,59 @@ MSG91_SENDER_ID = config('MSG91_SENDER_ID')
 MSG91_ROUTE = 4
 MSG91_COUNTRY_CODE = config('MSG91_COUNTRY_CODE')
 
+# OTPs are generated and checked locally (users.otp) against a hash kept on the user row,
+# so any worker can verify them; only the SMS goes to the gateway.
+# Use users.sms.FakeSMSGateway for local testing.
+OTP_LENGTH = config('TOKEN_LENGTH', default=6, cast=int)
+OTP_EXPIRE_MINUTES = config('TOKEN_EXPIRE_MINUTES', default=10, cast=int)
+OTP_MAX_ATTEMPTS = config('OTP_MAX_ATTEMPTS', default=5, cast=int)
+OTP_RESEND_SECONDS = config('OTP_RESEND_SECONDS', default=30, cast=int)
+SMS_GATEWAY_BACKEND = config('SMS_GATEWAY_BACKEND', default='users.sms.MSG91Gateway')
+SMS_GATEWAY_WORKERS = config('SMS_GATEWAY_WORKERS', default=4, cast=int)
+SMS_MAX_ATTEMPTS = config('SMS_MAX_ATTEMPTS', default=3, cast=int)
+# Seconds before an unclaimed or stuck OTP send is taken over by the retry task
+SMS_CLAIM_TIMEOUT = config('SMS_CLAIM_TIMEOUT', default=60, cast=int)
+
+# Outbound clients (users.outbound): timeouts in seconds, calls in flight per process,
+# consecutive failures before the circuit opens and seconds it stays open.
+# Point the base URLs at `manage.py run_outbound_stubs` to work offline.
+OUTBOUND_PROVIDERS = {
+    'msg91': {
+        'base_url': config('MSG91_BASE_URL', default='https://control.msg91.com'),
+        'connect_timeout': 3.05,
+        'read_timeout': config('MSG91_READ_TIMEOUT', default=10, cast=float),
+        'max_concurrency': config('MSG91_MAX_CONCURRENCY', default=10, cast=int),
+        'failure_threshold': 5,
+        'reset_timeout': 30,
+    },
+    'openfoodfacts': {
+        'base_url': config('OPENFOODFACTS_BASE_URL', default='https://world.openfoodfacts.org'),
+        'connect_timeout': 3.05,
+        'read_timeout': config('OPENFOODFACTS_READ_TIMEOUT', default=5, cast=float),
+        'max_concurrency': config('OPENFOODFACTS_MAX_CONCURRENCY', default=4, cast=int),
+        'failure_threshold': 3,
+        'reset_timeout': 60,
+    },
+    'fcm': {
+        'read_timeout': config('FCM_READ_TIMEOUT', default=10, cast=float),
+        'max_concurrency': config('FCM_MAX_CONCURRENCY', default=4, cast=int),
+        'failure_threshold': 5,
+        'reset_timeout': 30,
+    },
+}
+
 DECRYPT_KEY = config('DECRYPT_KEY')
 
 
 DIET_QUESTION_ADD_DAYS = config('DIET_QUESTION_ADD_DAYS')
 QUESTIONS_DAYS = config('QUESTIONS_DAYS')
+DIET_PLAN_WINDOW_DAYS = config('DIET_PLAN_WINDOW_DAYS', default=7, cast=int)
+PATIENT_CHART_WINDOW_DAYS = config('PATIENT_CHART_WINDOW_DAYS', default=30, cast=int)
+ADHERENCE_WINDOW_DAYS = config('ADHERENCE_WINDOW_DAYS', default=30, cast=int)
+PATIENT_SYNC_MAX_OPERATIONS = config('PATIENT_SYNC_MAX_OPERATIONS', default=500, cast=int)
+PATIENT_SYNC_INITIAL_DAYS = config('PATIENT_SYNC_INITIAL_DAYS', default=7, cast=int)
+# Deleted records are reported to the app this long; older sync tokens are refused
+PATIENT_SYNC_TOMBSTONE_DAYS = config('PATIENT_SYNC_TOMBSTONE_DAYS', default=30, cast=int)
 
 
 PHONENUMBER_DEFAULT_REGION = 'IN'
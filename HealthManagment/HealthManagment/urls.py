@@ -23,7 +23,9 @@ from users.views import (
  SendOrResendSMSAPIView,
  ProfileAPIView,  
  CustomLoginView,UserRegistrationAPIView,LogoutAPIView,DashboardView,
+ PresignedUploadView, DirectUploadView,
 )
+from users.jwt_auth import get_refresh_view
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
@@ -33,6 +35,7 @@ urlpatterns = [
     path('request-otp/', SendOrResendSMSAPIView.as_view(), name='send-sms'),
     path('verify-otp/', CustomLoginView.as_view(), name='login'),
     path('logout/', LogoutAPIView.as_view(), name='logout'),
+    path('token/refresh/', get_refresh_view().as_view(), name='token-refresh'),
     path('admin-panel/', include('users.urls')),
     path('profile/', ProfileAPIView.as_view(), name='profile-api'),
     path('dashboard/', DashboardView.as_view(), name='dashboard'),
@@ -40,6 +43,8 @@ urlpatterns = [
     path('patient/', include('patient.urls')), 
     
     path("notifications/", include("notification.urls")),
+    path('uploads/presign/', PresignedUploadView.as_view(), name='presigned-upload'),
+    path('uploads/direct/<str:token>/', DirectUploadView.as_view(), name='direct-upload'),
 ]
 
 if settings.DEBUG:
@@ -1,11 +1,25 @@
 from rest_framework import serializers
 from users.models import CustomUser, Profile, DietPlan, MealPortion, DietPlanDate, DietPlanMeal, DietPlanStatus, DietPlanCompletedPortion, ExtraMeal, HealthStatus,DoctorExerciseResponse,PatientDietQuestion,PatientExerciseLog
+from collections import defaultdict
+from django.db.models import Q
 from django.utils import timezone
+from users.audio import CompressedAudioMixin, CompressedAudioListSerializer, audio_url, audio_variant_map
 class HealthStatusSerializer(serializers.ModelSerializer):
     class Meta:
         model = HealthStatus
         fields =  "__all__"
         
+class HealthStatusReviewSerializer(serializers.ModelSerializer):
+    patient_id = serializers.IntegerField(source="id")
+    diet_plans = serializers.IntegerField(source="diet_plan_count")
+    lab_reports = serializers.IntegerField(source="lab_report_count")
+    health_status = serializers.CharField(allow_null=True)
+    trimester = serializers.IntegerField(allow_null=True)
+
+    class Meta:
+        model = CustomUser
+        fields = ["patient_id", "username", "diet_plans", "lab_reports", "health_status", "trimester"]
+
 class ProfileSerializer(serializers.ModelSerializer):
     age = serializers.ReadOnlyField()
     pregnancy_month = serializers.ReadOnlyField()
@@ -58,7 +72,7 @@ class MealPortionSerializer(serializers.ModelSerializer):
             "calories", "protein", "carbohydrates", "fat",
             "fiber", "sugar", "saturated_fat", "trans_fat",
             "cholesterol", "sodium", "serving_unit", "serving_qty",
-            "ai_generated",
+            "ai_generated", "nutrition_lookup",
         ]
 
 class DietPlanMealSerializer(serializers.ModelSerializer):
@@ -76,6 +90,8 @@ class DietPlanMealSerializer(serializers.ModelSerializer):
         target_date = self.context.get("target_date")
         if target_date:
             return target_date
+        if "latest_date_map" in self.context:
+            return self.context["latest_date_map"].get(obj.diet_plan_id) or timezone.now().date()
         latest = obj.diet_plan.diet_dates.order_by('-date').first()
         return latest.date if latest else timezone.now().date()
 
@@ -94,6 +110,10 @@ class DietPlanMealSerializer(serializers.ModelSerializer):
         if not request or not request.user.is_authenticated:
             return "pending"
 
+        if "status_map" in self.context:
+            status_obj = self.context["status_map"].get((obj.id, target_date))
+            return status_obj.status if status_obj else "pending"
+
         status_obj = DietPlanStatus.objects.filter(
             patient=obj.diet_plan.patient,
             diet_plan=obj,
@@ -103,28 +123,33 @@ class DietPlanMealSerializer(serializers.ModelSerializer):
         return status_obj.status if status_obj else "pending"
 
     def get_statuses_by_date(self, obj):
-        statuses = DietPlanStatus.objects.filter(
-            patient=obj.diet_plan.patient,
-            diet_plan=obj
-        ).order_by("date")
+        if "statuses_by_meal" in self.context:
+            statuses = self.context["statuses_by_meal"].get(obj.id, [])
+        else:
+            statuses = DietPlanStatus.objects.filter(
+                patient=obj.diet_plan.patient,
+                diet_plan=obj
+            ).order_by("date")
 
         return [
             {
                 "date": s.date,
                 "status": s.status,
-                "reason_audio": s.reason_audio.url if s.reason_audio else None,
+                "reason_audio": audio_url(s.reason_audio, variants=self.context.get("audio_variants", {})) if s.reason_audio else None,
             }
             for s in statuses
         ]
 
     def get_completed_portions(self, obj):
         target_date = self._get_target_date(obj)
-        patient = obj.diet_plan.patient
-        completed = DietPlanCompletedPortion.objects.filter(
-            patient=patient,
-            diet_plan_meal=obj,
-            date=target_date
-        ).select_related('portion')
+        if "portion_map" in self.context:
+            completed = self.context["portion_map"].get((obj.id, target_date), [])
+        else:
+            completed = DietPlanCompletedPortion.objects.filter(
+                patient=obj.diet_plan.patient,
+                diet_plan_meal=obj,
+                date=target_date
+            ).select_related('portion')
         return [
             {"id": cp.portion.id, "name": cp.portion.name}
             for cp in completed
@@ -132,13 +157,15 @@ class DietPlanMealSerializer(serializers.ModelSerializer):
 
     def get_others(self, obj):
         target_date = self._get_target_date(obj)
-        patient = obj.diet_plan.patient
         request = self.context.get('request')
-        extra_items = ExtraMeal.objects.filter(
-            patient=patient,
-            diet_plan_meal=obj,
-            date=target_date
-        )
+        if "extra_map" in self.context:
+            extra_items = self.context["extra_map"].get((obj.id, target_date), [])
+        else:
+            extra_items = ExtraMeal.objects.filter(
+                patient=obj.diet_plan.patient,
+                diet_plan_meal=obj,
+                date=target_date
+            )
         return [
             {
                 "id": e.id,
@@ -146,10 +173,84 @@ class DietPlanMealSerializer(serializers.ModelSerializer):
                 "quantity": e.quantity,
                 "notes": e.notes,
                 "image": request.build_absolute_uri(e.image.url) if e.image and request else None,
-                "audio_entry": request.build_absolute_uri(e.audio_entry.url) if e.audio_entry and request else None,
+                "audio_entry": audio_url(e.audio_entry, request, self.context.get("audio_variants", {})) if e.audio_entry and request else None,
             } for e in extra_items
         ]
 
+def build_diet_plan_review_lookups(diet_plans, start=None, end=None, target_date=None):
+    """
+    Context maps for DietPlanReadSerializer over `diet_plans` (with `diet_dates` and
+    `meals` prefetched): statuses inside the window (all of them without one) plus those
+    of each plan's latest date or `target_date`, the completed portions and extras of
+    those dates, and the audio variants of their voice notes. Four queries in total
+    instead of several per meal.
+    """
+    latest_date_map = {
+        plan.id: max((d.date for d in plan.diet_dates.all()), default=None)
+        for plan in diet_plans
+    }
+    meal_patients = {meal.id: plan.patient_id for plan in diet_plans for meal in plan.meals.all()}
+    lookups = {
+        "latest_date_map": latest_date_map,
+        "status_map": {},
+        "statuses_by_meal": defaultdict(list),
+        "portion_map": defaultdict(list),
+        "extra_map": defaultdict(list),
+        "audio_variants": {},
+    }
+    if not meal_patients:
+        return lookups
+
+    def in_window(day):
+        return (not start or day >= start) and (not end or day <= end)
+
+    days = {target_date} if target_date else {day for day in latest_date_map.values() if day}
+    statuses = DietPlanStatus.objects.filter(
+        patient_id__in=set(meal_patients.values()), diet_plan_id__in=meal_patients
+    )
+    if start or end:
+        window = Q()
+        if start:
+            window &= Q(date__gte=start)
+        if end:
+            window &= Q(date__lte=end)
+        statuses = statuses.filter(window | Q(date__in=days))
+    # Each meal only shows the entries of its own plan's patient.
+    for entry in statuses.order_by("date"):
+        if entry.patient_id != meal_patients[entry.diet_plan_id]:
+            continue
+        lookups["status_map"][entry.diet_plan_id, entry.date] = entry
+        if in_window(entry.date):
+            lookups["statuses_by_meal"][entry.diet_plan_id].append(entry)
+
+    for cp in DietPlanCompletedPortion.objects.filter(
+        patient_id__in=set(meal_patients.values()), diet_plan_meal_id__in=meal_patients, date__in=days
+    ).select_related("portion").order_by("id"):
+        if cp.patient_id == meal_patients[cp.diet_plan_meal_id]:
+            lookups["portion_map"][cp.diet_plan_meal_id, cp.date].append(cp)
+
+    for extra in ExtraMeal.objects.filter(
+        patient_id__in=set(meal_patients.values()), diet_plan_meal_id__in=meal_patients, date__in=days
+    ).order_by("id"):
+        if extra.patient_id == meal_patients[extra.diet_plan_meal_id]:
+            lookups["extra_map"][extra.diet_plan_meal_id, extra.date].append(extra)
+
+    lookups["audio_variants"] = audio_variant_map(
+        [entry.reason_audio.name for entry in lookups["status_map"].values() if entry.reason_audio]
+        + [extra.audio_entry.name for extras in lookups["extra_map"].values() for extra in extras if extra.audio_entry]
+    )
+    return lookups
+
+
+class DietPlanReadListSerializer(serializers.ListSerializer):
+    """Builds the review lookups of the whole page in one go."""
+
+    def to_representation(self, data):
+        plans = list(data.all() if hasattr(data, "all") else data)
+        if "status_map" not in self.context:
+            self._context.update(build_diet_plan_review_lookups(plans, target_date=self.context.get("target_date")))
+        return super().to_representation(plans)
+
 class DietPlanDateSerializer(serializers.ModelSerializer):
     class Meta:
         model = DietPlanDate
@@ -232,6 +333,12 @@ class DietPlanReadSerializer(serializers.ModelSerializer):
     class Meta:
         model = DietPlan
         fields = ["id", "patient", "patient_name", "doctor_id", "doctor_name", "dates", "meals"]
+        list_serializer_class = DietPlanReadListSerializer
+
+    def to_representation(self, instance):
+        if self.parent is None and "status_map" not in self.context:
+            self._context.update(build_diet_plan_review_lookups([instance], target_date=self.context.get("target_date")))
+        return super().to_representation(instance)
 
     def get_doctor_name(self, obj):
         profile = getattr(obj.doctor, "profile", None)
@@ -253,7 +360,7 @@ class DoctorExerciseResponseSerializer(serializers.ModelSerializer):
         model = DoctorExerciseResponse
         fields = '__all__'
            
-class PatientDietQuestionSerializer(serializers.ModelSerializer):
+class PatientDietQuestionSerializer(CompressedAudioMixin, serializers.ModelSerializer):
     breakfast_audio = serializers.SerializerMethodField()
     lunch_audio = serializers.SerializerMethodField()
     eveningSnack_audio = serializers.SerializerMethodField()
@@ -262,6 +369,7 @@ class PatientDietQuestionSerializer(serializers.ModelSerializer):
     class Meta:
         model = PatientDietQuestion
         fields = "__all__"
+        list_serializer_class = CompressedAudioListSerializer
 
     def get_full_url(self, obj, field):
         request = self.context.get("request")
@@ -4,8 +4,8 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
 from users.models import CustomUser, DietPlan, MealPortion, Exercise, LabReport, PatientResponse, PatientDietQuestion, PatientExerciseLog, DietPlanDate,ExerciseDate, ExerciseStatus
 from django.shortcuts import get_object_or_404
-from users.nutrition_service import fetch_nutrition_data
-from .serializers import PatientSerializer, DietPlanCreateSerializer, MealPortionSerializer,DietPlanReadSerializer,PatientDietQuestionSerializer,PatientExerciseLogSerializer,ExcerciseDateAssignSerializer,DoctorExerciseResponseSerializer
+from users.nutrition import schedule_nutrition_enrichment
+from .serializers import HealthStatusReviewSerializer, build_diet_plan_review_lookups, PatientSerializer, DietPlanCreateSerializer, MealPortionSerializer,DietPlanReadSerializer,PatientDietQuestionSerializer,PatientExerciseLogSerializer,ExcerciseDateAssignSerializer,DoctorExerciseResponseSerializer
 from users.serializers import ExerciseDateSerializer
 from patient.serializers import LabReportSerializer, PatientResponseSerializer
 from users.permissions import PermissionsManager,IsDoctorUser, IsSuperAdmin, IsAdmin, IsDoctorOrAdmin
@@ -13,10 +13,26 @@ from rest_framework import viewsets, filters, generics
 from django_filters.rest_framework import DjangoFilterBackend
 from users.filters import CustomUserFilter
 from users.pagination import Pagination
-from django.db.models.functions import ExtractMonth, ExtractYear, Now
-from django.db.models import IntegerField, F, ExpressionWrapper, Prefetch
+from users.querysets import HIGH_RISK_STATUSES, count_subquery, profile_metric_annotations
+from users.cohorts import doctor_cohort
+from django.db.models.functions import ExtractMonth
+from django.db.models import F, Prefetch, OuterRef, Q
 from django.utils.timezone import now
-from datetime import date
+from datetime import date, timedelta
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.decorators import action
+from django.conf import settings
+from django.utils.dateparse import parse_date
+from users.audio import audio_variant_map
+# ?sections= names of the patient chart and the keys they are returned under.
+CHART_SECTIONS = {
+    "summary": "patient_details",
+    "exercises": "assigned_exercises",
+    "diet_plans": "assigned_diet_plans",
+    "lab_reports": "lab_reports",
+    "questions": "questions",
+}
+
 class PatientManagementViewSet(viewsets.ModelViewSet):
     """
     Allows doctors to view and edit patient details.
@@ -28,55 +44,113 @@ class PatientManagementViewSet(viewsets.ModelViewSet):
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
     filterset_class = CustomUserFilter
     search_fields = ['profile__first_name', 'profile__last_name', 'email', 'phone_number']
-    ordering_fields = ['profile__first_name', 'age', 'birth_month', 'date_joined']
+    ordering_fields = ['profile__first_name', 'age', 'age_years', 'birth_month', 'date_joined', 'pregnancy_month_num', 'gestational_weeks', 'trimester', 'bmi_value']
     ordering = ['profile__first_name', 'age', 'birth_month', ] 
     codename = 'patientmanagement'
     
     def get_queryset(self):
-        today = date.today()
+        queryset = CustomUser.objects.filter(role='patient')
+        if self.request.query_params.get("my_patients") in ("1", "true"):
+            queryset = queryset.filter(patient_cohorts__doctor=self.request.user)
         return (
-            CustomUser.objects.filter(role='patient')
+            queryset
             .annotate(
-                # Age
-                age=ExpressionWrapper(
-                    ExtractYear(Now()) - ExtractYear(F('profile__date_of_birth')),
-                    output_field=IntegerField()
-                ),
-                # Birth month
+                **profile_metric_annotations("profile__"),
+                age=F('age_years'),  # ?ordering=age predates the metric annotations
                 birth_month=ExtractMonth(F('profile__date_of_birth')),
-
-                # Pregnancy month (approx, based on 28-day cycle)
-                pregnancy_month=ExpressionWrapper(
-                    ((Now() - F('profile__lmp_date')) / 28) + 1,
-                    output_field=IntegerField()
-                ),
-
-                # Gestational age in weeks (integer)
-                gestational_weeks=ExpressionWrapper(
-                    (Now() - F('profile__lmp_date')) / 7,
-                    output_field=IntegerField()
-                )
+                bmi_value=F('profile__bmi_value'),
             )
+            .select_related('profile')
         )
     def retrieve(self, request, pk=None):
-        patient = get_object_or_404(CustomUser, id=pk, role='patient')
-        
-        assigned_exercises = ExerciseDate.objects.filter(patient=patient).prefetch_related(
-            Prefetch('status_entries', queryset=ExerciseStatus.objects.filter(user=patient), to_attr='patient_status')
-        )
-        diet_plans = DietPlan.objects.filter(patient=patient)
-        lab_reports = LabReport.objects.filter(patient=patient)
-        questions = PatientResponse.objects.filter(user=patient)
-
-        data = {
-            "patient_details": PatientSerializer(patient).data,
-            "assigned_exercises": ExerciseDateSerializer(assigned_exercises, many=True).data,
-            "assigned_diet_plans": DietPlanReadSerializer(diet_plans, many=True, context={'request': request}).data,
-            "lab_reports": LabReportSerializer(lab_reports, many=True).data,
-            "questions": PatientResponseSerializer(questions, many=True).data
-        }
+        """
+        Sectioned patient chart. `?sections=` picks any of summary, exercises, diet_plans,
+        lab_reports, questions (default: all). Dated sections only cover the `from`/`to`
+        window, by default PATIENT_CHART_WINDOW_DAYS either side of today; use
+        `chart/<section>/` to page through a section.
+        """
+        requested = request.query_params.get("sections")
+        sections = [name.strip() for name in requested.split(",") if name.strip()] if requested else list(CHART_SECTIONS)
+        unknown = [name for name in sections if name not in CHART_SECTIONS]
+        if unknown:
+            raise ValidationError({"sections": f"Unknown sections: {', '.join(unknown)}. Use {', '.join(CHART_SECTIONS)}."})
+
+        patient = get_object_or_404(CustomUser.objects.select_related("profile"), id=pk, role='patient')
+        start, end = self.chart_window()
+        data = {}
+        for name in sections:
+            items = self.chart_section_queryset(name, patient, start, end)
+            data[CHART_SECTIONS[name]] = self.serialize_chart_section(name, items, patient, start, end)
         return Response(data, status=status.HTTP_200_OK)
-    
+
+    @action(detail=True, methods=["get"], url_path=r"chart/(?P<section>[a-z_]+)")
+    def chart_section(self, request, pk=None, section=None):
+        """One section of the patient chart, paginated, with the same `from`/`to` window."""
+        if section not in CHART_SECTIONS or section == "summary":
+            raise NotFound(f"Unknown chart section '{section}'.")
+        patient = get_object_or_404(CustomUser, id=pk, role='patient')
+        start, end = self.chart_window()
+        page = self.paginate_queryset(self.chart_section_queryset(section, patient, start, end))
+        return self.get_paginated_response(self.serialize_chart_section(section, page, patient, start, end))
+
+    def chart_window(self):
+        params = self.request.query_params
+        try:
+            start = parse_date(params.get("from") or "")
+            end = parse_date(params.get("to") or "")
+        except ValueError:
+            start = end = None
+        for key, value in (("from", start), ("to", end)):
+            if params.get(key) and value is None:
+                raise ValidationError({key: "Invalid date format. Use YYYY-MM-DD."})
+
+        if start is None and end is None:
+            today = date.today()
+            window = timedelta(days=settings.PATIENT_CHART_WINDOW_DAYS)
+            start, end = today - window, today + window
+        return start, end
+
+    def chart_section_queryset(self, section, patient, start, end):
+        def in_window(queryset, field):
+            if start:
+                queryset = queryset.filter(**{f"{field}__gte": start})
+            if end:
+                queryset = queryset.filter(**{f"{field}__lte": end})
+            return queryset
+
+        if section == "summary":
+            return patient
+        if section == "exercises":
+            return in_window(ExerciseDate.objects.filter(patient=patient), "date").select_related("exercise").prefetch_related(
+                Prefetch('status_entries', queryset=ExerciseStatus.objects.filter(user=patient), to_attr='patient_status')
+            ).order_by("date", "id")
+        if section == "diet_plans":
+            plan_ids = in_window(DietPlanDate.objects.filter(diet_plan__patient=patient), "date").values("diet_plan_id")
+            return DietPlan.objects.filter(id__in=plan_ids).select_related(
+                "patient__profile", "doctor__profile"
+            ).prefetch_related("diet_dates", "meals__meal_portions").order_by("-id")
+        if section == "lab_reports":
+            return in_window(LabReport.objects.filter(patient=patient), "date_of_report").order_by("-date_of_report", "-id")
+        return in_window(PatientResponse.objects.filter(user=patient), "created_at__date").order_by("-created_at", "-id")
+
+    def serialize_chart_section(self, section, items, patient, start, end):
+        context = {"request": self.request}
+        if section == "summary":
+            return PatientSerializer(patient, context=context).data
+        if section == "exercises":
+            items = list(items)
+            context["audio_variants"] = audio_variant_map([
+                entry.reason_audio.name for item in items for entry in item.patient_status if entry.reason_audio
+            ])
+            return ExerciseDateSerializer(items, many=True, context=context).data
+        if section == "diet_plans":
+            items = list(items)
+            context.update(build_diet_plan_review_lookups(items, start, end))
+            return DietPlanReadSerializer(items, many=True, context=context).data
+        if section == "lab_reports":
+            return LabReportSerializer(items, many=True).data
+        return PatientResponseSerializer(items, many=True).data
+
 
 class MealPortionViewSet(viewsets.ModelViewSet):
     queryset = MealPortion.objects.all()
@@ -85,21 +159,9 @@ class MealPortionViewSet(viewsets.ModelViewSet):
     filter_backends = [filters.SearchFilter]
     search_fields = ["name"]
 
-    def _enrich_with_nutrition(self, instance):
-        print(f"--- AI Nutrition: fetching data for '{instance.name}' ---")
-        data = fetch_nutrition_data(instance.name)
-        print(data)
-        if data:
-            for field, value in data.items():
-                setattr(instance, field, value)
-            instance.save(update_fields=list(data.keys()))
-            print(f"--- AI Nutrition: saved data for '{instance.name}' (calories={data.get('calories')}) ---")
-        else:
-            print(f"--- AI Nutrition: no data found for '{instance.name}' ---")
-
     def perform_create(self, serializer):
         instance = serializer.save()
-        self._enrich_with_nutrition(instance)
+        schedule_nutrition_enrichment([instance])
 
     def perform_update(self, serializer):
         name_changed = (
@@ -107,7 +169,7 @@ class MealPortionViewSet(viewsets.ModelViewSet):
         )
         instance = serializer.save()
         if name_changed:
-            self._enrich_with_nutrition(instance)
+            schedule_nutrition_enrichment([instance])
 
 class DietPlanViewSet(viewsets.ModelViewSet):
     """
@@ -184,26 +246,50 @@ class DietPlanViewSet(viewsets.ModelViewSet):
                 pass
 
         return context
-class ReviewHealthStatusView(APIView):
+class ReviewHealthStatusView(generics.ListAPIView):
     """
-    Allows doctors to review the health status of patients.
+    Allows doctors to review the health status of their patients.
+
+    Patients come from the doctor's cohort rows, which also carry the latest health
+    status and trimester; counts are subqueries of the same statement.
+    Filters: `risk=high|normal`, `trimester=1|2|3`.
     """
     permission_classes = [PermissionsManager,IsDoctorUser]
+    serializer_class = HealthStatusReviewSerializer
+    pagination_class = Pagination
+    filter_backends = [filters.OrderingFilter]
+    ordering_fields = ['id', 'username', 'diet_plan_count', 'lab_report_count', 'health_status', 'trimester']
+    ordering = ['id']
+    codename = 'healthstatus'
 
-    def get(self, request):
-        if not hasattr(request.user, 'role') or request.user.role != 'doctor':
-            return Response({'error': 'Access denied'}, status=403)
-        patients = CustomUser.objects.filter(role='patient')
-        data = []
-        for patient in patients:
-            health_status = {
-                'patient_id': patient.id,
-                'username': patient.username,
-                'diet_plans': patient.assigned_diets.count(),
-                'lab_reports': patient.lab_reports.count(),
-            }
-            data.append(health_status)
-        return Response(data)
+    def get_queryset(self):
+        doctor_cohort(self.request.user)
+        cohort = Q(patient_cohorts__doctor=self.request.user)
+
+        params = self.request.query_params
+        risk = params.get("risk")
+        if risk == "high":
+            cohort &= Q(patient_cohorts__health_status__in=HIGH_RISK_STATUSES)
+        elif risk == "normal":
+            cohort &= Q(patient_cohorts__health_status__isnull=True) | ~Q(patient_cohorts__health_status__in=HIGH_RISK_STATUSES)
+        elif risk:
+            raise ValidationError({"risk": "Use 'high' or 'normal'."})
+
+        trimester = params.get("trimester")
+        if trimester:
+            if trimester not in ("1", "2", "3"):
+                raise ValidationError({"trimester": "Use 1, 2 or 3."})
+            cohort &= Q(patient_cohorts__trimester=int(trimester))
+
+        return (
+            CustomUser.objects.filter(cohort, role='patient')
+            .annotate(
+                diet_plan_count=count_subquery(DietPlan.objects.filter(patient=OuterRef("pk")), "patient"),
+                lab_report_count=count_subquery(LabReport.objects.filter(patient=OuterRef("pk")), "patient"),
+                health_status=F("patient_cohorts__health_status"),
+                trimester=F("patient_cohorts__trimester"),
+            )
+        )
     
     
 class DoctorAssignExerciseView(APIView):
@@ -1,8 +1,9 @@
 from django.contrib import admin
 
 # Register your models here.
-from notification.models import Notification, DeviceToken
+from notification.models import Notification, DeviceToken, NotificationOutbox
 
 
 admin.site.register(Notification)
-admin.site.register(DeviceToken)
\ No newline at end of file
+admin.site.register(DeviceToken)
+admin.site.register(NotificationOutbox)
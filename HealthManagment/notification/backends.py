@@ -0,0 +1,98 @@
+import json
+import logging
+from dataclasses import dataclass
+
+import firebase_admin
+from firebase_admin import credentials, messaging
+from decouple import config
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from users.outbound import get_client
+
+logger = logging.getLogger(__name__)
+
+# FCM accepts at most 500 tokens per multicast request.
+MAX_MULTICAST_TOKENS = 500
+
+
+@dataclass
+class PushResult:
+    token: str
+    success: bool
+    unregistered: bool = False
+    error: str = None
+
+
+def initialize_firebase():
+    if not firebase_admin._apps:
+        firebase_json = config("FIREBASE_CREDENTIALS")
+
+        if not firebase_json:
+            raise Exception("Firebase credentials not found in ENV")
+
+        cred_dict = json.loads(firebase_json)
+
+        cred = credentials.Certificate(cred_dict)
+        firebase_admin.initialize_app(cred, {"httpTimeout": get_client("fcm").timeout[1]})
+
+
+class FirebaseMessagingBackend:
+    """Sends multicast pushes through firebase_admin.messaging."""
+
+    def send_multicast(self, tokens, title, body, data=None):
+        initialize_firebase()
+
+        message = messaging.MulticastMessage(
+            notification=messaging.Notification(
+                title=title,
+                body=body,
+            ),
+            tokens=tokens,
+            data={str(k): str(v) for k, v in (data or {}).items()}  # Firebase needs string
+        )
+
+        # Fails fast with ProviderUnavailable while FCM's circuit is open; the outbox
+        # keeps the entries for the next run.
+        response = get_client("fcm").call(messaging.send_each_for_multicast, message)
+        logger.info("FCM multicast: %s sent, %s failed", response.success_count, response.failure_count)
+
+        results = []
+        for token, r in zip(tokens, response.responses):
+            if r.success:
+                results.append(PushResult(token=token, success=True))
+                continue
+            unregistered = isinstance(
+                r.exception, (messaging.UnregisteredError, messaging.SenderIdMismatchError)
+            )
+            results.append(PushResult(token=token, success=False, unregistered=unregistered, error=str(r.exception)))
+        return results
+
+
+class FakeMessagingBackend:
+    """
+    In-memory stand-in for FCM used in tests and local development.
+    Tokens listed in `unregistered_tokens` fail the way FCM reports stale devices.
+    """
+    sent = []
+    unregistered_tokens = set()
+
+    def send_multicast(self, tokens, title, body, data=None):
+        if len(tokens) > MAX_MULTICAST_TOKENS:
+            raise ValueError(f"Multicast is limited to {MAX_MULTICAST_TOKENS} tokens.")
+        self.sent.append({"tokens": list(tokens), "title": title, "body": body, "data": dict(data or {})})
+        return [
+            PushResult(token=token, success=False, unregistered=True, error="registration-token-not-registered")
+            if token in self.unregistered_tokens else PushResult(token=token, success=True)
+            for token in tokens
+        ]
+
+    @classmethod
+    def reset(cls):
+        cls.sent = []
+        cls.unregistered_tokens = set()
+
+
+def get_messaging_backend():
+    backend_path = getattr(settings, "PUSH_MESSAGING_BACKEND", "notification.backends.FirebaseMessagingBackend")
+    return import_string(backend_path)()
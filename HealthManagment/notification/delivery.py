@@ -0,0 +1,199 @@
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from users.outbound import backoff_delay
+
+from .backends import MAX_MULTICAST_TOKENS, get_messaging_backend
+from .models import DeviceToken, NotificationOutbox
+
+logger = logging.getLogger(__name__)
+
+
+def _claim_batch(batch_size):
+    """Moves up to `batch_size` due pending rows to `processing` and returns them."""
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            NotificationOutbox.objects
+            .select_for_update(skip_locked=True)
+            .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now), status="pending")
+            .order_by("id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        if not ids:
+            return []
+        NotificationOutbox.objects.filter(id__in=ids).update(
+            status="processing",
+            claimed_at=now,
+            attempts=F("attempts") + 1,
+        )
+    return list(
+        NotificationOutbox.objects
+        .filter(id__in=ids)
+        .select_related("notification")
+        .order_by("id")
+    )
+
+
+def _release_stuck_entries():
+    """
+    Returns rows claimed by a worker that died mid-batch to the queue, or fails them
+    once they have used up PUSH_MAX_ATTEMPTS.
+    """
+    timeout = getattr(settings, "PUSH_OUTBOX_CLAIM_TIMEOUT", 300)
+    max_attempts = getattr(settings, "PUSH_MAX_ATTEMPTS", 5)
+    now = timezone.now()
+    stuck = NotificationOutbox.objects.filter(
+        status="processing",
+        claimed_at__lt=now - timedelta(seconds=timeout),
+    )
+    stuck.filter(attempts__gte=max_attempts).update(
+        status="failed", last_error="Claim timed out", processed_at=now
+    )
+    stuck.update(status="pending", next_attempt_at=now)
+
+
+def _coalesce(entries):
+    """
+    Builds one push payload per user. A single pending notification is sent as is;
+    several pending notifications for the same user are merged into one summary push
+    that carries the latest one's extra_data, so tapping it still opens that screen.
+    """
+    by_user = defaultdict(list)
+    for entry in entries:
+        by_user[entry.notification.user_id].append(entry)
+
+    payloads = {}
+    for user_id, user_entries in by_user.items():
+        notifications = [e.notification for e in user_entries]
+        data = {str(k): str(v) for k, v in (notifications[-1].extra_data or {}).items()}
+        if len(notifications) == 1:
+            n = notifications[0]
+            payload = (n.title, n.message, tuple(sorted(data.items())))
+        else:
+            titles = list(dict.fromkeys(n.title for n in reversed(notifications)))
+            data["count"] = str(len(notifications))
+            payload = (
+                f"You have {len(notifications)} new notifications",
+                ", ".join(titles[:3]),
+                tuple(sorted(data.items())),
+            )
+        payloads[user_id] = payload
+    return by_user, payloads
+
+
+def deliver_pending_notifications(batch_size=None, backend=None):
+    """
+    Drains one batch of the outbox.
+
+    Notifications are coalesced per user, users sharing the same payload are sent
+    together in multicasts of at most 500 tokens, and tokens FCM reports as
+    unregistered are deactivated. Failed entries are retried with backoff on a later
+    run. Returns counters for logging.
+    """
+    batch_size = batch_size or getattr(settings, "PUSH_OUTBOX_BATCH_SIZE", 500)
+    max_attempts = getattr(settings, "PUSH_MAX_ATTEMPTS", 5)
+    backend = backend or get_messaging_backend()
+
+    _release_stuck_entries()
+    entries = _claim_batch(batch_size)
+    stats = {"notifications": len(entries), "multicasts": 0, "sent": 0, "failed": 0, "retry": 0, "deactivated": 0}
+    if not entries:
+        return stats
+
+    by_user, payloads = _coalesce(entries)
+
+    tokens_by_user = defaultdict(list)
+    for user_id, token in (
+        DeviceToken.objects
+        .filter(user_id__in=by_user.keys(), is_active=True)
+        .values_list("user_id", "token")
+        .distinct()
+    ):
+        tokens_by_user[user_id].append(token)
+
+    token_owner = {}
+    tokens_by_payload = defaultdict(list)
+    for user_id, payload in payloads.items():
+        for token in tokens_by_user.get(user_id, []):
+            token_owner[token] = user_id
+            tokens_by_payload[payload].append(token)
+
+    delivered_users, failed_users, errors = set(), set(), {}
+    unregistered = []
+    for (title, body, data), tokens in tokens_by_payload.items():
+        for start in range(0, len(tokens), MAX_MULTICAST_TOKENS):
+            chunk = tokens[start:start + MAX_MULTICAST_TOKENS]
+            stats["multicasts"] += 1
+            try:
+                results = backend.send_multicast(chunk, title, body, dict(data))
+            except Exception as exc:
+                logger.exception("Push multicast failed")
+                for token in chunk:
+                    failed_users.add(token_owner[token])
+                    errors[token_owner[token]] = str(exc)
+                continue
+            for result in results:
+                user_id = token_owner[result.token]
+                if result.success:
+                    delivered_users.add(user_id)
+                    stats["sent"] += 1
+                else:
+                    failed_users.add(user_id)
+                    errors[user_id] = result.error
+                    stats["failed"] += 1
+                    if result.unregistered:
+                        unregistered.append(result.token)
+
+    if unregistered:
+        stats["deactivated"] = DeviceToken.objects.filter(token__in=unregistered).update(is_active=False)
+
+    now = timezone.now()
+    outcome = defaultdict(list)
+    for user_id, user_entries in by_user.items():
+        if user_id in delivered_users:
+            state = "sent"
+        elif user_id not in failed_users:
+            state = "no_tokens"
+        else:
+            state = "retry"
+        for entry in user_entries:
+            if state != "retry":
+                outcome[state, None, None].append(entry.id)
+            elif entry.attempts >= max_attempts:
+                outcome["failed", errors.get(user_id), None].append(entry.id)
+            else:
+                stats["retry"] += 1
+                outcome["pending", errors.get(user_id), entry.attempts].append(entry.id)
+
+    for (state, error, attempts), ids in outcome.items():
+        NotificationOutbox.objects.filter(id__in=ids).update(
+            status=state,
+            last_error=error,
+            processed_at=now if state != "pending" else None,
+            next_attempt_at=now + timedelta(seconds=backoff_delay(attempts, base=30, cap=3600)) if attempts else None,
+        )
+
+    return stats
+
+
+def drain_outbox(batch_size=None, backend=None):
+    """
+    Delivers batches while they come back full and returns the summed counters.
+    Stops early when a whole batch has to be retried (e.g. FCM is unreachable), so
+    the rest of the queue keeps its attempts for a later run.
+    """
+    batch_size = batch_size or getattr(settings, "PUSH_OUTBOX_BATCH_SIZE", 500)
+    totals = {"notifications": 0, "multicasts": 0, "sent": 0, "failed": 0, "retry": 0, "deactivated": 0}
+    while True:
+        stats = deliver_pending_notifications(batch_size=batch_size, backend=backend)
+        for key, value in stats.items():
+            totals[key] += value
+        if stats["notifications"] < batch_size or stats["retry"] == stats["notifications"]:
+            return totals
@@ -0,0 +1,29 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from notification.delivery import deliver_pending_notifications
+
+
+class Command(BaseCommand):
+    help = "Deliver queued push notifications from the outbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None, help="Outbox rows claimed per batch")
+        parser.add_argument("--loop", action="store_true", help="Keep polling the outbox instead of exiting")
+        parser.add_argument("--interval", type=float, default=5, help="Seconds to sleep when the outbox is empty")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"] or settings.PUSH_OUTBOX_BATCH_SIZE
+        while True:
+            stats = deliver_pending_notifications(batch_size=batch_size)
+            if stats["notifications"]:
+                self.stdout.write(
+                    f"Delivered {stats['notifications']} notifications in {stats['multicasts']} multicasts "
+                    f"(sent={stats['sent']}, failed={stats['failed']}, retry={stats['retry']}, "
+                    f"deactivated={stats['deactivated']})"
+                )
+            if stats["notifications"] >= batch_size and stats["retry"] < stats["notifications"]:
+                continue
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
@@ -39,4 +39,38 @@ class DeviceToken(models.Model):
     is_active = models.BooleanField(default=True)
 
     def __str__(self):
-        return f"{self.user.phone_number}"
\ No newline at end of file
+        return f"{self.user.phone_number}"
+
+class NotificationOutbox(models.Model):
+    """
+    Push delivery queue. Requests only insert here; the delivery worker
+    drains pending rows in batches and sends them through FCM.
+    """
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("processing", "Processing"),
+        ("sent", "Sent"),
+        ("no_tokens", "No tokens"),
+        ("failed", "Failed"),
+    ]
+
+    notification = models.OneToOneField(
+        Notification,
+        on_delete=models.CASCADE,
+        related_name="outbox_entry"
+    )
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)  # Backoff before the next retry
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "id"], name="outbox_status_id_idx"),
+        ]
+
+    def __str__(self):
+        return f"Outbox {self.notification_id} ({self.status})"
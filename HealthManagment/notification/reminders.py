@@ -0,0 +1,50 @@
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+
+from .delivery import drain_outbox
+from .models import Notification, NotificationOutbox
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def queue_reminders(recipients, n_type, chunk_size=None):
+    """
+    Bulk-queues reminder notifications.
+
+    `recipients` yields (user_id, title, message) tuples and is consumed in
+    chunks, so it can be a server-side cursor over any number of patients.
+    Each chunk is written with two bulk inserts (notifications, outbox rows).
+    Returns the number of notifications queued.
+    """
+    chunk_size = chunk_size or settings.REMINDER_CHUNK_SIZE
+    queued = 0
+    for chunk in _chunks(recipients, chunk_size):
+        with transaction.atomic():
+            notifications = Notification.objects.bulk_create([
+                Notification(user_id=user_id, title=title, message=message, notification_type=n_type)
+                for user_id, title, message in chunk
+            ])
+            NotificationOutbox.objects.bulk_create([
+                NotificationOutbox(notification_id=n.id) for n in notifications
+            ])
+        queued += len(notifications)
+    return queued
+
+
+def send_reminders(recipients, n_type, chunk_size=None, backend=None):
+    """
+    Queues the reminders and drains the outbox straight away, so identical
+    reminders go out as multicasts of up to 500 tokens in the same run.
+    """
+    stats = {"queued": queue_reminders(recipients, n_type, chunk_size)}
+    stats.update(drain_outbox(backend=backend))
+    return stats
@@ -1,49 +1,18 @@
-import os,json
-import firebase_admin
-from firebase_admin import credentials, messaging
-from django.conf import settings
-from .models import Notification, DeviceToken
-from decouple import config
+from django.db import transaction
+from .models import Notification, NotificationOutbox
+from .backends import get_messaging_backend
 
-# ✅ Initialize Firebase (safe)
-def initialize_firebase():
-    if not firebase_admin._apps:
-        firebase_json = config("FIREBASE_CREDENTIALS")
 
-        if not firebase_json:
-            raise Exception("Firebase credentials not found in ENV")
-
-        cred_dict = json.loads(firebase_json)
-
-        cred = credentials.Certificate(cred_dict)
-        firebase_admin.initialize_app(cred)
-
-# ✅ Push Notification Sender
+# ✅ Push Notification Sender (synchronous, bypasses the outbox)
 def send_push_notification(tokens, title, body, data=None):
-    initialize_firebase()
-
-    message = messaging.MulticastMessage(
-        notification=messaging.Notification(
-            title=title,
-            body=body,
-        ),
-        tokens=tokens,
-        data={str(k): str(v) for k, v in (data or {}).items()}  # Firebase needs string
-    )
-
-    response = messaging.send_each_for_multicast(message)
-
-    print("FCM Response:", response.success_count, response.failure_count)
-    print("Success:", sum([r.success for r in response.responses]))
-    print("Failure:", sum([not r.success for r in response.responses]))
-
-    return response
+    return get_messaging_backend().send_multicast(list(tokens), title, body, data)
 
 
 # ✅ MAIN FUNCTION (USE THIS EVERYWHERE)
 def send_notification(user, title, message, n_type="general", data=None):
     """
-    Sends notification + saves in DB
+    Saves the notification and queues it for push delivery.
+    The outbox worker (notification.delivery) sends it, so callers never wait on FCM.
 
     Args:
         user: CustomUser instance
@@ -53,32 +22,17 @@ def send_notification(user, title, message, n_type="general", data=None):
         data: dict (extra data for mobile navigation)
     """
 
-    # 1️⃣ Save in DB
-    Notification.objects.create(
-        user=user,
-        title=title,
-        message=message,
-        notification_type=n_type,
-        extra_data=data
-    )
-
-    # 2️⃣ Get device tokens
-    tokens = DeviceToken.objects.filter(
-        user=user,
-        is_active=True
-    ).values_list("token", flat=True)
-
-    tokens = list(tokens)
-
-    if not tokens:
-        print("No device tokens found for user")
-        return {"status": "no_tokens"}
-
-    # 3️⃣ Send push
-    response = send_push_notification(tokens, title, message, data)
+    with transaction.atomic():
+        notification = Notification.objects.create(
+            user=user,
+            title=title,
+            message=message,
+            notification_type=n_type,
+            extra_data=data
+        )
+        NotificationOutbox.objects.create(notification=notification)
 
     return {
-        "status": "sent",
-        "success": response.success_count,
-        "failed": response.failure_count
-    }
\ No newline at end of file
+        "status": "queued",
+        "notification_id": notification.id,
+    }
@@ -1,6 +1,8 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from users.models import LabReport, HealthStatus
+from users.signals import record_sync_tombstone
+from .models import Notification
 from .services import send_notification
 
 
@@ -23,4 +25,9 @@ def notify_health_update(sender, instance, created, **kwargs):
             title="Health Updated",
             message="Your health status updated",
             n_type="general"
-        )
\ No newline at end of file
+        )
+
+
+@receiver(post_delete, sender=Notification)
+def record_deleted_notification(sender, instance, origin=None, **kwargs):
+    record_sync_tombstone("notifications", instance.user_id, instance.pk, origin)
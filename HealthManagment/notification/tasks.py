@@ -1,56 +1,90 @@
 from celery import shared_task
+from django.conf import settings
 from django.utils.timezone import now
-from users.models import DietPlanMeal, DietPlanDate, ExerciseDate
-from .services import send_notification
+from users.models import DietPlanMeal, DietPlanDate, ExerciseDate, QuestionnaireCadence
+from users.questionnaire import due_questionnaire_cadences
+from .delivery import drain_outbox
+from .reminders import send_reminders
+
+
+@shared_task
+def deliver_pending_notifications():
+    """Drains the push outbox (scheduled by celery beat)."""
+    return drain_outbox()
 
 
 @shared_task
 def send_meal_notifications():
     current_time = now().time()
+    today = now().date()
 
     meals = DietPlanMeal.objects.filter(
         start_time__lte=current_time,
-        end_time__gte=current_time
-    )
-
-    for meal in meals:
-        patient = meal.diet_plan.patient
+        end_time__gte=current_time,
+        diet_plan__diet_dates__date=today
+    ).values_list("diet_plan__patient_id", "meal_type").distinct()
 
-        send_notification(
-            user=patient,
-            title="Meal Reminder 🍽️",
-            message=f"It's time for {meal.meal_type}",
-            n_type="diet"
-        )
+    return send_reminders(
+        (
+            (patient_id, "Meal Reminder 🍽️", f"It's time for {meal_type}")
+            for patient_id, meal_type in meals.iterator(chunk_size=settings.REMINDER_CHUNK_SIZE)
+        ),
+        n_type="diet"
+    )
 
 
 @shared_task
 def daily_diet_reminder():
     today = now().date()
 
-    diet_dates = DietPlanDate.objects.filter(date=today)
-
-    for d in diet_dates:
-        patient = d.diet_plan.patient
+    patient_ids = DietPlanDate.objects.filter(
+        date=today
+    ).values_list("diet_plan__patient_id", flat=True).distinct()
 
-        send_notification(
-            user=patient,
-            title="Today's Diet Plan",
-            message="Check your diet plan for today",
-            n_type="diet"
-        )
+    return send_reminders(
+        (
+            (patient_id, "Today's Diet Plan", "Check your diet plan for today")
+            for patient_id in patient_ids.iterator(chunk_size=settings.REMINDER_CHUNK_SIZE)
+        ),
+        n_type="diet"
+    )
 
 
 @shared_task
 def exercise_reminder():
     today = now().date()
 
-    exercises = ExerciseDate.objects.filter(date=today)
+    exercises = ExerciseDate.objects.filter(
+        date=today
+    ).values_list("patient_id", "exercise__title").distinct()
+
+    return send_reminders(
+        (
+            (patient_id, "Exercise Reminder 🏃", f"Do your exercise: {title}")
+            for patient_id, title in exercises.iterator(chunk_size=settings.REMINDER_CHUNK_SIZE)
+        ),
+        n_type="exercise"
+    )
+
 
-    for ex in exercises:
-        send_notification(
-            user=ex.patient,
-            title="Exercise Reminder 🏃",
-            message=f"Do your exercise: {ex.exercise.title}",
-            n_type="exercise"
-        )
\ No newline at end of file
+@shared_task
+def questionnaire_round_reminder():
+    """Notifies every patient whose next questionnaire round opened, once per round."""
+    today = now().date()
+    # Read up front: only the cadences reminded in this run are marked, not ones that
+    # became due while the pushes went out.
+    due = list(due_questionnaire_cadences(today).values_list("id", "patient_id"))
+
+    stats = send_reminders(
+        (
+            (patient_id, "Health Check-in 📝", "Your next set of health questions is ready")
+            for _, patient_id in due
+        ),
+        n_type="followup"
+    )
+    chunk_size = settings.REMINDER_CHUNK_SIZE
+    for start in range(0, len(due), chunk_size):
+        QuestionnaireCadence.objects.filter(
+            id__in=[cadence_id for cadence_id, _ in due[start:start + chunk_size]]
+        ).update(last_reminded_on=today)
+    return stats
@@ -1,3 +1,127 @@
-from django.test import TestCase
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from users.models import CustomUser, QuestionnaireCadence
+from .backends import FakeMessagingBackend
+from .delivery import _release_stuck_entries, deliver_pending_notifications, drain_outbox
+from .models import DeviceToken, Notification, NotificationOutbox
+from .reminders import send_reminders
+from .services import send_notification
+from .tasks import questionnaire_round_reminder
+
+
+class UnreachableBackend:
+    def send_multicast(self, tokens, title, body, data=None):
+        raise ConnectionError("FCM unreachable")
+
+
+@override_settings(PUSH_MAX_ATTEMPTS=3)
+class OutboxDeliveryTests(TestCase):
+    def setUp(self):
+        FakeMessagingBackend.reset()
+        self.users = []
+        for i in range(3):
+            user = CustomUser.objects.create(username=f"p{i}", phone_number=f"+91999990010{i}")
+            DeviceToken.objects.create(user=user, token=f"token-{i}")
+            self.users.append(user)
+
+    def notify(self, user, title="Title", data=None):
+        return send_notification(user, title, "Message", data=data)["notification_id"]
+
+    def make_due(self):
+        NotificationOutbox.objects.filter(status="pending").update(next_attempt_at=timezone.now())
+
+    def test_pending_notifications_are_sent(self):
+        for user in self.users:
+            self.notify(user)
+        stats = drain_outbox(backend=FakeMessagingBackend())
+        self.assertEqual((stats["sent"], stats["multicasts"]), (3, 1))
+        self.assertFalse(NotificationOutbox.objects.exclude(status="sent").exists())
+
+    def test_failed_entries_wait_for_their_backoff(self):
+        self.notify(self.users[0])
+        stats = deliver_pending_notifications(backend=UnreachableBackend())
+        self.assertEqual(stats["retry"], 1)
+
+        entry = NotificationOutbox.objects.get()
+        self.assertEqual((entry.status, entry.attempts), ("pending", 1))
+        self.assertIsNotNone(entry.next_attempt_at)
+        self.assertIn("FCM unreachable", entry.last_error)
+
+        entry.next_attempt_at = timezone.now() + timedelta(minutes=5)
+        entry.save(update_fields=["next_attempt_at"])
+        self.assertEqual(deliver_pending_notifications(backend=FakeMessagingBackend())["notifications"], 0)
+
+        self.make_due()
+        self.assertEqual(deliver_pending_notifications(backend=FakeMessagingBackend())["sent"], 1)
+
+    def test_entries_fail_after_max_attempts(self):
+        self.notify(self.users[0])
+        for _ in range(3):
+            self.make_due()
+            deliver_pending_notifications(backend=UnreachableBackend())
+        entry = NotificationOutbox.objects.get()
+        self.assertEqual((entry.status, entry.attempts), ("failed", 3))
+
+        self.make_due()
+        self.assertEqual(deliver_pending_notifications(backend=UnreachableBackend())["notifications"], 0)
+
+    def test_drain_stops_when_a_whole_batch_is_retried(self):
+        for user in self.users:
+            self.notify(user)
+        stats = drain_outbox(batch_size=1, backend=UnreachableBackend())
+        self.assertEqual((stats["notifications"], stats["retry"]), (1, 1))
+        self.assertEqual(NotificationOutbox.objects.filter(attempts=0).count(), 2)
+
+    def test_stuck_claims_are_released_or_failed(self):
+        fresh, exhausted = self.notify(self.users[0]), self.notify(self.users[1])
+        claimed_at = timezone.now() - timedelta(hours=1)
+        NotificationOutbox.objects.filter(notification_id=fresh).update(status="processing", attempts=1, claimed_at=claimed_at)
+        NotificationOutbox.objects.filter(notification_id=exhausted).update(status="processing", attempts=3, claimed_at=claimed_at)
+
+        _release_stuck_entries()
+        self.assertEqual(NotificationOutbox.objects.get(notification_id=fresh).status, "pending")
+        self.assertEqual(NotificationOutbox.objects.get(notification_id=exhausted).status, "failed")
+
+    def test_coalesced_push_keeps_the_latest_deep_link(self):
+        self.notify(self.users[0], "Diet", {"screen": "diet", "id": 1})
+        self.notify(self.users[0], "Lab report", {"screen": "lab", "id": 7})
+        drain_outbox(backend=FakeMessagingBackend())
+
+        [push] = FakeMessagingBackend.sent
+        self.assertEqual(push["title"], "You have 2 new notifications")
+        self.assertEqual(push["data"], {"screen": "lab", "id": "7", "count": "2"})
+
+
+@override_settings(PUSH_MESSAGING_BACKEND="notification.backends.FakeMessagingBackend")
+class QuestionnaireReminderTests(TestCase):
+    def setUp(self):
+        FakeMessagingBackend.reset()
+        self.today = timezone.now().date()
+        self.patients = [
+            CustomUser.objects.create(username=f"p{i}", phone_number=f"+91999990010{i}", role="patient")
+            for i in range(2)
+        ]
+        self.due = QuestionnaireCadence.objects.create(patient=self.patients[0], next_due_date=self.today)
+
+    def test_due_patients_are_reminded_once_per_round(self):
+        self.assertEqual(questionnaire_round_reminder()["queued"], 1)
+        self.due.refresh_from_db()
+        self.assertEqual(self.due.last_reminded_on, self.today)
+        self.assertEqual(questionnaire_round_reminder()["queued"], 0)
+
+    def test_cadence_due_during_the_run_is_left_for_the_next_one(self):
+        def due_meanwhile(recipients, n_type):
+            stats = send_reminders(recipients, n_type)
+            QuestionnaireCadence.objects.create(patient=self.patients[1], next_due_date=self.today)
+            return stats
+
+        with mock.patch("notification.tasks.send_reminders", side_effect=due_meanwhile):
+            questionnaire_round_reminder()
+        late = QuestionnaireCadence.objects.get(patient=self.patients[1])
+        self.assertIsNone(late.last_reminded_on)
+        self.assertEqual(Notification.objects.filter(user=self.patients[1]).count(), 0)
+        self.assertEqual(questionnaire_round_reminder()["queued"], 1)
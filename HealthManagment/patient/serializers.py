@@ -1,8 +1,10 @@
 from rest_framework import serializers
 from users.models import CustomUser, ExerciseDate, LabReport, Question, HealthStatus,PatientResponse, PatientDietQuestion, PatientExerciseLog, ExerciseLogEntry, DietPlanStatus, ExerciseStatus,DietPlanMeal,DietPlanDate,DietPlanCompletedPortion,ExtraMeal
 from users.serializers import OptionSerializer
+from users.audio import CompressedAudioMixin, CompressedAudioListSerializer, audio_url, audio_variant_map
 from django.utils import timezone
 from datetime import date
+from collections import defaultdict
 class EmptyLabReportSerializer(serializers.Serializer):
     message = serializers.SerializerMethodField()
 
@@ -16,12 +18,7 @@ class DietPlanStatusSerializer(serializers.ModelSerializer):
         fields = ['status', 'date', 'reason_audio', 'diet_plan']
 
     def create(self, validated_data):
-        """Convert audio file to binary before saving"""
-        audio_file = validated_data.pop('reason_audio', None)
-
-        if audio_file:
-            validated_data['reason_audio'] = audio_file.read()  # Convert file to binary
-
+        """The uploaded file is handed to the storage backend, which streams it in chunks"""
         return DietPlanStatus.objects.create(**validated_data)
 
     def get_reason_audio(self, obj):
@@ -52,11 +49,19 @@ class DietPlanMealSerializer(serializers.ModelSerializer):
                 return f"{obj.start_time.strftime('%H:%M')} – {obj.end_time.strftime('%H:%M')}"
         return None
     
+    def _lookup(self, name, obj):
+        """Reads from the maps built by build_diet_plan_lookups, keyed by (meal id, date)."""
+        date = self.context.get("target_date", timezone.now().date())
+        return self.context[name].get((obj.id, date), [])
+
     def get_status(self, obj):
         request = self.context.get('request')
         user = getattr(request, 'user', None)
         date = self.context.get("target_date", timezone.now().date())
 
+        if "status_map" in self.context:
+            return self._lookup("status_map", obj) or "pending"
+
         if user and user.is_authenticated:
             status_obj = DietPlanStatus.objects.filter(
                 patient=user,
@@ -73,40 +78,81 @@ class DietPlanMealSerializer(serializers.ModelSerializer):
         user = getattr(request, 'user', None)
         date = self.context.get("target_date", timezone.now().date())
 
-        if user:
+        if "extra_map" in self.context:
+            extra_items = self._lookup("extra_map", obj)
+        elif user:
             extra_items = ExtraMeal.objects.filter(
                 patient=user,
                 diet_plan_meal=obj,
                 date=date
             )
-            return [
-                {
-                    "id": e.id,
-                    "text": e.item_name,
-                    "quantity": e.quantity,
-                    "notes": e.notes,
-                    "image": request.build_absolute_uri(e.image.url) if e.image and request else None,
-                    "audio_entry": request.build_absolute_uri(e.audio_entry.url) if e.audio_entry and request else None,
-                } for e in extra_items
-            ]
-        return []
+        else:
+            return []
+        return [
+            {
+                "id": e.id,
+                "text": e.item_name,
+                "quantity": e.quantity,
+                "notes": e.notes,
+                "image": request.build_absolute_uri(e.image.url) if e.image and request else None,
+                "audio_entry": audio_url(e.audio_entry, request, self.context.get("audio_variants")) if e.audio_entry and request else None,
+            } for e in extra_items
+        ]
 
     def get_completed_portions(self, obj):
         request = self.context.get('request')
         user = getattr(request, 'user', None)
         date = self.context.get("target_date", timezone.now().date())
 
-        if user:
+        if "portion_map" in self.context:
+            completed = self._lookup("portion_map", obj)
+        elif user:
             completed = DietPlanCompletedPortion.objects.filter(
                 patient=user,
                 diet_plan_meal=obj,
                 date=date
             ).select_related('portion')
-            return [
-                {"id": cp.portion.id, "name": cp.portion.name}
-                for cp in completed
-            ]
-        return []
+        else:
+            return []
+        return [
+            {"id": cp.portion.id, "name": cp.portion.name}
+            for cp in completed
+        ]
+
+
+def build_diet_plan_lookups(patient, dates):
+    """
+    Loads the patient's statuses, completed portions, extra meals and the compressed
+    variants of their voice notes for the given dates in four queries and returns them
+    as serializer context maps keyed by (meal id, date), so DietPlanMealSerializer
+    does not query per meal.
+    """
+    dates = set(dates)
+    lookups = {
+        "status_map": {}, "portion_map": defaultdict(list), "extra_map": defaultdict(list), "audio_variants": {},
+    }
+    if not dates:
+        return lookups
+
+    for meal_id, day, status in DietPlanStatus.objects.filter(
+        patient=patient, date__in=dates
+    ).values_list("diet_plan_id", "date", "status"):
+        lookups["status_map"][meal_id, day] = status
+
+    for cp in DietPlanCompletedPortion.objects.filter(
+        patient=patient, date__in=dates
+    ).select_related("portion").order_by("id"):
+        lookups["portion_map"][cp.diet_plan_meal_id, cp.date].append(cp)
+
+    for extra in ExtraMeal.objects.filter(
+        patient=patient, date__in=dates, diet_plan_meal__isnull=False
+    ).order_by("id"):
+        lookups["extra_map"][extra.diet_plan_meal_id, extra.date].append(extra)
+
+    lookups["audio_variants"] = audio_variant_map(
+        [extra.audio_entry.name for extras in lookups["extra_map"].values() for extra in extras if extra.audio_entry]
+    )
+    return lookups
 
 class DietPlanSerializer(serializers.ModelSerializer):
     meals = serializers.SerializerMethodField()
@@ -176,6 +222,19 @@ class HealthStatusSerializer(serializers.ModelSerializer):
     class Meta:
         model = HealthStatus
         fields = '__all__'
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        adherence = self.context.get("adherence")
+        if adherence:
+            # Adherence comes from the daily rollup; the stored strings are placeholders.
+            for field in ("diet_followed", "exercise_followed"):
+                if adherence[field] is not None:
+                    data[field] = f"{adherence[field]}%"
+            for field in ("diet_streak", "exercise_streak"):
+                data[field] = f"{adherence[field]} Days"
+        return data
+
 class QuestionSerializer(serializers.ModelSerializer):
     options = OptionSerializer(many=True, read_only=True)
     sub_questions = serializers.SerializerMethodField()
@@ -209,13 +268,14 @@ class BulkPatientResponseSerializer(serializers.Serializer):
             raise serializers.ValidationError(f"Invalid question IDs: {list(invalid_questions)}")
 
         return data      
-class DietQuestionSerializer(serializers.ModelSerializer):
+class DietQuestionSerializer(CompressedAudioMixin, serializers.ModelSerializer):
     ask_diet_question = serializers.SerializerMethodField()
     date = serializers.SerializerMethodField()
     
     class Meta:
         model = PatientDietQuestion
         fields = '__all__'   
+        list_serializer_class = CompressedAudioListSerializer
         
     def get_ask_diet_question(self, obj):
         return obj.patient.ask_diet_question
@@ -232,13 +292,8 @@ class ExerciseStatusSerializer(serializers.ModelSerializer):
         fields = ["exercise", "status", "reason_audio"]
 
     def create(self, validated_data):
-        """Convert audio file to binary before saving"""
-        audio_file = validated_data.pop('reason_audio', None)
-
-        if audio_file:
-            validated_data['reason_audio'] = audio_file.read() 
-
-        return DietPlanStatus.objects.create(**validated_data)
+        """The uploaded file is handed to the storage backend, which streams it in chunks"""
+        return ExerciseStatus.objects.create(**validated_data)
 
     def get_reason_audio(self, obj):
         """Return the binary data as a base64 encoded string"""
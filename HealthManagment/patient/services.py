@@ -0,0 +1,279 @@
+import json
+from datetime import datetime
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from users.adherence import schedule_adherence_refresh
+from users.audio import queue_audio_transcode
+from users.dashboard import invalidate_patient_dashboards
+from users.storage import InvalidUpload, claim_uploaded_file
+from users.models import DietPlanMeal, DietPlanDate, DietPlanStatus, DietPlanCompletedPortion, ExtraMeal, PatientResponse
+
+
+class MealStatusError(Exception):
+    """Raised when a meal status update is rejected; carries the HTTP status to answer with."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def _parse_id_list(value):
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return []
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    return list(value)
+
+
+def parse_meal_update(data, files, patient=None):
+    """
+    Normalises one update coming from the single-meal form fields or from one item of
+    `entries`. File fields are taken from `files`; batch items name the multipart part
+    holding their file (e.g. "audio_reason": "audio_1"). A `<field>_key` from a presigned
+    upload can be sent instead of the file.
+    """
+    diet_plan_meal_id = data.get("diet_plan")
+    new_status = data.get("status")
+    date_str = data.get("date")
+
+    if not all([diet_plan_meal_id, new_status, date_str]):
+        raise MealStatusError("Required fields: diet_plan, status, date, selected_portions")
+
+    try:
+        target_date = datetime.strptime(date_str, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        raise MealStatusError("Invalid date format")
+
+    if (datetime.now().date() - target_date).days > 2:
+        raise MealStatusError("Editing diet status is allowed only within 48 hours.", 403)
+
+    if new_status not in dict(DietPlanStatus.STATUS_CHOICES):
+        raise MealStatusError(f"Invalid status '{new_status}'.")
+
+    def file_for(key, kind):
+        if data.get(f"{key}_key") and patient is not None:
+            try:
+                return claim_uploaded_file(patient, kind, data[f"{key}_key"])
+            except InvalidUpload as e:
+                raise MealStatusError(f"{key}: {e}")
+        value = data.get(key)
+        if isinstance(value, str):
+            return files.get(value)
+        return value or None
+
+    try:
+        meal_id = int(diet_plan_meal_id)
+    except (TypeError, ValueError):
+        raise MealStatusError(f"Meal ID {diet_plan_meal_id} not found.", 404)
+
+    selected_portions = []
+    for portion_id in _parse_id_list(data.get("selected_portions", [])):
+        try:
+            selected_portions.append(int(portion_id))
+        except (TypeError, ValueError):
+            raise MealStatusError(f"Portion ID {portion_id} not found.")
+
+    return {
+        "meal_id": meal_id,
+        "status": new_status,
+        "date": target_date,
+        "audio_reason": file_for("audio_reason", "diet_status_audio"),
+        "selected_portions": selected_portions,
+        "others": data.get("others", []),
+        "extra_audio": file_for("extra_audio", "extra_meal_audio"),
+        "others_image": file_for("others_image", "extra_meal_image"),
+    }
+
+
+def apply_meal_status_updates(patient, updates):
+    """
+    Applies a list of parsed updates for one patient in a single transaction.
+
+    Meals, assigned dates and the portions of each meal are validated with one query each;
+    statuses, completed portions and extra meals are written with bulk operations.
+    Returns the saved DietPlanStatus rows, one per meal and date.
+    """
+    if not updates:
+        raise MealStatusError("No meal updates given.")
+
+    # The last update for the same meal and date wins.
+    updates = list({(u["meal_id"], u["date"]): u for u in updates}.values())
+
+    meals = DietPlanMeal.objects.select_related("diet_plan").in_bulk({u["meal_id"] for u in updates})
+    for update in updates:
+        if update["meal_id"] not in meals:
+            raise MealStatusError(f"Meal ID {update['meal_id']} not found.", 404)
+        update["meal"] = meals[update["meal_id"]]
+
+    assigned = set(
+        DietPlanDate.objects.filter(
+            diet_plan_id__in={m.diet_plan_id for m in meals.values()},
+            date__in={u["date"] for u in updates},
+            diet_plan__patient=patient,
+        ).values_list("diet_plan_id", "date")
+    )
+    for update in updates:
+        if (update["meal"].diet_plan_id, update["date"]) not in assigned:
+            raise MealStatusError("Meal not assigned on this patient/date.", 403)
+
+    completed = [u for u in updates if u["status"] == "completed"]
+    portion_ids = {pid for u in completed for pid in u["selected_portions"]}
+    meal_portions = set(
+        DietPlanMeal.meal_portions.through.objects.filter(
+            dietplanmeal_id__in={u["meal_id"] for u in completed},
+            mealportion_id__in=portion_ids,
+        ).values_list("dietplanmeal_id", "mealportion_id")
+    )
+    for update in completed:
+        for portion_id in update["selected_portions"]:
+            if (update["meal_id"], portion_id) not in meal_portions:
+                raise MealStatusError(f"Portion ID {portion_id} is not part of meal {update['meal_id']}.")
+
+    now = timezone.now()
+    with transaction.atomic():
+        existing = {
+            (s.diet_plan_id, s.date): s
+            for s in DietPlanStatus.objects.select_for_update().filter(
+                patient=patient,
+                diet_plan_id__in={u["meal_id"] for u in updates},
+                date__in={u["date"] for u in updates},
+            )
+        }
+
+        entries, to_create, to_update = [], [], []
+        for update in updates:
+            audio = update["audio_reason"] if update["status"] == "skipped" else None
+            entry = existing.get((update["meal_id"], update["date"]))
+            if entry is None:
+                entry = DietPlanStatus(patient=patient, diet_plan_id=update["meal_id"], date=update["date"])
+            entry.status = update["status"]
+            entry.reason_audio = audio
+            entry.updated_by = patient
+            entry.updated_at = now
+            if audio and not isinstance(audio, str):
+                # File uploads go through save() so the storage backend writes them.
+                entry.save()
+            elif entry.pk:
+                to_update.append(entry)
+            else:
+                to_create.append(entry)
+            entries.append(entry)
+
+        DietPlanStatus.objects.bulk_create(to_create)
+        DietPlanStatus.objects.bulk_update(to_update, ["status", "reason_audio", "updated_by", "updated_at"])
+
+        extras = []
+        if completed:
+            same_meal_date = reduce(or_, (Q(diet_plan_meal_id=u["meal_id"], date=u["date"]) for u in completed))
+            DietPlanCompletedPortion.objects.filter(same_meal_date, patient=patient).delete()
+            ExtraMeal.objects.filter(same_meal_date, patient=patient).delete()
+
+            DietPlanCompletedPortion.objects.bulk_create([
+                DietPlanCompletedPortion(
+                    patient=patient,
+                    diet_plan_meal_id=update["meal_id"],
+                    portion_id=portion_id,
+                    date=update["date"],
+                    updated_by=patient,
+                )
+                for update in completed
+                for portion_id in dict.fromkeys(update["selected_portions"])
+            ])
+            extras = ExtraMeal.objects.bulk_create([
+                ExtraMeal(
+                    patient=patient,
+                    diet_plan_meal_id=update["meal_id"],
+                    date=update["date"],
+                    item_name=update["others"],
+                    audio_entry=update["extra_audio"],
+                    image=update["others_image"],
+                    updated_by=patient,
+                )
+                for update in completed
+                if update["others"] or update["extra_audio"]
+            ])
+
+        # Bulk writes skip the model signals, so refresh the dashboards and adherence
+        # rollup and queue the voice notes for transcoding explicitly.
+        invalidate_patient_dashboards(patient.id)
+        schedule_adherence_refresh(patient.id, [u["date"] for u in updates])
+        queue_audio_transcode(
+            [e.reason_audio.name for e in entries if e.reason_audio]
+            + [e.audio_entry.name for e in extras if e.audio_entry]
+        )
+
+    return entries
+
+
+def build_patient_responses(user, questions, data, required_main_ids=None):
+    """
+    Validates a bulk questionnaire submission against the already loaded questions and
+    returns (unsaved PatientResponse objects, errors) without touching the database.
+
+    Answers are resolved through in-memory option indexes keyed by (question id, value)
+    and by option id, built from the prefetched `options`.
+    """
+    by_value, by_id = {}, {}
+    for question in questions:
+        for option in question.options.all():
+            by_value.setdefault((question.id, option.value), option)
+            by_id[option.id] = option
+
+    errors, responses = [], []
+    for question in questions:
+        response_value = data.get(str(question.id))
+        if response_value is None:
+            errors.append({
+                "question_id": question.id,
+                "message": "Answer required but not provided"
+            })
+            continue
+
+        if not isinstance(response_value, list):
+            response_value = [response_value]
+        for val in response_value:
+            if isinstance(val, dict) and "option_id" in val:
+                try:
+                    selected_option = by_id.get(int(val["option_id"]))
+                except (TypeError, ValueError):
+                    selected_option = None
+                if selected_option and selected_option.question_id != question.id:
+                    selected_option = None
+                text_value = val.get("text")
+            else:
+                selected_option = by_value.get((question.id, str(val))) if not isinstance(val, dict) else None
+                text_value = None
+            # If option requires text but text is missing, register error
+            if selected_option and selected_option.type == "text" and not text_value:
+                errors.append({
+                    "question_id": question.id,
+                    "option_id": selected_option.id,
+                    "message": "Text required for this option"
+                })
+            responses.append(
+                PatientResponse(
+                    user=user,
+                    question=question,
+                    selected_option=selected_option,
+                    response_text=text_value if text_value else (None if selected_option else val)
+                )
+            )
+
+    # Validate that all main initial questions are answered
+    if required_main_ids is not None:
+        missing_ids = required_main_ids - {question.id for question in questions}
+        if missing_ids:
+            errors.append({
+                "message": "Please answer all main questions.",
+                "missing_questions": list(missing_ids)
+            })
+    return responses, errors
@@ -0,0 +1,323 @@
+from datetime import datetime, timedelta
+from collections import defaultdict
+
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import serializers
+
+from notification.models import Notification
+from users.adherence import schedule_adherence_refresh
+from users.dashboard import invalidate_patient_dashboards
+from users.identity import invalidate_identity
+from users.steps import schedule_step_refresh
+from users.models import (
+    CustomUser, DailyStepCount, DietPlan, DietPlanDate, DietPlanStatus, ExerciseDate, ExerciseLogEntry,
+    ExerciseStatus, PatientExerciseLog, SyncOperation, SyncTombstone,
+)
+from users.permissions import get_user_permissions
+from users.serializers import StepSyncSerializer
+from users.services import calculate_step_goal, classify_steps, get_trimester, has_diabetes
+from .serializers import ExerciseLogEntrySerializer
+from .services import MealStatusError, apply_meal_status_updates, parse_meal_update
+
+SYNC_TOKEN_SALT = "patient.sync"
+
+
+class InvalidSyncToken(Exception):
+    pass
+
+
+def issue_sync_token(moment):
+    return signing.dumps(moment.isoformat(), salt=SYNC_TOKEN_SALT)
+
+
+def read_sync_token(token):
+    """
+    Tokens older than the tombstones are refused, since deletions made in between
+    could no longer be reported; the app then syncs again without one.
+    """
+    try:
+        return datetime.fromisoformat(signing.loads(
+            token, salt=SYNC_TOKEN_SALT, max_age=timedelta(days=settings.PATIENT_SYNC_TOMBSTONE_DAYS)
+        ))
+    except signing.SignatureExpired:
+        raise InvalidSyncToken("Sync token has expired. Sync again without a token.")
+    except (signing.BadSignature, TypeError, ValueError):
+        raise InvalidSyncToken("Invalid sync token.")
+
+
+def _first_error(errors):
+    if isinstance(errors, dict):
+        key, value = next(iter(errors.items()))
+        return f"{key}: {_first_error(value)}"
+    if isinstance(errors, list) and errors:
+        return _first_error(next((e for e in errors if e), errors[0]))
+    return str(errors)
+
+
+######## Operation handlers ########
+# Each handler applies every operation of its type with bulk writes and returns {key: error}
+# for the operations it rejected.
+
+def _apply_diet_statuses(patient, ops):
+    errors, parsed = {}, []
+    for op in ops:
+        try:
+            parsed.append((op["key"], parse_meal_update(op["data"], {}, patient)))
+        except MealStatusError as e:
+            errors[op["key"]] = e.message
+    if not parsed:
+        return errors
+
+    try:
+        apply_meal_status_updates(patient, [update for _, update in parsed])
+    except MealStatusError:
+        # Isolate the offending operations so the rest of the batch still applies.
+        for key, update in parsed:
+            try:
+                apply_meal_status_updates(patient, [update])
+            except MealStatusError as e:
+                errors[key] = e.message
+    return errors
+
+
+def _apply_exercise_statuses(patient, ops):
+    errors, valid = {}, []
+    for op in ops:
+        data = op["data"]
+        if not data.get("exercise") or data.get("status") not in dict(ExerciseStatus.STATUS_CHOICES):
+            errors[op["key"]] = "Both 'exercise' and a valid 'status' are required"
+            continue
+        try:
+            valid.append((op["key"], int(data["exercise"]), data["status"]))
+        except (TypeError, ValueError):
+            errors[op["key"]] = f"Exercise ID {data['exercise']} not found."
+
+    assigned = dict(
+        ExerciseDate.objects.filter(patient=patient, id__in={ex_id for _, ex_id, _ in valid})
+        .values_list("id", "date")
+    )
+    rows = {}
+    for key, ex_id, new_status in valid:
+        if ex_id not in assigned:
+            errors[key] = "Exercise not assigned to this patient."
+            continue
+        rows[ex_id] = ExerciseStatus(
+            user=patient, exercise_id=ex_id, status=new_status, reason_audio=None, updated_by=patient
+        )
+
+    ExerciseStatus.objects.bulk_create(
+        rows.values(),
+        update_conflicts=True,
+        unique_fields=["user", "exercise"],
+        update_fields=["status", "reason_audio", "updated_by", "updated_at"],
+    )
+    schedule_adherence_refresh(patient.id, [assigned[ex_id] for ex_id in rows])
+    return errors
+
+
+def _apply_steps(patient, ops):
+    errors, rows = {}, {}
+    goal = None
+    for op in ops:
+        serializer = StepSyncSerializer(data=op["data"])
+        if not serializer.is_valid():
+            errors[op["key"]] = _first_error(serializer.errors)
+            continue
+        if goal is None:
+            profile = getattr(patient, "profile", None)
+            goal = calculate_step_goal(get_trimester(profile) if profile else None, has_diabetes(patient))
+        data = serializer.validated_data
+        rows[data["date"]] = DailyStepCount(
+            patient=patient,
+            date=data["date"],
+            steps=data["steps"],
+            goal_steps=goal,
+            source=data["source"],
+            status=classify_steps(data["steps"], goal),
+            updated_by=patient,
+        )
+
+    DailyStepCount.objects.bulk_create(
+        rows.values(),
+        update_conflicts=True,
+        unique_fields=["patient", "date"],
+        update_fields=["steps", "goal_steps", "source", "status", "updated_by", "updated_at"],
+    )
+    schedule_step_refresh(patient.id, rows.keys())
+    return errors
+
+
+def _apply_exercise_logs(patient, ops):
+    if not patient.initial_question_completed:
+        message = "Please complete your initial questions before adding exercise logs."
+        return {op["key"]: message for op in ops}
+
+    errors, valid = {}, []
+    for op in ops:
+        data = op["data"]
+        entries = ExerciseLogEntrySerializer(data=data.get("logs", []), many=True)
+        try:
+            log_date = serializers.DateField().run_validation(data.get("date"))
+        except serializers.ValidationError as e:
+            errors[op["key"]] = f"date: {_first_error(e.detail)}"
+            continue
+        if not entries.is_valid():
+            errors[op["key"]] = f"logs: {_first_error(entries.errors)}"
+            continue
+        valid.append((PatientExerciseLog(patient=patient, date=log_date, updated_by=patient), entries.validated_data))
+
+    if valid:
+        logs = PatientExerciseLog.objects.bulk_create([log for log, _ in valid])
+        ExerciseLogEntry.objects.bulk_create([
+            ExerciseLogEntry(exercise_log=log, **entry)
+            for log, (_, entries) in zip(logs, valid)
+            for entry in entries
+        ])
+        if CustomUser.objects.filter(pk=patient.pk, is_first_login=True).update(is_first_login=False):
+            invalidate_identity([patient.pk])
+    return errors
+
+
+OPERATION_HANDLERS = {
+    "diet_status": (_apply_diet_statuses, "add_dietplanstatus"),
+    "exercise_status": (_apply_exercise_statuses, "add_exercisestatus"),
+    "exercise_log": (_apply_exercise_logs, "add_patientexerciselog"),
+    "steps": (_apply_steps, None),
+}
+
+
+def apply_sync_operations(patient, operations):
+    """
+    Applies a batch of idempotency-keyed operations in one transaction.
+
+    Operations whose key was already processed return the stored outcome; the rest are
+    grouped by type and applied with bulk writes. Returns one result per operation, in order.
+    """
+    results, pending = [], {}
+    for op in operations:
+        key = op.get("key") if isinstance(op, dict) else None
+        if not isinstance(key, str) or not key or len(key) > 64:
+            results.append({"key": key, "status": "rejected", "error": "Each operation needs a 'key' of at most 64 characters."})
+            continue
+        result = {"key": key}
+        results.append(result)
+        if op.get("type") not in OPERATION_HANDLERS:
+            result.update(status="rejected", error=f"Unknown operation type '{op.get('type')}'.")
+        elif not isinstance(op.get("data"), dict):
+            result.update(status="rejected", error="'data' must be an object.")
+        pending.setdefault(key, (op, result))
+
+    processed = {
+        record.key: record
+        for record in SyncOperation.objects.filter(patient=patient, key__in=pending.keys())
+    }
+    codenames = get_user_permissions(patient)["codenames"]
+    by_type = defaultdict(list)
+    for key, (op, result) in pending.items():
+        if key in processed:
+            continue
+        if "status" not in result:
+            by_type[op["type"]].append({"key": key, "data": op["data"]})
+
+    with transaction.atomic():
+        errors = {}
+        for op_type, ops in by_type.items():
+            handler, codename = OPERATION_HANDLERS[op_type]
+            if codename and codename not in codenames:
+                errors.update({op["key"]: f"You do not have permission to {codename.replace('_', ' ', 1)}." for op in ops})
+                continue
+            errors.update(handler(patient, ops))
+
+        records = []
+        for key, (op, result) in pending.items():
+            if key in processed:
+                continue
+            if "status" not in result:
+                result["status"] = "rejected" if key in errors else "applied"
+                if key in errors:
+                    result["error"] = errors[key]
+            records.append(SyncOperation(
+                patient=patient,
+                key=key,
+                op_type=str(op.get("type"))[:30],
+                status=result["status"],
+                error=result.get("error"),
+            ))
+        SyncOperation.objects.bulk_create(records)
+
+        if any(r.get("status") == "applied" for r in results):
+            # Bulk writes skip the model signals, so refresh the dashboards explicitly.
+            invalidate_patient_dashboards(patient.id)
+
+    for result in results:
+        record = processed.get(result["key"])
+        if record is not None:
+            result.update(status=record.status, replayed=True)
+            if record.error:
+                result["error"] = record.error
+        elif "status" not in result:
+            # Same key sent twice in one batch: only the first one was applied.
+            first = pending[result["key"]][1]
+            result.update({k: v for k, v in first.items() if k != "key"}, replayed=True)
+    return results
+
+
+def build_sync_delta(patient, since=None):
+    """
+    Returns the server-side records of the patient changed after `since`, and under
+    "deleted" the ids of those removed since then (the dates of a deleted diet plan
+    are only listed through the plan). Without a token the delta covers the last
+    PATIENT_SYNC_INITIAL_DAYS days.
+    """
+    if since is None:
+        since = timezone.now() - timedelta(days=settings.PATIENT_SYNC_INITIAL_DAYS)
+
+    deleted = defaultdict(list)
+    for entity, object_id in (
+        SyncTombstone.objects.filter(patient=patient, deleted_at__gt=since)
+        .order_by("id").values_list("entity", "object_id")
+    ):
+        deleted[entity].append(object_id)
+
+    return {
+        "diet_plans": list(
+            DietPlan.objects.filter(patient=patient, updated_at__gt=since).values_list("id", flat=True)
+        ),
+        "diet_dates": list(
+            DietPlanDate.objects.filter(diet_plan__patient=patient, updated_at__gt=since)
+            .values("id", "diet_plan_id", "date")
+        ),
+        "diet_statuses": list(
+            DietPlanStatus.objects.filter(patient=patient, updated_at__gt=since)
+            .values("diet_plan_id", "date", "status")
+        ),
+        "exercise_dates": list(
+            ExerciseDate.objects.filter(patient=patient, updated_at__gt=since)
+            .values("id", "exercise_id", "exercise__title", "date")
+        ),
+        "exercise_statuses": list(
+            ExerciseStatus.objects.filter(user=patient, updated_at__gt=since)
+            .values("exercise_id", "status", "calories_burned")
+        ),
+        "steps": list(
+            DailyStepCount.objects.filter(patient=patient, updated_at__gt=since)
+            .values("date", "steps", "goal_steps", "status")
+        ),
+        "notifications": list(
+            Notification.objects.filter(user=patient, updated_at__gt=since)
+            .values("id", "title", "message", "notification_type", "is_read", "created_at")
+        ),
+        "deleted": {
+            entity: deleted[entity] for entity in ("diet_plans", "diet_dates", "exercise_dates", "notifications")
+        },
+    }
+
+
+def prune_sync_tombstones():
+    """Deletes tombstones older than any sync token still accepted. Returns the number deleted."""
+    cutoff = timezone.now() - timedelta(days=settings.PATIENT_SYNC_TOMBSTONE_DAYS)
+    deleted, _ = SyncTombstone.objects.filter(deleted_at__lt=cutoff).delete()
+    return deleted
@@ -0,0 +1,8 @@
+from celery import shared_task
+from .sync import prune_sync_tombstones as prune_expired_tombstones
+
+
+@shared_task
+def prune_sync_tombstones():
+    """Deletes the tombstones no sync token can ask for anymore (scheduled daily)."""
+    return prune_expired_tombstones()
@@ -3,7 +3,7 @@ from .views import (
     LabReportViewSet,
     ViewHealthStatusView,PatientResponseViewSet,InitialQuestionsView,DietQuestionsView,DietQuestionStatusView,
     CompleteSkipDietPlanView, DietPlanView,CompleteSkipExerciseView,PatientAssignedExercisesView,QuestionFlowStatusView,
-    CurrentOrNextMealView, ExerciseLogView, ExerciseLogStatusView
+    CurrentOrNextMealView, ExerciseLogView, ExerciseLogStatusView, PatientSyncView
     
 )
 from rest_framework.routers import DefaultRouter
@@ -28,4 +28,5 @@ urlpatterns = [
     path("exercise/status-update/", CompleteSkipExerciseView.as_view(), name="exercise-update-status"),
     path("exercise-logs/", ExerciseLogView.as_view(), name="exercise-logs"),
     path("exercise-log/status/", ExerciseLogStatusView.as_view(), name="exercise-log-status"),
+    path("sync/", PatientSyncView.as_view(), name="patient-sync"),
 ]
\ No newline at end of file
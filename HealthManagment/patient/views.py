@@ -3,9 +3,17 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from users.models import ExerciseDate, LabReport, Question,PatientResponse,CustomUser,PatientDietQuestion, PatientExerciseLog, Option, DietPlanStatus,Exercise,ExerciseStatus,HealthStatus,DietPlanDate,DietPlanMeal,DietPlan,ExtraMeal, DietPlanCompletedPortion,MealPortion
 from .serializers import ( PatientResponseSerializer,EmptyLabReportSerializer, HealthStatusSerializer, LabReportSerializer, 
-                          QuestionSerializer, DietQuestionSerializer, DietPlanSerializer, DietPlanStatusSerializer, CurrentMealSerializer, BulkPatientResponseSerializer,
+                          QuestionSerializer, DietQuestionSerializer, DietPlanSerializer, build_diet_plan_lookups, DietPlanStatusSerializer, CurrentMealSerializer, BulkPatientResponseSerializer,
                           ExerciseStatusSerializer, AssignedExerciseSerializer, ExerciseLogSerializer)
-from users.permissions import PermissionsManager,IsDoctorUser,IsPatientUser
+from users.permissions import PermissionsManager,IsDoctorUser,IsPatientUser,user_in_group
+from users.pagination import DateCursorPagination
+from users.storage import InvalidUpload, claim_uploaded_file
+from users.questionnaire import get_questionnaire, get_questionnaire_cadence, record_questionnaire_submission, with_absolute_images
+from users.adherence import adherence_summary
+from .services import MealStatusError, parse_meal_update, apply_meal_status_updates, build_patient_responses
+from .sync import InvalidSyncToken, apply_sync_operations, build_sync_delta, issue_sync_token, read_sync_token
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch
 from rest_framework import viewsets, permissions,generics,status
 from rest_framework import serializers
 
@@ -15,6 +23,8 @@ from rest_framework.filters import OrderingFilter
 from rest_framework.viewsets import ModelViewSet
 from django.utils import timezone
 from django.utils.dateparse import parse_date
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
 from datetime import timedelta,datetime
 from django.conf import settings
 from django.shortcuts import get_object_or_404
@@ -34,7 +44,7 @@ class LabReportViewSet(viewsets.ModelViewSet):
         user = self.request.user
         # Ensure user is authenticated
         if user.is_authenticated:
-            if user.groups.filter(name='doctor').exists():  # Check if the user has the 'doctor' role
+            if user_in_group(user, 'doctor'):  # Check if the user has the 'doctor' role
                 return LabReport.objects.all()
             return LabReport.objects.filter(patient=user)
         return LabReport.objects.none()  # If the user is not authenticated, return no reports
@@ -80,9 +90,11 @@ class ViewHealthStatusView(APIView):
 
     def get(self, request):
         health_status_qs = HealthStatus.objects.filter(patient=request.user)
-        serializer = HealthStatusSerializer(health_status_qs, many=True)
+        adherence = adherence_summary(request.user.id)
+        serializer = HealthStatusSerializer(health_status_qs, many=True, context={"adherence": adherence})
 
         data = {
+            'adherence': adherence,
             'health_reports': serializer.data,
             'lab_reports': LabReport.objects.filter(patient=request.user).count(),
         }
@@ -141,91 +153,51 @@ class PatientResponseViewSet(viewsets.ModelViewSet):
         serializer.is_valid(raise_exception=True)
 
         question_ids = serializer.validated_data["questions"]
-        questions = Question.objects.filter(id__in=question_ids).prefetch_related("options")
-        initial_questions = questions.filter(category="initial")
-        other_questions = questions.filter(category="other")
+        questions = list(
+            Question.objects.filter(id__in=question_ids).prefetch_related(
+                Prefetch("options", queryset=Option.objects.order_by("id"))
+            )
+        )
+        categories = {question.category for question in questions}
 
         # Check initial/other question rules
-        if not user.initial_question_completed and other_questions.exists():
+        if not user.initial_question_completed and "other" in categories:
             raise serializers.ValidationError(
                 "You must complete all initial questions before answering other questions."
             )
 
-        if user.initial_question_completed and initial_questions.exists():
+        if user.initial_question_completed and "initial" in categories:
             raise serializers.ValidationError(
                 "Initial questions already completed. You can now only answer other questions."
             )
 
-        saved_responses = []
-        errors = []
-        responses_to_create = []
-
-        for question in questions:
-            q_id = str(question.id)
-            response_value = data.get(q_id)
-            if q_id in [str(q) for q in question_ids] and response_value is None:
-                errors.append({
-                    "question_id": question.id,
-                    "message": "Answer required but not provided"
-                })
-                continue
-            if response_value is None:
-                continue
-
-            if not isinstance(response_value, list):
-                response_value = [response_value]
-            for val in response_value:
-                if isinstance(val, dict) and "option_id" in val:
-                    selected_option = Option.objects.filter(id=val["option_id"], question=question).first()
-                    text_value = val.get("text")
-                else:
-                    selected_option = Option.objects.filter(question=question, value=val).first()
-                    text_value = None
-                # If option requires text but text is missing, register error
-                if selected_option and selected_option.type == "text" and not text_value:
-                    errors.append({
-                        "question_id": question.id,
-                        "option_id": selected_option.id,
-                        "message": "Text required for this option"
-                    })
-                # Prepare valid responses for bulk create
-                responses_to_create.append(
-                    PatientResponse(
-                        user=user,
-                        question=question,
-                        selected_option=selected_option,
-                        response_text=text_value if text_value else (None if selected_option else val)
-                    )
-                )
-                saved_responses.append({
-                    "question_id": question.id,
-                    "option_id": selected_option.id if selected_option else None,
-                    "response_text": text_value if text_value else (None if selected_option else val)
-                })
-        # Validate that all main initial questions are answered
+        required_main_ids = None
         if not user.initial_question_completed:
-            total_initial = Question.objects.filter(category="initial", parent__isnull=True)
-            required_main_ids = [q.id for q in total_initial]
-            answered_main_ids = [int(q) for q in data.get("questions", []) if int(q) in required_main_ids]
-            missing_ids = set(required_main_ids) - set(answered_main_ids)
-            if missing_ids:
-                errors.append({
-                    "message": "Please answer all main questions.",
-                    "missing_questions": list(missing_ids)
-                })
+            required_main_ids = set(
+                Question.objects.filter(category="initial", parent__isnull=True).values_list("id", flat=True)
+            )
+
+        responses_to_create, errors = build_patient_responses(user, questions, data, required_main_ids)
+
         # **All-or-nothing save**
         if errors:
             return Response({
                 "message": "Errors found, no responses saved.",
                 "errors": errors
             }, status=status.HTTP_400_BAD_REQUEST)
-        # Save all valid responses
-        PatientResponse.objects.bulk_create(responses_to_create)
-        # Update user flags
-        user.initial_question_completed = True
-        # user.is_first_login = False
-        user.last_question_answered_at = timezone.now().date()
-        user.save()
+        with transaction.atomic():
+            # Save all valid responses
+            PatientResponse.objects.bulk_create(responses_to_create)
+            record_questionnaire_submission(
+                user,
+                completed_initial=not user.initial_question_completed,
+                answered_other="other" in categories,
+            )
+            # Update user flags
+            user.initial_question_completed = True
+            # user.is_first_login = False
+            user.last_question_answered_at = timezone.now().date()
+            user.save(update_fields=["initial_question_completed", "last_question_answered_at"])
         return Response({
             "message": "All responses saved successfully!",
             # "saved_responses": saved_responses
@@ -236,41 +208,37 @@ class InitialQuestionsView(generics.ListAPIView):
     permission_classes =[PermissionsManager]
     codename = 'question'
 
+    def questionnaire_response(self, request, category):
+        """
+        Serves the cached question tree of `category`. Clients send back the ETag in
+        If-None-Match and get a 304 until the questionnaire changes.
+        """
+        version, tree = get_questionnaire(category)
+        etag = quote_etag(f"questionnaire-{category}-{version}")
+        if_none_match = parse_etags(request.headers.get("If-None-Match", ""))
+        if etag in if_none_match or "*" in if_none_match:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(with_absolute_images(tree, request))
+        response["ETag"] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
     def list(self, request, *args, **kwargs):
-        user = request.user
-        user_status = CustomUser.objects.get(id=user.id)
-        interval_days = int(getattr(settings, "QUESTIONS_DAYS", 10))
-        interval = timedelta(days=interval_days)
+        user_status = request.user
         today = timezone.now().date()
 
         if user_status.is_first_login and not user_status.initial_question_completed:
-            queryset = Question.objects.filter(category="initial", parent__isnull=True)
-            serializer = self.get_serializer(queryset, many=True)
-            return Response(serializer.data)
+            return self.questionnaire_response(request, "initial")
 
         if user_status.initial_question_completed:
-            last_other_answer = (
-                PatientResponse.objects
-                .filter(user=user, question__category="other")
-                .order_by("-created_at")
-                .values_list("created_at", flat=True)
-                .first()
-            )
-
-            if not last_other_answer:
-                queryset = Question.objects.filter(category="other", parent__isnull=True)
-                serializer = self.get_serializer(queryset, many=True)
-                return Response(serializer.data)
-
-            last_answer_date = last_other_answer.date()
+            cadence = get_questionnaire_cadence(user_status)
 
-            if today >= last_answer_date + interval:
-                queryset = Question.objects.filter(category="other", parent__isnull=True)
-                serializer = self.get_serializer(queryset, many=True)
-                return Response(serializer.data)
+            if cadence.is_due(today):
+                return self.questionnaire_response(request, "other")
 
             return Response(
-                {"message": f"Next questions will be available on {last_answer_date + interval}."},
+                {"message": f"Next questions will be available on {cadence.next_due_date}."},
                 status=status.HTTP_200_OK
             )
         return Response([], status=status.HTTP_200_OK)
@@ -349,16 +317,24 @@ class DietQuestionsView(generics.ListCreateAPIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+        audio = {}
+        for field in ("breakfast_audio", "lunch_audio", "eveningSnack_audio", "dinner_audio"):
+            key = request.data.get(f"{field}_key")
+            if key:
+                try:
+                    audio[field] = claim_uploaded_file(user, "diet_question_audio", key)
+                except InvalidUpload as e:
+                    return Response({"message": f"{field}: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+            else:
+                audio[field] = request.FILES.get(field)
+
         diet = PatientDietQuestion.objects.create(
             patient=user,
             breakfast=request.data.get("breakfast"),
             lunch=request.data.get("lunch"),
             eveningSnack=request.data.get("eveningSnack"),
             dinner=request.data.get("dinner"),
-            breakfast_audio=request.FILES.get("breakfast_audio"),
-            lunch_audio=request.FILES.get("lunch_audio"),
-            eveningSnack_audio=request.FILES.get("eveningSnack_audio"),
-            dinner_audio=request.FILES.get("dinner_audio"),
+            **audio,
         )
 
         user.is_first_login = False
@@ -406,14 +382,42 @@ class DietPlanView(generics.ListAPIView):
     filter_backends = [DjangoFilterBackend]
     filterset_class = DietPlanMealFilter
     serch_field = ['date ']
+    pagination_class = DateCursorPagination
     codename = 'dietplanmeal'
 
+    def _date_window(self):
+        """
+        Returns the (from, to) bounds for the listing. Without `from`/`to` (and without
+        `date` or cursor paging) it defaults to DIET_PLAN_WINDOW_DAYS around today.
+        """
+        params = self.request.query_params
+        try:
+            start = parse_date(params.get("from") or "")
+            end = parse_date(params.get("to") or "")
+        except ValueError:
+            start = end = None
+        for key, value in (("from", start), ("to", end)):
+            if params.get(key) and value is None:
+                raise serializers.ValidationError({key: "Invalid date format. Use YYYY-MM-DD."})
+
+        if start is None and end is None and not params.get("date") and not self.paginator.is_requested(self.request):
+            half_window = settings.DIET_PLAN_WINDOW_DAYS // 2
+            today = timezone.now().date()
+            start, end = today - timedelta(days=half_window), today + timedelta(days=half_window)
+        return start, end
+
     def get_queryset(self):
-        return DietPlanDate.objects.filter(
+        qs = DietPlanDate.objects.filter(
             diet_plan__patient=self.request.user
-        ).select_related("diet_plan").prefetch_related(
+        )
+        start, end = self._date_window()
+        if start:
+            qs = qs.filter(date__gte=start)
+        if end:
+            qs = qs.filter(date__lte=end)
+        return qs.select_related("diet_plan").prefetch_related(
             "diet_plan__meals__meal_portions"
-        ).order_by("date")
+        ).order_by("date", "id")
     
     def get_serializer_context(self):
         context = super().get_serializer_context()
@@ -425,123 +429,61 @@ class DietPlanView(generics.ListAPIView):
             except ValueError:
                 pass
         return context
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        diet_dates = page if page is not None else list(queryset)
+        context = self.get_serializer_context()
+        context.update(build_diet_plan_lookups(request.user, [d.date for d in diet_dates]))
+        serializer = self.get_serializer(diet_dates, many=True, context=context)
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
     
 class CompleteSkipDietPlanView(APIView):
     serializer_class = DietPlanStatusSerializer
-    parser_classes = [MultiPartParser, FormParser]
+    parser_classes = [MultiPartParser, FormParser, JSONParser]
     permission_classes = [PermissionsManager]
     codename = 'dietplanstatus'
     
     def post(self, request):
-        """Patient updates ONE specific meal (breakfast/lunch/dinner/snack) for a given date"""
+        """
+        Patient updates one meal (breakfast/lunch/dinner/snack) for a given date, or several
+        meals/dates at once by sending `entries` (a JSON list of the same fields).
+        """
         patient = request.user
-        diet_plan_meal_id = request.data.get("diet_plan")
-        new_status = request.data.get("status")
-        date_str = request.data.get("date")
-        audio_file = request.FILES.get("audio_reason")
-        selected_portion_ids = request.data.get("selected_portions", [])
-        others = request.data.get("others", [])
-        others_audio = request.FILES.get("extra_audio")
-        others_image = request.FILES.get("others_image")
-
-        # Basic validation
-        if not all([diet_plan_meal_id, new_status, date_str]):
-            return Response(
-                {"error": "Required fields: diet_plan, status, date, selected_portions"},
-                status=400
-            )
+        entries = request.data.get("entries")
 
-        # Parse date
         try:
-            target_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-        except ValueError:
-            return Response({"error": "Invalid date format"}, status=400)
-        
-        now = datetime.now().date()
-        time_difference = (now - target_date).days
-        if time_difference > 2:
-            return Response({"error": "Editing diet status is allowed only within 48 hours."}, status=403)
-
-
-        # Fetch meal entry
-        meal = get_object_or_404(DietPlanMeal, id=diet_plan_meal_id)
-
-        # Check if patient owns this diet plan + date
-        if not DietPlanDate.objects.filter(
-            diet_plan=meal.diet_plan,
-            date=target_date,
-            diet_plan__patient=patient
-        ).exists():
-            return Response({"error": "Meal not assigned on this patient/date."}, status=403)
-
-        # Read audio reason only for skipped
-        audio_data = audio_file if new_status == "skipped" and audio_file else None
-
-        # --- UPDATE STATUS ENTRY ---
-        status_entry, _ = DietPlanStatus.objects.update_or_create(
-            patient=patient,
-            diet_plan=meal,
-            date=target_date,
-            defaults={"status": new_status, "reason_audio": audio_data}
-        )
-
-        # --- IF COMPLETED: HANDLE PORTIONS + EXTRAS ---
-        if new_status == "completed":
-            # Ensure JSON data is parsed
-            if isinstance(selected_portion_ids, str):
-                try:
-                    selected_portion_ids = json.loads(selected_portion_ids)
-                except:
-                    selected_portion_ids = []
-
-            # ✅ Clear previous portions for this meal+date
-            DietPlanCompletedPortion.objects.filter(
-                patient=patient, diet_plan_meal=meal, date=target_date
-            ).delete()
-
-            # ✅ Save selected portions
-            for portion_id in selected_portion_ids:
-                try:
-                    portion = MealPortion.objects.get(id=portion_id)
-                    DietPlanCompletedPortion.objects.create(
-                        patient=patient,
-                        diet_plan_meal=meal,
-                        portion=portion,
-                        date=target_date
-                    )
-                except MealPortion.DoesNotExist:
-                    return Response(
-                        {"error": f"Portion ID {portion_id} not found."},
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
-
-            # ✅ Clear previous extra meals (avoid duplicates)
-            ExtraMeal.objects.filter(
-                patient=patient, diet_plan_meal=meal, date=target_date
-            ).delete()
-
-            # ✅ Save new extras
-            if others or others_audio:
-                try:
-                    ExtraMeal.objects.create(
-                        patient=patient,
-                        diet_plan_meal=meal,
-                        date=target_date,
-                        item_name=others,
-                        audio_entry=others_audio if others_audio else None,
-                        image=others_image if others_image else None, 
-                    )
-                except Exception as e:
-                    return Response(
-                        {"error": f"Error saving extra meal: {str(e)}"},
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
-
-        serializer = DietPlanStatusSerializer(status_entry)
+            if entries is None:
+                updates = [parse_meal_update(request.data, request.FILES, patient)]
+            else:
+                if isinstance(entries, str):
+                    try:
+                        entries = json.loads(entries)
+                    except ValueError:
+                        return Response({"error": "entries must be a JSON list."}, status=400)
+                if not isinstance(entries, list):
+                    return Response({"error": "entries must be a JSON list."}, status=400)
+                updates = [parse_meal_update(entry, request.FILES, patient) for entry in entries]
+            status_entries = apply_meal_status_updates(patient, updates)
+        except MealStatusError as e:
+            return Response({"error": e.message}, status=e.status_code)
+
+        if entries is None:
+            update = updates[0]
+            return Response(
+                {
+                    "message": f"{update['meal'].meal_type.capitalize()} for {request.data.get('date')} updated successfully",
+                    "data": DietPlanStatusSerializer(status_entries[0]).data
+                },
+                status=200
+            )
         return Response(
             {
-                "message": f"{meal.meal_type.capitalize()} for {date_str} updated successfully",
-                "data": serializer.data
+                "message": f"{len(status_entries)} meal entries updated successfully",
+                "data": DietPlanStatusSerializer(status_entries, many=True).data
             },
             status=200
         )
@@ -647,6 +589,7 @@ class CompleteSkipExerciseView(APIView):
         id = request.data.get("exercise")
         new_status = request.data.get("status")  
         audio_file = request.FILES.get("audio_reason")  
+        audio_key = request.data.get("audio_reason_key")
 
         if not new_status or not id:
             return Response(
@@ -657,8 +600,14 @@ class CompleteSkipExerciseView(APIView):
         exercise = get_object_or_404(ExerciseDate, id=id)
 
         audio_data = None
-        if new_status == "skipped" and audio_file:
-            audio_data = audio_file.read()  
+        if new_status == "skipped" and audio_key:
+            try:
+                audio_data = claim_uploaded_file(request.user, "exercise_status_audio", audio_key)
+            except InvalidUpload as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        elif new_status == "skipped" and audio_file:
+            # Saved through the storage backend in chunks, never read into memory.
+            audio_data = audio_file
             
         status_entry, created = ExerciseStatus.objects.update_or_create(
             user_id=user_id,  
@@ -675,8 +624,6 @@ class QuestionFlowStatusView(APIView):
     def get(self, request):
         user = request.user
         today = timezone.now().date()
-        interval_days = int(getattr(settings, "QUESTIONS_DAYS", 10))
-        interval = timedelta(days=interval_days)
 
         if not user.initial_question_completed:
             return Response({
@@ -685,29 +632,22 @@ class QuestionFlowStatusView(APIView):
                 "message": "Initial questions are available."
             })
 
-        has_other = (
-            PatientResponse.objects
-            .filter(user=user, question__category="other")
-            .order_by("-created_at")
-            .values_list("created_at", flat=True)
-            .first()
-        )
+        cadence = get_questionnaire_cadence(user)
 
-        if not has_other:
+        if cadence.last_other_completed_at is None:
             return Response({
                 "status": "available",
                 "type": "other",
                 "message": "Other questions are available."
             })
-        last_other_answer_date = has_other.date()
-        if today >= last_other_answer_date + interval:
+        if cadence.is_due(today):
             return Response({
                 "status": "available",
                 "type": "other",
                 "message": "Next round of other questions is available."
             })
 
-        next_date = last_other_answer_date  + interval if last_other_answer_date  else None
+        next_date = cadence.next_due_date
         return Response({
             "status": "wait",
             "next_question_date": next_date,
@@ -825,4 +765,60 @@ class ExerciseLogStatusView(APIView):
         return Response({
             "message": "You can submit exercise logs anytime.",
             "can_submit": True
-        })
\ No newline at end of file
+        })
+
+
+class PatientSyncView(APIView):
+    """
+    Offline sync for the patient app. Applies a batch of idempotency-keyed log operations
+    and returns the server-side changes since the client's last sync token.
+
+    --- REQUEST EXAMPLE ---
+
+    {
+      "sync_token": "<token from the previous response, omit on first sync>",
+      "operations": [
+        {"key": "c1b0...", "type": "diet_status", "data": {"diet_plan": 12, "status": "completed", "date": "2026-06-05", "selected_portions": [3, 4]}},
+        {"key": "c1b1...", "type": "exercise_status", "data": {"exercise": 7, "status": "skipped"}},
+        {"key": "c1b2...", "type": "exercise_log", "data": {"date": "2026-06-05", "logs": [...]}},
+        {"key": "c1b3...", "type": "steps", "data": {"date": "2026-06-05", "steps": 4200, "source": "google_fit"}}
+      ]
+    }
+    """
+    permission_classes = [IsAuthenticated, IsPatientUser]
+    parser_classes = [JSONParser]
+
+    def post(self, request):
+        patient = request.user
+        operations = request.data.get("operations", [])
+        if not isinstance(operations, list):
+            return Response({"error": "operations must be a list."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(operations) > settings.PATIENT_SYNC_MAX_OPERATIONS:
+            return Response(
+                {"error": f"At most {settings.PATIENT_SYNC_MAX_OPERATIONS} operations per sync."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        since = None
+        token = request.data.get("sync_token")
+        if token:
+            try:
+                since = read_sync_token(token)
+            except InvalidSyncToken as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Taken before applying, so nothing written meanwhile can fall between two tokens.
+        synced_at = timezone.now()
+        try:
+            results = apply_sync_operations(patient, operations)
+        except IntegrityError:
+            return Response(
+                {"error": "Another sync with the same operations is in progress. Please retry."},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        return Response({
+            "results": results,
+            "changes": build_sync_delta(patient, since),
+            "sync_token": issue_sync_token(synced_at),
+        }, status=status.HTTP_200_OK)
@@ -0,0 +1,239 @@
+from datetime import date, timedelta
+from itertools import groupby
+from operator import attrgetter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+
+from .models import CustomUser, DailyAdherence, DietPlanMeal, DietPlanStatus, ExerciseDate
+
+COUNT_FIELDS = (
+    "meals_planned", "meals_completed", "meals_skipped",
+    "exercises_planned", "exercises_completed", "exercises_skipped",
+)
+
+
+def _next_streak(previous, planned, followed):
+    # Days with nothing planned neither extend nor break a streak.
+    if not planned:
+        return previous
+    return previous + 1 if followed else 0
+
+
+def _apply_streaks(row, previous):
+    row.diet_streak = _next_streak(previous.diet_streak if previous else 0, row.meals_planned, row.diet_followed)
+    row.exercise_streak = _next_streak(
+        previous.exercise_streak if previous else 0, row.exercises_planned, row.exercise_followed
+    )
+
+
+def _day_counts(day, patient_ids):
+    """{patient_id: {count field: value}} for one day, with one grouped query per source."""
+    counts = {patient_id: dict.fromkeys(COUNT_FIELDS, 0) for patient_id in patient_ids}
+
+    meals = (
+        DietPlanMeal.objects
+        .filter(diet_plan__patient_id__in=patient_ids, diet_plan__diet_dates__date=day)
+        .values("diet_plan__patient_id")
+        .annotate(planned=Count("id"))
+    )
+    for row in meals:
+        counts[row["diet_plan__patient_id"]]["meals_planned"] = row["planned"]
+
+    statuses = (
+        DietPlanStatus.objects
+        .filter(patient_id__in=patient_ids, date=day)
+        .values("patient_id")
+        .annotate(
+            completed=Count("id", filter=Q(status="completed")),
+            skipped=Count("id", filter=Q(status="skipped")),
+        )
+    )
+    for row in statuses:
+        counts[row["patient_id"]].update(meals_completed=row["completed"], meals_skipped=row["skipped"])
+
+    exercises = (
+        ExerciseDate.objects
+        .filter(patient_id__in=patient_ids, date=day)
+        .values("patient_id")
+        .annotate(
+            planned=Count("id", distinct=True),
+            completed=Count("status_entries", filter=Q(status_entries__status="completed")),
+            skipped=Count("status_entries", filter=Q(status_entries__status="skipped")),
+        )
+    )
+    for row in exercises:
+        counts[row["patient_id"]].update(
+            exercises_planned=row["planned"],
+            exercises_completed=row["completed"],
+            exercises_skipped=row["skipped"],
+        )
+    return counts
+
+
+def rollup_day(day, patient_ids):
+    """
+    Recomputes the rollup rows of `day` for the given patients, taking the streaks on
+    from their rows of the day before. Returns the saved rows.
+    """
+    patient_ids = list(patient_ids)
+    if not patient_ids:
+        return []
+    previous = {
+        row.patient_id: row
+        for row in DailyAdherence.objects.filter(patient_id__in=patient_ids, date=day - timedelta(days=1))
+    }
+    rows = []
+    for patient_id, counts in _day_counts(day, patient_ids).items():
+        row = DailyAdherence(patient_id=patient_id, date=day, **counts)
+        _apply_streaks(row, previous.get(patient_id))
+        rows.append(row)
+    DailyAdherence.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=["patient", "date"],
+        update_fields=[*COUNT_FIELDS, "diet_streak", "exercise_streak", "updated_at"],
+    )
+    return rows
+
+
+def _carried_rows(rows):
+    """Re-derives the streaks of one patient's rows (by date), stopping once they line up again."""
+    changed = []
+    for previous, row in zip(rows, rows[1:]):
+        if row.date - previous.date != timedelta(days=1):
+            previous = None
+        streaks = (row.diet_streak, row.exercise_streak)
+        _apply_streaks(row, previous)
+        if (row.diet_streak, row.exercise_streak) == streaks:
+            break
+        changed.append(row)
+    return changed
+
+
+def carry_streaks(patient_id, after):
+    """Re-derives the streaks of the patient's rows after `after`."""
+    rows = list(DailyAdherence.objects.filter(patient_id=patient_id, date__gte=after).order_by("date"))
+    DailyAdherence.objects.bulk_update(_carried_rows(rows), ["diet_streak", "exercise_streak", "updated_at"])
+
+
+def carry_all_streaks(after, chunk_size=1000):
+    """
+    carry_streaks for every patient with rows after `after`, reading all their rows
+    from `after` on in one pass ordered by patient and date.
+    """
+    later = DailyAdherence.objects.filter(date__gt=after).values("patient_id")
+    rows = (
+        DailyAdherence.objects
+        .filter(patient_id__in=later, date__gte=after)
+        .order_by("patient_id", "date")
+        .iterator(chunk_size=chunk_size)
+    )
+    changed = []
+    for _, patient_rows in groupby(rows, key=attrgetter("patient_id")):
+        changed.extend(_carried_rows(list(patient_rows)))
+        if len(changed) >= chunk_size:
+            DailyAdherence.objects.bulk_update(changed, ["diet_streak", "exercise_streak", "updated_at"])
+            changed = []
+    DailyAdherence.objects.bulk_update(changed, ["diet_streak", "exercise_streak", "updated_at"])
+
+
+def refresh_patient_adherence(patient_id, dates):
+    """Recomputes the patient's rollup for the given days (future days are skipped)."""
+    today = date.today()
+    dates = sorted({d for d in dates if d and d <= today})
+    if dates and not CustomUser.objects.filter(pk=patient_id).exists():
+        # Scheduled by records deleted together with the patient.
+        return
+    for day in dates:
+        rollup_day(day, [patient_id])
+    if dates:
+        # From the first day on: days between the refreshed ones were not rolled up and
+        # the later days took their streaks from them.
+        carry_streaks(patient_id, dates[0])
+
+
+def schedule_adherence_refresh(patient_id, dates):
+    """Refreshes the rollup once the surrounding transaction commits."""
+    dates = set(dates)
+    if patient_id and dates:
+        transaction.on_commit(lambda: refresh_patient_adherence(patient_id, dates))
+
+
+def close_day(day=None, chunk_size=1000):
+    """
+    Writes the rollup of `day` (yesterday by default) for every patient with something
+    planned that day or a running streak, so untouched days still count, then carries the
+    streaks into rows already written for later days.
+    """
+    day = day or date.today() - timedelta(days=1)
+    patient_ids = set(
+        DietPlanMeal.objects.filter(diet_plan__diet_dates__date=day).values_list("diet_plan__patient_id", flat=True)
+    )
+    patient_ids.update(ExerciseDate.objects.filter(date=day).values_list("patient_id", flat=True))
+    patient_ids.update(
+        DailyAdherence.objects
+        .filter(Q(diet_streak__gt=0) | Q(exercise_streak__gt=0), date=day - timedelta(days=1))
+        .values_list("patient_id", flat=True)
+    )
+    patient_ids = sorted(patient_ids)
+    for start in range(0, len(patient_ids), chunk_size):
+        rollup_day(day, patient_ids[start:start + chunk_size])
+
+    carry_all_streaks(day, chunk_size)
+    return len(patient_ids)
+
+
+def rebuild_adherence(days):
+    """Rebuilds the rollup of the last `days` days, oldest first (backfill / repair)."""
+    today = date.today()
+    closed = 0
+    for offset in range(days - 1, -1, -1):
+        closed += close_day(today - timedelta(days=offset))
+    return closed
+
+
+def _percent(done, planned):
+    return round(done * 100 / planned) if planned else None
+
+
+def _followed_percent(rows):
+    totals = rows.aggregate(*(Sum(field) for field in COUNT_FIELDS))
+    return {
+        "diet_followed": _percent(totals["meals_completed__sum"] or 0, totals["meals_planned__sum"] or 0),
+        "exercise_followed": _percent(totals["exercises_completed__sum"] or 0, totals["exercises_planned__sum"] or 0),
+    }
+
+
+def adherence_summary(patient_id, today=None, days=None):
+    """
+    Diet and exercise adherence of the last `days` days (ADHERENCE_WINDOW_DAYS by default)
+    in percent, and the current streaks. Today only extends a streak once it is followed.
+    """
+    today = today or date.today()
+    days = days or settings.ADHERENCE_WINDOW_DAYS
+    rows = DailyAdherence.objects.filter(patient_id=patient_id, date__gt=today - timedelta(days=days), date__lte=today)
+    recent = {row.date: row for row in rows.filter(date__gte=today - timedelta(days=1))}
+    current, yesterday = recent.get(today), recent.get(today - timedelta(days=1))
+
+    def streak(field, followed):
+        if current is not None and getattr(current, followed):
+            return getattr(current, field)
+        return getattr(yesterday, field) if yesterday else 0
+
+    return {
+        "window_days": days,
+        **_followed_percent(rows),
+        "diet_streak": streak("diet_streak", "diet_followed"),
+        "exercise_streak": streak("exercise_streak", "exercise_followed"),
+    }
+
+
+def cohort_adherence(patients, today=None, days=7):
+    """Combined diet and exercise adherence in percent of a set of patients over the last `days` days."""
+    today = today or date.today()
+    rows = DailyAdherence.objects.filter(
+        patient__in=patients, date__gt=today - timedelta(days=days), date__lte=today
+    )
+    return {"days": days, **_followed_percent(rows)}
@@ -0,0 +1,239 @@
+import hashlib
+import logging
+import os
+import re
+import subprocess
+import tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from rest_framework import serializers
+
+from .models import AudioVariant, DietPlanStatus, ExerciseStatus, ExtraMeal, PatientDietQuestion
+
+logger = logging.getLogger(__name__)
+
+# Voice note fields whose uploads are transcoded.
+AUDIO_FIELDS = {
+    DietPlanStatus: ("reason_audio",),
+    ExerciseStatus: ("reason_audio",),
+    ExtraMeal: ("audio_entry",),
+    PatientDietQuestion: ("breakfast_audio", "lunch_audio", "eveningSnack_audio", "dinner_audio"),
+}
+
+DURATION_RE = re.compile(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)")
+
+
+class AudioTranscodeError(Exception):
+    pass
+
+
+def audio_names(instance):
+    """Storage names of the voice notes currently set on `instance`."""
+    names = []
+    for field in AUDIO_FIELDS.get(type(instance), ()):
+        value = getattr(instance, field)
+        if value and value.name:
+            names.append(value.name)
+    return names
+
+
+def queue_audio_transcode(names):
+    """Creates pending AudioVariant rows for new voice notes (existing names are left alone)."""
+    names = {name for name in names if name}
+    if names:
+        AudioVariant.objects.bulk_create(
+            [AudioVariant(source_name=name) for name in names],
+            ignore_conflicts=True,
+        )
+
+
+######## Transcoding ########
+
+def _claim_batch(batch_size):
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            AudioVariant.objects
+            .select_for_update(skip_locked=True)
+            .filter(status="pending")
+            .order_by("id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        AudioVariant.objects.filter(id__in=ids).update(
+            status="processing", claimed_at=now, attempts=F("attempts") + 1
+        )
+    return list(AudioVariant.objects.filter(id__in=ids).order_by("id"))
+
+
+def _release_stuck_variants():
+    """
+    Returns variants whose worker died mid-transcode to the queue, or fails them
+    once they have used up AUDIO_TRANSCODE_MAX_ATTEMPTS.
+    """
+    stuck = AudioVariant.objects.filter(
+        status="processing",
+        claimed_at__lt=timezone.now() - timedelta(seconds=settings.AUDIO_TRANSCODE_TIMEOUT * 2),
+    )
+    stuck.filter(attempts__gte=settings.AUDIO_TRANSCODE_MAX_ATTEMPTS).update(
+        status="failed", error="Claim timed out"
+    )
+    stuck.update(status="pending")
+
+
+def _parse_duration(ffmpeg_output):
+    match = DURATION_RE.search(ffmpeg_output or "")
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return round(int(hours) * 3600 + int(minutes) * 60 + float(seconds), 2)
+
+
+def transcode_variant(variant):
+    """
+    Streams the original out of storage, transcodes it to mono Opus at
+    AUDIO_TRANSCODE_BITRATE_KBPS with ffmpeg and stores the compressed copy.
+    If the result is not smaller than the original only the metadata is kept.
+    """
+    bitrate = settings.AUDIO_TRANSCODE_BITRATE_KBPS
+    with tempfile.TemporaryDirectory() as tmp:
+        source_path = os.path.join(tmp, "source" + os.path.splitext(variant.source_name)[1][:10])
+        output_path = os.path.join(tmp, "voice.ogg")
+
+        with default_storage.open(variant.source_name, "rb") as source, open(source_path, "wb") as target:
+            for chunk in source.chunks():
+                target.write(chunk)
+
+        command = [
+            settings.FFMPEG_BINARY, "-nostdin", "-hide_banner", "-y",
+            "-i", source_path,
+            "-vn", "-ac", "1", "-ar", "16000",
+            "-c:a", "libopus", "-b:a", f"{bitrate}k", "-application", "voip",
+            output_path,
+        ]
+        try:
+            result = subprocess.run(
+                command, capture_output=True, text=True, timeout=settings.AUDIO_TRANSCODE_TIMEOUT
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            raise AudioTranscodeError(str(e))
+        if result.returncode != 0 or not os.path.exists(output_path):
+            raise AudioTranscodeError(result.stderr[-1000:])
+
+        variant.source_size = os.path.getsize(source_path)
+        variant.compressed_size = os.path.getsize(output_path)
+        variant.duration_seconds = _parse_duration(result.stderr)
+        variant.codec = "opus"
+        variant.bitrate_kbps = bitrate
+
+        if variant.compressed_size < variant.source_size:
+            digest = hashlib.sha1(variant.source_name.encode()).hexdigest()
+            with open(output_path, "rb") as compressed:
+                variant.compressed.save(f"{digest}.ogg", File(compressed), save=False)
+        else:
+            variant.compressed_size = None
+
+    variant.status = "done"
+    variant.error = None
+    variant.save()
+
+
+def transcode_pending_audio(batch_size=None):
+    """Transcodes one batch of pending voice notes. Returns counters for logging."""
+    batch_size = batch_size or settings.AUDIO_TRANSCODE_BATCH_SIZE
+    _release_stuck_variants()
+    stats = {"processed": 0, "done": 0, "failed": 0}
+    for variant in _claim_batch(batch_size):
+        stats["processed"] += 1
+        # The claim is renewed per variant, so a long batch is not mistaken for a dead worker.
+        AudioVariant.objects.filter(pk=variant.pk).update(claimed_at=timezone.now())
+        try:
+            transcode_variant(variant)
+            stats["done"] += 1
+        except Exception as e:
+            logger.warning("Transcoding %s failed: %s", variant.source_name, e)
+            retry = variant.attempts < settings.AUDIO_TRANSCODE_MAX_ATTEMPTS
+            AudioVariant.objects.filter(pk=variant.pk).update(
+                status="pending" if retry else "failed",
+                error=str(e)[:2000],
+            )
+            stats["failed"] += 1
+    return stats
+
+
+######## Serving ########
+
+def audio_variant_map(names):
+    names = [name for name in names if name]
+    if not names:
+        return {}
+    return {
+        v.source_name: v
+        for v in AudioVariant.objects.filter(source_name__in=names, status="done")
+    }
+
+
+def audio_url(file, request=None, variants=None):
+    """URL of the compressed variant of `file` when there is one, otherwise of the original."""
+    if not file:
+        return None
+    if variants is None:
+        variants = audio_variant_map([file.name])
+    variant = variants.get(file.name)
+    url = variant.compressed.url if variant and variant.compressed else file.url
+    return request.build_absolute_uri(url) if request else url
+
+
+def audio_details(file, variants):
+    variant = variants.get(file.name) if file else None
+    if variant is None:
+        return None
+    return {
+        "codec": variant.codec if variant.compressed else None,
+        "duration_seconds": variant.duration_seconds,
+        "size": variant.compressed_size or variant.source_size,
+    }
+
+
+class CompressedAudioListSerializer(serializers.ListSerializer):
+    """Loads the audio variants of the whole list in one query."""
+
+    def to_representation(self, data):
+        items = list(data.all() if hasattr(data, "all") else data)
+        self.child._audio_variants = audio_variant_map(
+            [name for item in items for name in audio_names(item)]
+        )
+        return super().to_representation(items)
+
+
+class CompressedAudioMixin:
+    """
+    Serves the compressed variant for the model's voice note fields and adds an
+    `audio_details` entry with duration and size. Set
+    `list_serializer_class = CompressedAudioListSerializer` in Meta so lists
+    load the variants in one query.
+    """
+
+    def get_audio_variants(self, instance):
+        variants = getattr(self, "_audio_variants", None)
+        if variants is None:
+            return audio_variant_map(audio_names(instance))
+        return variants
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        variants = self.get_audio_variants(instance)
+        request = self.context.get("request")
+        details = {}
+        for field in AUDIO_FIELDS.get(type(instance), ()):
+            file = getattr(instance, field)
+            if field in data:
+                data[field] = audio_url(file, request, variants)
+            details[field] = audio_details(file, variants)
+        data["audio_details"] = details
+        return data
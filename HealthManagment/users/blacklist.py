@@ -0,0 +1,155 @@
+import hashlib
+import math
+import threading
+from datetime import timedelta
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import RefreshToken
+
+# Changed on every blacklisting so each process knows when to load new entries.
+BLACKLIST_GENERATION_KEY = "token-blacklist:generation"
+
+
+class BloomFilter:
+    """Fixed-size bloom filter over strings (double hashing on one blake2b digest)."""
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = max(1, capacity)
+        self.size = max(64, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big") | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RevocationFilter:
+    """
+    Per-process bloom filter of the jti of blacklisted, unexpired refresh tokens.
+    Whenever the shared generation changes, the rows blacklisted since the newest one
+    seen are added, re-reading TOKEN_BLACKLIST_FILTER_OVERLAP seconds back for rows that
+    committed late; the filter is rebuilt from scratch once it holds more than its
+    capacity. Without a shared cache other workers' blacklistings would never reach it,
+    so is_blacklisted then always asks the database.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bloom = None
+        self._loaded_until = None
+        self._recent = {}
+        self._generation = None
+
+    def _load(self):
+        overlap = timedelta(seconds=settings.TOKEN_BLACKLIST_FILTER_OVERLAP)
+        rows = BlacklistedToken.objects.order_by("blacklisted_at", "id")
+        if self._loaded_until is not None:
+            rows = rows.filter(blacklisted_at__gte=self._loaded_until - overlap)
+        now = timezone.now()
+        for row_id, jti, expires_at, blacklisted_at in rows.values_list(
+            "id", "token__jti", "token__expires_at", "blacklisted_at"
+        ).iterator(chunk_size=2000):
+            if row_id in self._recent:
+                continue
+            if expires_at > now:
+                self._bloom.add(jti)
+            self._recent[row_id] = blacklisted_at
+            if self._loaded_until is None or blacklisted_at > self._loaded_until:
+                self._loaded_until = blacklisted_at
+        # Only rows inside the overlap window can be read again.
+        if self._loaded_until is not None:
+            cutoff = self._loaded_until - overlap
+            self._recent = {row_id: at for row_id, at in self._recent.items() if at >= cutoff}
+
+    def sync(self):
+        generation = cache.get(BLACKLIST_GENERATION_KEY)
+        if self._bloom is not None and generation is not None and generation == self._generation:
+            return
+        with self._lock:
+            if generation is None:
+                cache.add(BLACKLIST_GENERATION_KEY, uuid4().hex, timeout=None)
+                generation = cache.get(BLACKLIST_GENERATION_KEY)
+            if self._bloom is None or self._bloom.count > self._bloom.capacity:
+                self._bloom = BloomFilter(
+                    settings.TOKEN_BLACKLIST_FILTER_CAPACITY, settings.TOKEN_BLACKLIST_FILTER_ERROR_RATE
+                )
+                self._loaded_until = None
+                self._recent = {}
+            self._load()
+            self._generation = generation
+
+    def might_contain(self, jti):
+        self.sync()
+        return jti in self._bloom
+
+    def reset(self):
+        with self._lock:
+            self._bloom = None
+
+
+revocation_filter = RevocationFilter()
+
+
+def is_blacklisted(jti):
+    """Only jti values the filter may contain are looked up in the blacklist table."""
+    if settings.SHARED_CACHE and not revocation_filter.might_contain(jti):
+        return False
+    return BlacklistedToken.objects.filter(token__jti=jti).exists()
+
+
+def notify_blacklisted():
+    transaction.on_commit(lambda: cache.set(BLACKLIST_GENERATION_KEY, uuid4().hex, timeout=None))
+
+
+class FilteredRefreshToken(RefreshToken):
+    """RefreshToken whose blacklist check goes through the revocation filter."""
+
+    def check_blacklist(self):
+        if is_blacklisted(self.payload[api_settings.JTI_CLAIM]):
+            raise TokenError("Token is blacklisted")
+
+    def blacklist(self):
+        result = super().blacklist()
+        notify_blacklisted()
+        return result
+
+
+def prune_expired_tokens(batch_size=None, max_batches=None):
+    """
+    Deletes expired outstanding tokens (and their blacklist rows) in batches of
+    `batch_size` ids, at most `max_batches` batches per run. Returns the number deleted.
+    """
+    batch_size = batch_size or settings.TOKEN_PRUNE_BATCH_SIZE
+    max_batches = max_batches or settings.TOKEN_PRUNE_MAX_BATCHES
+    now = timezone.now()
+    pruned = 0
+    for _ in range(max_batches):
+        ids = list(
+            OutstandingToken.objects.filter(expires_at__lte=now)
+            .order_by("id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        BlacklistedToken.objects.filter(token_id__in=ids).delete()
+        OutstandingToken.objects.filter(id__in=ids).delete()
+        pruned += len(ids)
+    return pruned
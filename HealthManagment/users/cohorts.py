@@ -0,0 +1,86 @@
+from datetime import date
+
+from django.db.models import Exists, OuterRef, Subquery
+
+from .models import DietPlan, HealthStatus, PatientCohort, Profile
+from .querysets import due_bucket_expression, trimester_expression
+
+
+def _latest_health_status(patient_ref):
+    return Subquery(
+        HealthStatus.objects.filter(patient=patient_ref)
+        .order_by("-created_at", "-id")
+        .values("health_status")[:1]
+    )
+
+
+def refresh_cohort_buckets(queryset=None, today=None):
+    """Recomputes trimester and due-date buckets of the given cohort rows in one UPDATE."""
+    today = today or date.today()
+    queryset = PatientCohort.objects.all() if queryset is None else queryset
+    return queryset.update(
+        trimester=trimester_expression(today=today),
+        due_bucket=due_bucket_expression(today=today),
+        buckets_on=today,
+    )
+
+
+def doctor_cohort(doctor, today=None):
+    """The doctor's cohort rows, with any rows whose buckets are not from today refreshed first."""
+    today = today or date.today()
+    cohort = PatientCohort.objects.filter(doctor=doctor)
+    refresh_cohort_buckets(cohort.exclude(buckets_on=today), today)
+    return cohort
+
+
+def sync_patient_cohorts(patient_id):
+    """
+    Makes the patient's cohort rows match their diet plans: one row per doctor with a
+    plan for the patient, carrying the current LMP, latest health status and buckets.
+    """
+    doctor_ids = set(DietPlan.objects.filter(patient_id=patient_id).values_list("doctor_id", flat=True))
+    PatientCohort.objects.filter(patient_id=patient_id).exclude(doctor_id__in=doctor_ids).delete()
+    if not doctor_ids:
+        return
+
+    lmp_date = Profile.objects.filter(user_id=patient_id).values_list("lmp_date", flat=True).first()
+    health_status = (
+        HealthStatus.objects.filter(patient_id=patient_id)
+        .order_by("-created_at", "-id")
+        .values_list("health_status", flat=True)
+        .first()
+    )
+    PatientCohort.objects.bulk_create(
+        [
+            PatientCohort(doctor_id=doctor_id, patient_id=patient_id, lmp_date=lmp_date, health_status=health_status)
+            for doctor_id in doctor_ids
+        ],
+        update_conflicts=True,
+        unique_fields=["doctor", "patient"],
+        update_fields=["lmp_date", "health_status", "updated_at"],
+    )
+    refresh_cohort_buckets(PatientCohort.objects.filter(patient_id=patient_id))
+
+
+def update_cohort_health_status(patient_id):
+    PatientCohort.objects.filter(patient_id=patient_id).update(
+        health_status=_latest_health_status(OuterRef("patient_id"))
+    )
+
+
+def rebuild_patient_cohorts():
+    """Rebuilds the whole table from the diet plans (backfill / repair)."""
+    pairs = DietPlan.objects.values_list("doctor_id", "patient_id").distinct()
+    PatientCohort.objects.bulk_create(
+        [PatientCohort(doctor_id=doctor_id, patient_id=patient_id) for doctor_id, patient_id in pairs],
+        ignore_conflicts=True,
+        batch_size=1000,
+    )
+    PatientCohort.objects.exclude(
+        Exists(DietPlan.objects.filter(doctor_id=OuterRef("doctor_id"), patient_id=OuterRef("patient_id")))
+    ).delete()
+    PatientCohort.objects.update(
+        lmp_date=Subquery(Profile.objects.filter(user_id=OuterRef("patient_id")).values("lmp_date")[:1]),
+        health_status=_latest_health_status(OuterRef("patient_id")),
+    )
+    return refresh_cohort_buckets()
@@ -0,0 +1,407 @@
+import json
+from datetime import date, timedelta
+
+from django.conf import settings
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Avg, Count, F, Q
+from django.db.models.functions import Coalesce, Now
+from django.utils import timezone
+
+from .models import (
+    CustomUser, DailyStepCount, DashboardSnapshot, DietPlan, DietPlanDate, DietPlanStatus,
+    Exercise, ExerciseDate, ExerciseStatus, HealthStatus, Profile,
+)
+from .querysets import HIGH_RISK_STATUSES
+from .cohorts import doctor_cohort
+from .adherence import adherence_summary, cohort_adherence
+
+
+def build_doctor_dashboard(user):
+    today = timezone.now().date()
+
+    patients = CustomUser.objects.filter(
+        role="patient",
+        patient_cohorts__doctor=user
+    )
+
+    cohort = doctor_cohort(user, today).aggregate(
+        total=Count("id"),
+        high_risk=Count("id", filter=Q(health_status__in=HIGH_RISK_STATUSES)),
+        due_soon=Count("id", filter=Q(due_bucket__in=["due_soon", "overdue"])),
+        **{f"t{n}": Count("id", filter=Q(trimester=n)) for n in (1, 2, 3)},
+    )
+    total_mothers = cohort["total"]
+    high_risk = cohort["high_risk"]
+    due_soon = cohort["due_soon"]
+    trimester = {f"t{n}": cohort[f"t{n}"] for n in (1, 2, 3)}
+
+    diet_qs = DietPlanStatus.objects.filter(
+        patient__in=patients,
+        date=today,
+        status="skipped"
+    )
+
+    diet_missed_patients = diet_qs.values("patient").distinct().count()
+    diet_missed_total = diet_qs.count()
+
+    exercise_qs = ExerciseStatus.objects.filter(
+        user__in=patients,
+        status="skipped",
+        updated_at__date=today
+    )
+
+    exercise_missed_patients = exercise_qs.values("user").distinct().count()
+    exercise_missed_total = exercise_qs.count()
+
+    total_diet_plans = DietPlan.objects.filter(doctor=user).count()
+
+    diet_completed_today = DietPlanStatus.objects.filter(
+        patient__in=patients,
+        date=today,
+        status="completed"
+    ).count()
+
+    adherence = cohort_adherence(patients, today)
+
+    alerts = []
+
+    critical_cases = HealthStatus.objects.filter(
+        patient__in=patients,
+        health_status="Critical"
+    ).select_related("patient")
+
+    for c in critical_cases[:10]:
+        alerts.append({
+            "name": c.patient.get_full_name(),
+            "message": "Critical health condition",
+            "type": "critical"
+        })
+
+    profiles = Profile.objects.filter(user__in=patients).select_related("user")
+    health_map = {
+        h.patient_id: h
+        for h in HealthStatus.objects.filter(patient__in=patients)
+    }
+
+    recent_mothers = []
+
+    for p in profiles[:10]:
+        user_obj = p.user
+        health = health_map.get(user_obj.id)
+
+        recent_mothers.append({
+            "id": user_obj.id,
+            "name": f"{p.first_name or ''} {p.last_name or ''}".strip(),
+            "phone_number": str(user_obj.phone_number) if user_obj.phone_number else "",
+            "gestational_age": p.gestational_age or "NA",
+            "bp": getattr(health, "blood_pressure", "NA"),
+            "sugar": getattr(health, "blood_sugar", "NA"),
+            "edd": p.edd or "NA",
+            "bmi": p.bmi or "NA",
+            "health_status": getattr(health, "health_status", "Stable")
+        })
+
+    return {
+        "active_mothers": total_mothers,
+        "high_risk_cases": high_risk,
+        "due_in_30_days": due_soon,
+        "total_diet_plans": total_diet_plans,
+
+        "trimester_overview": trimester,
+
+        "diet_missed_today": diet_missed_patients,
+        "diet_missed_total": diet_missed_total,
+        "diet_completed_today": diet_completed_today,
+
+        "exercise_missed_today": exercise_missed_patients,
+        "exercise_missed_total": exercise_missed_total,
+
+        "adherence_last_7_days": adherence,
+
+        "alerts": alerts,
+
+        "recent_mothers": recent_mothers,
+    }
+
+
+def build_patient_dashboard(user):
+    today = timezone.now().date()
+
+    total_diets = DietPlan.objects.filter(patient=user).count()
+    total_exercises = ExerciseDate.objects.filter(patient=user).count()
+
+    latest_health_status = HealthStatus.objects.filter(
+        patient=user
+    ).order_by("-created_at").first()
+
+    avg_calories_burned = (
+        ExerciseStatus.objects
+        .filter(user=user, status="completed")
+        .aggregate(avg=Avg("calories_burned"))
+        .get("avg") or 0
+    )
+
+    completed_exercises = ExerciseStatus.objects.filter(user=user).count()
+
+    goal_achievement_rate = (
+        round((completed_exercises / total_exercises) * 100, 2)
+        if total_exercises else 0
+    )
+
+    profile = getattr(user, "profile", None)
+    pregnancy_details = {}
+    if profile:
+        pregnancy_details = {
+            "gestational_age": profile.gestational_age,
+            "edd": profile.edd,
+            "pregnancy_month": profile.pregnancy_month,
+            "bmi": profile.bmi,
+            "bmi_category": profile.bmi_category,
+        }
+
+    today_diet_status = DietPlanStatus.objects.filter(
+        patient=user,
+        date=today
+    ).values("status").annotate(count=Count("id"))
+
+    today_meals = {item["status"]: item["count"] for item in today_diet_status}
+
+    today_exercise_status = ExerciseStatus.objects.filter(
+        user=user,
+        updated_at__date=today
+    ).values("status").annotate(count=Count("id"))
+
+    today_exercises = {item["status"]: item["count"] for item in today_exercise_status}
+
+    today_steps = DailyStepCount.objects.filter(
+        patient=user,
+        date=today
+    ).first()
+
+    upcoming_diet_plans = DietPlanDate.objects.filter(
+        diet_plan__patient=user,
+        date__gte=today
+    ).order_by("date")[:5]
+
+    return {
+        "total_diets": total_diets,
+        "total_exercises": total_exercises,
+        "latest_health_status": latest_health_status.health_status if latest_health_status else "No status",
+        "average_calories_burned_per_week": avg_calories_burned,
+        "goal_achievement_rate": goal_achievement_rate,
+        "pregnancy_details": pregnancy_details,
+        "today_meals": today_meals,
+        "today_exercises": today_exercises,
+        "today_steps": {
+            "steps": today_steps.steps,
+            "goal": today_steps.goal_steps,
+            "status": today_steps.status,
+        } if today_steps else {"steps": 0, "goal": 0, "status": "low"},
+        "upcoming_diet_dates": [d.date for d in upcoming_diet_plans],
+        "adherence": adherence_summary(user.id, today),
+    }
+
+
+def build_admin_dashboard(user=None):
+    today = timezone.now().date()
+    this_month_start = today.replace(day=1)
+
+    total_patients = CustomUser.objects.filter(role="patient").count()
+    total_doctors = CustomUser.objects.filter(role="doctor").count()
+    total_diet_plans = DietPlan.objects.count()
+    total_exercises = Exercise.objects.count()
+    total_admins = CustomUser.objects.filter(role="admin").count()
+
+    new_patients_this_month = CustomUser.objects.filter(
+        role="patient",
+        date_joined__gte=this_month_start
+    ).count()
+    new_doctors_this_month = CustomUser.objects.filter(
+        role="doctor",
+        date_joined__gte=this_month_start
+    ).count()
+
+    diet_missed_today = DietPlanStatus.objects.filter(
+        date=today,
+        status="skipped"
+    ).count()
+    diet_completed_today = DietPlanStatus.objects.filter(
+        date=today,
+        status="completed"
+    ).count()
+
+    exercise_missed_today = ExerciseStatus.objects.filter(
+        status="skipped",
+        updated_at__date=today
+    ).count()
+    exercise_completed_today = ExerciseStatus.objects.filter(
+        status="completed",
+        updated_at__date=today
+    ).count()
+
+    critical_cases = HealthStatus.objects.filter(
+        health_status="Critical"
+    ).count()
+
+    diet_completion_rate = 0
+    total_diet_statuses_today = DietPlanStatus.objects.filter(date=today).count()
+    if total_diet_statuses_today > 0:
+        diet_completion_rate = round(
+            (diet_completed_today / total_diet_statuses_today) * 100, 2
+        )
+
+    doctor_patient_counts = (
+        CustomUser.objects.filter(role="doctor")
+        .annotate(patient_count=Count("created_diets__patient", distinct=True))
+        .values("id", "username")
+        .annotate(
+            first_name=F("profile__first_name"),
+            last_name=F("profile__last_name")
+        )
+        .order_by("-patient_count")[:10]
+    )
+
+    recent_patients = (
+        CustomUser.objects.filter(role="patient")
+        .select_related("profile")
+        .order_by("-date_joined")[:5]
+        .values(
+            "id", "date_joined",
+            "profile__first_name", "profile__last_name"
+        )
+    )
+
+    return {
+        "total_patients": total_patients,
+        "total_doctors": total_doctors,
+        "total_diet_plans": total_diet_plans,
+        "total_exercises": total_exercises,
+        "total_admins": total_admins,
+        "new_patients_this_month": new_patients_this_month,
+        "new_doctors_this_month": new_doctors_this_month,
+        "diet_missed_today": diet_missed_today,
+        "diet_completed_today": diet_completed_today,
+        "exercise_missed_today": exercise_missed_today,
+        "exercise_completed_today": exercise_completed_today,
+        "critical_cases": critical_cases,
+        "diet_completion_rate": diet_completion_rate,
+        "top_doctors": list(doctor_patient_counts),
+        "recent_patients": list(recent_patients),
+    }
+
+
+SNAPSHOT_BUILDERS = {
+    "doctor": build_doctor_dashboard,
+    "patient": build_patient_dashboard,
+    "admin": build_admin_dashboard,
+}
+
+
+def _snapshot_scope(role):
+    if role in ["admin", "superadmin"]:
+        return "admin"
+    return role
+
+
+def _store_snapshot(snapshot, data, today):
+    """
+    Saves a rebuilt payload. The row only turns fresh if nothing invalidated it while
+    it was built; otherwise it keeps the newer payload but stays stale for the next run.
+    """
+    now = timezone.now()
+    fields = {"data": data, "snapshot_date": today, "updated_at": now}
+    fresh = DashboardSnapshot.objects.filter(pk=snapshot.pk, version=snapshot.version)
+    if not fresh.update(is_stale=False, stale_since=None, **fields):
+        DashboardSnapshot.objects.filter(pk=snapshot.pk, is_stale=True).update(stale_since=now, **fields)
+
+
+def get_dashboard_snapshot(user):
+    """
+    Returns the dashboard payload for the user's role from its summary row.
+    A patient's row is rebuilt on read once their own writes made it stale. Admin and
+    doctor rows go stale with nearly every patient write and are rebuilt by the
+    rebuild_dashboards task, so a stale one is served as is; the request only rebuilds
+    it when it is missing, from a previous day, or the task has not caught up within
+    DASHBOARD_STALE_SECONDS.
+    """
+    scope = _snapshot_scope(user.role)
+    owner_id = None if scope == "admin" else user.id
+    now = timezone.now()
+    today = now.date()
+
+    snapshot = (
+        DashboardSnapshot.objects
+        .filter(scope=scope, owner_id=owner_id)
+        .order_by("id")
+        .first()
+    )
+    if snapshot and snapshot.snapshot_date == today and (
+        not snapshot.is_stale
+        or scope != "patient" and snapshot.stale_since is not None
+        and snapshot.stale_since > now - timedelta(seconds=settings.DASHBOARD_STALE_SECONDS)
+    ):
+        return snapshot.data
+
+    data = SNAPSHOT_BUILDERS[scope](user)
+
+    if snapshot is None:
+        DashboardSnapshot.objects.get_or_create(
+            scope=scope,
+            owner_id=owner_id,
+            defaults={"snapshot_date": today, "data": data},
+        )
+    else:
+        _store_snapshot(snapshot, data, today)
+    # Serve the same JSON-compatible payload whether it was just built or read back.
+    return json.loads(json.dumps(data, cls=DjangoJSONEncoder))
+
+
+def rebuild_stale_dashboards(batch_size=100):
+    """
+    Rebuilds today's stale admin and doctor snapshots, oldest first, so their readers
+    do not have to. Rows invalidated again while being built are left for the next run.
+    Returns the number of rows rebuilt.
+    """
+    today = timezone.now().date()
+    stale = list(
+        DashboardSnapshot.objects
+        .filter(is_stale=True, snapshot_date=today, scope__in=("admin", "doctor"))
+        .select_related("owner")
+        .order_by("stale_since", "id")[:batch_size]
+    )
+    for snapshot in stale:
+        _store_snapshot(snapshot, SNAPSHOT_BUILDERS[snapshot.scope](snapshot.owner), today)
+    return len(stale)
+
+
+def _mark_stale(condition):
+    DashboardSnapshot.objects.filter(condition).update(
+        is_stale=True,
+        stale_since=Coalesce("stale_since", Now()),
+        version=F("version") + 1,
+    )
+
+
+def invalidate_patient_dashboards(patient_id):
+    """
+    Marks the patient's own snapshot, the snapshots of every doctor with a
+    diet plan for the patient and the admin snapshot as stale.
+    """
+    doctor_ids = DietPlan.objects.filter(patient_id=patient_id).values("doctor_id")
+    transaction.on_commit(lambda: _mark_stale(
+        Q(scope="patient", owner_id=patient_id)
+        | Q(scope="doctor", owner_id__in=doctor_ids)
+        | Q(scope="admin")
+    ))
+
+
+def invalidate_doctor_dashboards(doctor_id):
+    transaction.on_commit(lambda: _mark_stale(
+        Q(scope="doctor", owner_id=doctor_id) | Q(scope="admin")
+    ))
+
+
+def invalidate_admin_dashboard():
+    transaction.on_commit(lambda: _mark_stale(Q(scope="admin")))
@@ -1,6 +1,7 @@
 from django_filters import rest_framework as filters
 from .models import CustomUser, DietPlan, LabReport,Exercise,RoleChoices,PatientDietQuestion,DietPlanDate,ExerciseDate
 import django_filters
+from .querysets import age_q, bmi_category_q, gestational_weeks_q, trimester_q
 
 class DietPlanMealFilter(filters.FilterSet):
     date = filters.DateFilter(field_name="date", lookup_expr="exact")
@@ -40,13 +41,36 @@ class CustomUserFilter(filters.FilterSet):
     email = filters.CharFilter(field_name="email", lookup_expr='icontains')
     first_name = filters.CharFilter(field_name="profile__first_name", lookup_expr='icontains')
     last_name = filters.CharFilter(field_name="profile__last_name", lookup_expr='icontains')
-    age = filters.NumberFilter(field_name="profile__age", lookup_expr="exact")
-    age__gte = filters.NumberFilter(field_name="profile__age", lookup_expr="gte")
-    age__lte = filters.NumberFilter(field_name="profile__age", lookup_expr="lte")
+    age = filters.NumberFilter(method="filter_age")
+    age__gte = filters.NumberFilter(method="filter_age")
+    age__lte = filters.NumberFilter(method="filter_age")
+    trimester = filters.ChoiceFilter(choices=[(1, "1"), (2, "2"), (3, "3")], method="filter_trimester")
+    gestational_weeks__gte = filters.NumberFilter(method="filter_gestational_weeks")
+    gestational_weeks__lte = filters.NumberFilter(method="filter_gestational_weeks")
+    bmi_category = filters.ChoiceFilter(
+        choices=[(name, name) for name in ("Underweight", "Normal weight", "Overweight", "Obese")],
+        method="filter_bmi_category",
+    )
 
     class Meta:
         model = CustomUser
-        fields = ['role', 'email', 'first_name', 'last_name', 'age', 'age__gte', 'age__lte']
+        fields = ['role', 'email', 'first_name', 'last_name', 'age', 'age__gte', 'age__lte', 'trimester',
+                  'gestational_weeks__gte', 'gestational_weeks__lte', 'bmi_category']
+
+    # These translate into date_of_birth / lmp_date / bmi_value ranges so they use the profile indexes.
+    def filter_age(self, queryset, name, value):
+        bounds = {"age": (value, value), "age__gte": (value, None), "age__lte": (None, value)}[name]
+        return queryset.filter(age_q("profile__", *bounds))
+
+    def filter_trimester(self, queryset, name, value):
+        return queryset.filter(trimester_q(value, "profile__"))
+
+    def filter_gestational_weeks(self, queryset, name, value):
+        bounds = (value, None) if name.endswith("gte") else (None, value)
+        return queryset.filter(gestational_weeks_q("profile__", *bounds))
+
+    def filter_bmi_category(self, queryset, name, value):
+        return queryset.filter(bmi_category_q(value, "profile__"))
 
 class DietPlanMealFilter(filters.FilterSet):
     date = filters.DateFilter(field_name="date", lookup_expr="exact")
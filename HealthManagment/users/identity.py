@@ -0,0 +1,127 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from .blacklist import FilteredRefreshToken
+from .models import CustomUser
+
+IDENTITY_VERSION_KEY = "identity:version:{}"
+IDENTITY_USER_KEY = "identity:user:{}"
+
+# User fields carried as token claims. Changing any of them bumps the user's
+# token_version, so claims of an older version are never trusted. Onboarding flags
+# (is_first_login, initial_question_completed) flip during normal use and are left
+# out; they are read through the identity cache when a request needs them.
+TOKEN_CLAIM_FIELDS = ("role", "is_active", "is_staff", "is_superuser")
+TOKEN_VERSION_CLAIM = "tv"
+TOKEN_GROUPS_CLAIM = "groups"
+
+
+def set_identity_claims(token, user):
+    """Writes the current identity claims of `user` into `token`."""
+    from .permissions import get_user_permissions
+
+    token[TOKEN_VERSION_CLAIM] = user.token_version
+    token[TOKEN_GROUPS_CLAIM] = sorted(get_user_permissions(user)["groups"])
+    for field in TOKEN_CLAIM_FIELDS:
+        token[field] = getattr(user, field)
+    return token
+
+
+def identity_token_for(user):
+    """Refresh token (and, through it, access token) carrying the identity claims of `user`."""
+    return set_identity_claims(FilteredRefreshToken.for_user(user), user)
+
+
+######## Shared cache ########
+
+def _identity_fields():
+    return [f.attname for f in CustomUser._meta.concrete_fields if f.attname != "password"]
+
+
+def current_token_version(user_id):
+    """
+    The user's token_version (None if the user does not exist), from the shared cache
+    when there is one. A per-process cache would keep accepting tokens another worker
+    outdated, so without SHARED_CACHE it is read from the database.
+    """
+    if not settings.SHARED_CACHE:
+        return CustomUser.objects.filter(pk=user_id).values_list("token_version", flat=True).first()
+    key = IDENTITY_VERSION_KEY.format(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = CustomUser.objects.filter(pk=user_id).values_list("token_version", flat=True).first()
+        if version is not None:
+            cache.set(key, version, timeout=None)
+    return version
+
+
+def cached_identity(user_id):
+    """
+    The user's field values (everything but the password), cached for
+    IDENTITY_CACHE_TIMEOUT when the cache is shared, read from the database otherwise.
+    """
+    if not settings.SHARED_CACHE:
+        return CustomUser.objects.filter(pk=user_id).values(*_identity_fields()).first()
+    key = IDENTITY_USER_KEY.format(user_id)
+    fields = cache.get(key)
+    if fields is None:
+        fields = CustomUser.objects.filter(pk=user_id).values(*_identity_fields()).first()
+        if fields is not None:
+            cache.set(key, fields, timeout=settings.IDENTITY_CACHE_TIMEOUT)
+    return fields
+
+
+def invalidate_identity(user_ids):
+    keys = [IDENTITY_USER_KEY.format(user_id) for user_id in user_ids]
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def bump_token_version(user_ids):
+    """Makes the identity claims of every token issued to these users outdated."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    CustomUser.objects.filter(pk__in=user_ids).update(token_version=F("token_version") + 1)
+    keys = [key.format(user_id) for user_id in user_ids for key in (IDENTITY_VERSION_KEY, IDENTITY_USER_KEY)]
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+######## Users ########
+
+def _deferred_user(values):
+    # from_db expects the values in the order of the model's concrete fields.
+    names = [f.attname for f in CustomUser._meta.concrete_fields if f.attname in values]
+    user = CustomUser.from_db(None, names, [values[name] for name in names])
+    user._identity_from_token = True
+    return user
+
+
+def user_from_claims(user_id, token):
+    """
+    A CustomUser built from the token claims without touching the database. The other
+    fields are deferred and filled from the identity cache on first access.
+    """
+    user = _deferred_user({"id": user_id, **{field: token[field] for field in TOKEN_CLAIM_FIELDS}})
+    user.token_groups = frozenset(token[TOKEN_GROUPS_CLAIM])
+    return user
+
+
+def user_from_identity(user_id):
+    """A CustomUser built from the identity cache (password deferred), or None."""
+    fields = cached_identity(user_id)
+    return _deferred_user(fields) if fields is not None else None
+
+
+def load_deferred_identity(user, fields):
+    """
+    Fills the deferred fields of a token-backed user from the identity cache.
+    Returns the requested fields that still have to be read from the database.
+    """
+    cached = cached_identity(user.pk) or {}
+    deferred = user.get_deferred_fields()
+    for attname, value in cached.items():
+        if attname in deferred:
+            user.__dict__[attname] = value
+    return [field for field in fields if field not in cached]
@@ -3,7 +3,11 @@ from django.utils import timezone
 from rest_framework import exceptions, serializers
 from rest_framework.authentication import CSRFCheck
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
 from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+
+from .blacklist import FilteredRefreshToken
 
 
 def set_jwt_access_cookie(response, access_token):
@@ -69,6 +73,7 @@ def unset_jwt_cookies(response):
 class CookieTokenRefreshSerializer(TokenRefreshSerializer):
     refresh = serializers.CharField(
         required=False, help_text='WIll override cookie.')
+    token_class = FilteredRefreshToken
 
     def extract_refresh_token(self):
         request = self.context['request']
@@ -82,8 +87,29 @@ class CookieTokenRefreshSerializer(TokenRefreshSerializer):
             raise InvalidToken('No valid refresh token found.')
 
     def validate(self, attrs):
-        attrs['refresh'] = self.extract_refresh_token()
-        return super().validate(attrs)
+        # Same as TokenRefreshSerializer.validate, but the blacklist check goes through the
+        # revocation filter and the new tokens carry the user's current identity claims
+        # rather than the ones copied from the refresh token.
+        from .identity import set_identity_claims
+        from .models import CustomUser
+
+        refresh = self.token_class(self.extract_refresh_token())
+        user_id = refresh.payload.get(api_settings.USER_ID_CLAIM, None)
+        user = CustomUser.objects.filter(pk=user_id).first() if user_id else None
+        if user is None or not user.is_active:
+            raise AuthenticationFailed(self.error_messages['no_active_account'], 'no_active_account')
+
+        access = set_identity_claims(refresh.access_token, user)
+        data = {'access': str(access)}
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                refresh.blacklist()
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            refresh.outstand()
+            data['refresh'] = str(set_identity_claims(refresh, user))
+        return data
 
 
 def get_refresh_view():
@@ -105,7 +131,37 @@ def get_refresh_view():
     return RefreshViewWithCookieSupport
 
 
-class JWTCookieAuthentication(JWTAuthentication):
+class StatelessJWTAuthentication(JWTAuthentication):
+    """
+    Authenticates from the identity claims of the token without loading the user.
+    The claims are trusted while their token version matches the user's current one
+    (kept in the shared cache); otherwise the user comes from the identity cache.
+    """
+
+    def get_user(self, validated_token):
+        from .identity import TOKEN_VERSION_CLAIM, current_token_version, user_from_claims, user_from_identity
+
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+
+        version = current_token_version(user_id)
+        if version is None:
+            raise AuthenticationFailed("User not found", code="user_not_found")
+        if validated_token.get(TOKEN_VERSION_CLAIM) == version:
+            user = user_from_claims(user_id, validated_token)
+        else:
+            user = user_from_identity(user_id)
+            if user is None:
+                raise AuthenticationFailed("User not found", code="user_not_found")
+
+        if not user.is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        return user
+
+
+class JWTCookieAuthentication(StatelessJWTAuthentication):
     """
     An authentication plugin that hopefully authenticates requests through a JSON web
     token provided in a request cookie (and through the header as normal, with a
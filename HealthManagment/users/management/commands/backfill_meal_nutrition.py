@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from users.nutrition import backfill_missing_nutrition
+
+
+class Command(BaseCommand):
+    help = "Enrich every meal portion missing nutrients from the nutrition cache and OpenFoodFacts"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None, help="Lookups resolved per batch")
+        parser.add_argument("--concurrency", type=int, default=None, help="OpenFoodFacts calls in flight")
+
+    def handle(self, *args, **options):
+        totals = backfill_missing_nutrition(batch_size=options["batch_size"], concurrency=options["concurrency"])
+        self.stdout.write(
+            f"{totals['queued']} portions waited for a lookup; resolved {totals['lookups']} lookups "
+            f"({totals['found']} found, {totals['not_found']} not found, {totals['failed']} failed, "
+            f"{totals['retry']} left for retry) and enriched {totals['portions']} portions."
+        )
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from users.questionnaire import backfill_questionnaire_cadences
+
+
+class Command(BaseCommand):
+    help = "Create questionnaire cadence rows for patients who answered before cadence was tracked"
+
+    def handle(self, *args, **options):
+        created = backfill_questionnaire_cadences()
+        self.stdout.write(f"Created {created} questionnaire cadence rows.")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from users.blacklist import prune_expired_tokens
+
+
+class Command(BaseCommand):
+    help = "Delete expired outstanding and blacklisted refresh tokens in bounded batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None)
+        parser.add_argument("--max-batches", type=int, default=None)
+
+    def handle(self, *args, **options):
+        pruned = prune_expired_tokens(options["batch_size"], options["max_batches"])
+        self.stdout.write(f"Pruned {pruned} expired tokens.")
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from users.adherence import rebuild_adherence
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily adherence rollup and streaks from the diet and exercise statuses"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=280, help="Number of past days to rebuild, ending today")
+
+    def handle(self, *args, **options):
+        rows = rebuild_adherence(options["days"])
+        self.stdout.write(f"Rebuilt {rows} daily adherence rows.")
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from users.cohorts import rebuild_patient_cohorts
+
+
+class Command(BaseCommand):
+    help = "Rebuild the doctor-patient cohort table from the diet plans"
+
+    def handle(self, *args, **options):
+        rows = rebuild_patient_cohorts()
+        self.stdout.write(f"Rebuilt {rows} patient cohort rows.")
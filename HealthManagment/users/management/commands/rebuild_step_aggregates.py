@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from users.steps import rebuild_step_aggregates
+
+
+class Command(BaseCommand):
+    help = "Rebuild the weekly, monthly and trimester step aggregates from the daily step counts"
+
+    def handle(self, *args, **options):
+        patients = rebuild_step_aggregates()
+        self.stdout.write(f"Rebuilt step aggregates of {patients} patients.")
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from users.outbound_stubs import StubServer
+
+
+class Command(BaseCommand):
+    help = "Serve local stubs of the MSG91 and OpenFoodFacts APIs (set MSG91_BASE_URL / OPENFOODFACTS_BASE_URL to the printed URL)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--port", type=int, default=8901)
+        parser.add_argument("--latency", type=float, default=0, help="Seconds added to every answer")
+        parser.add_argument("--failure-rate", type=float, default=0, help="Share of requests answered with 503")
+
+    def handle(self, *args, **options):
+        stub = StubServer(port=options["port"], latency=options["latency"], failure_rate=options["failure_rate"])
+        self.stdout.write(f"Outbound stubs listening on {stub.base_url}")
+        try:
+            stub.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stub.httpd.server_close()
@@ -0,0 +1,39 @@
+import time
+from django.core.management.base import BaseCommand
+from users.audio import AUDIO_FIELDS, queue_audio_transcode, transcode_pending_audio
+
+
+class Command(BaseCommand):
+    help = "Transcode uploaded voice notes to compact Opus variants"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--backfill", action="store_true", help="Queue voice notes uploaded before transcoding existed")
+        parser.add_argument("--batch-size", type=int, default=None, help="Voice notes transcoded per batch")
+        parser.add_argument("--loop", action="store_true", help="Keep polling for new voice notes instead of exiting")
+        parser.add_argument("--interval", type=float, default=10, help="Seconds to sleep when nothing is pending")
+
+    def handle(self, *args, **options):
+        if options["backfill"]:
+            for model, fields in AUDIO_FIELDS.items():
+                for field in fields:
+                    names = (
+                        model.objects.exclude(**{f"{field}__isnull": True}).exclude(**{field: ""})
+                        .values_list(field, flat=True).iterator(chunk_size=2000)
+                    )
+                    batch = []
+                    for name in names:
+                        batch.append(name)
+                        if len(batch) >= 2000:
+                            queue_audio_transcode(batch)
+                            batch = []
+                    queue_audio_transcode(batch)
+            self.stdout.write("Queued existing voice notes.")
+
+        while True:
+            stats = transcode_pending_audio(batch_size=options["batch_size"])
+            if stats["processed"]:
+                self.stdout.write(f"Transcoded {stats['done']} voice notes ({stats['failed']} failed)")
+                continue
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
@@ -1,15 +1,21 @@
 import threading
 from django.utils.deprecation import MiddlewareMixin
 
-_user = threading.local()
+_request = threading.local()
 
 class AuditMiddleware(MiddlewareMixin):
+    """
+    Remembers the current request so audited saves can find the acting user. The user is
+    only resolved when a save asks for it, by which time DRF has authenticated the request.
+    """
     def process_request(self, request):
-        _user.value = request.user if request.user.is_authenticated else None
+        _request.value = request
 
     def process_response(self, request, response):
-        _user.value = None
+        _request.value = None
         return response
 
 def get_current_user():
-    return getattr(_user, "value", None)
+    request = getattr(_request, "value", None)
+    user = getattr(request, "user", None)
+    return user if user is not None and user.is_authenticated else None
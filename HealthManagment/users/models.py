@@ -1,13 +1,12 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings    
-import datetime
 import logging
 from phonenumber_field.modelfields import PhoneNumberField
 from django.utils import timezone
-from django.utils.crypto import get_random_string
-from users.utils import send_otp
 from django.core.exceptions import ValidationError
+from users.querysets import ProfileQuerySet, bmi_value_expression
+from django.core.serializers.json import DjangoJSONEncoder
 from .middleware import get_current_user
 from datetime import timedelta, date
 from django.utils.timezone import now
@@ -53,15 +52,21 @@ class RoleChoices(models.TextChoices):
     DOCTOR = "doctor", "Doctor"
     PATIENT = "patient", "Patient"
 
+
+# Written with update() only; see CustomUser.save.
+UPDATE_ONLY_FIELDS = ("token_version", "security_code", "sent", "otp_attempts")
+
+
 class CustomUser(AbstractUser, AuditModel):
     """
     Custom User Model with phone authentication & role-based access.
     """
     phone_number = PhoneNumberField(unique=True, blank=False, null=False)
     role = models.CharField(max_length=10, choices=RoleChoices.choices, default=RoleChoices.PATIENT)
-    security_code = models.CharField(max_length=6, blank=True, null=True)  # Store OTP
+    security_code = models.CharField(max_length=128, blank=True, null=True)  # Hash of the pending OTP
     is_verified = models.BooleanField(default=False)
     sent = models.DateTimeField(null=True)  # OTP sent time
+    otp_attempts = models.PositiveSmallIntegerField(default=0)  # Wrong guesses of the pending OTP
     is_first_login = models.BooleanField(default=True)
     initial_question_completed = models.BooleanField(default=False)  
     last_question_answered_at = models.DateField(null=True, blank=True)
@@ -70,6 +75,7 @@ class CustomUser(AbstractUser, AuditModel):
     verified = models.BooleanField(default=False)
     welcome_seen = models.BooleanField(default=False)
     app_tour_completed = models.BooleanField(default=False)
+    token_version = models.PositiveIntegerField(default=1, help_text="Bumped when the identity claims of issued tokens become outdated")
 
 
     
@@ -102,58 +108,51 @@ class CustomUser(AbstractUser, AuditModel):
         """ Ensure phone number is always present """
         if not self.phone_number and not self.is_superuser:
             raise ValidationError("Phone number cannot be empty.")
+        if not self._state.adding and kwargs.get("update_fields") is None and not kwargs.get("force_insert"):
+            # token_version and the OTP state only move through conditional update()s
+            # (bump_token_version, users.otp), so a full save of an instance loaded
+            # earlier must not write older values back.
+            deferred = self.get_deferred_fields()
+            kwargs["update_fields"] = [
+                f.attname for f in self._meta.concrete_fields
+                if not f.primary_key and f.attname not in deferred and f.attname not in UPDATE_ONLY_FIELDS
+            ]
         super().save(*args, **kwargs)
-        
-    def generate_security_code(self):
-        """ Generate a random security code (OTP). """
-        token_length = getattr(settings, "TOKEN_LENGTH", 6)
-        return get_random_string(token_length, allowed_chars="0123456789")
-
-    def is_security_code_expired(self):
-        """ Check if the security code has expired. """
-        expiration_date = self.sent + datetime.timedelta(minutes=settings.TOKEN_EXPIRE_MINUTES)
-        return expiration_date <= timezone.now()
 
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        """ Users built from token claims load deferred fields from the identity cache. """
+        if fields is not None and from_queryset is None and getattr(self, "_identity_from_token", False):
+            from users.identity import load_deferred_identity
+            fields = load_deferred_identity(self, fields)
+            if not fields:
+                return
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+        
     def send_confirmation(self):
         """
-        Generates & sends OTP via MSG91 API.
-        Returns True if OTP is sent successfully, else False.
+        Issues an OTP through users.otp; the SMS itself is sent in the background.
+        Returns True if the OTP was issued, else False.
         """
-        msg91_api_key = settings.MSG91_API_KEY
-        msg91_otp_template_id = settings.MSG91_OTP_TEMPLATE_ID
-
-        if all([msg91_api_key, msg91_otp_template_id]):
-            try:
-                self.security_code = self.generate_security_code()
-                self.sent = timezone.now()
-                self.save()
-
-                otp_response = send_otp(str(self.phone_number))  # Replace with your OTP sending logic
-
-                if otp_response.get("type") == "success":
-                    return True
-                else:
-                    logging.error(f"Failed to send OTP: {otp_response.get('message')}")
-                    return False
-            except Exception as e:
-                logging.error(f"Error while sending OTP: {e}")
-                return False
-        else:
-            logging.error("MSG91 credentials or OTP template ID are not set")
+        from users.otp import OTPError, issue_otp
+
+        try:
+            issue_otp(self)
+            return True
+        except OTPError as e:
+            logging.error(f"Failed to issue OTP: {e.message}")
             return False
 
     def check_verification(self, security_code):
         """ Check the OTP entered by the user. """
-        if security_code == self.security_code:
-            if not self.is_security_code_expired():
-                self.is_verified = True
-                self.security_code = None  # Clear the security code after verification
-                self.save()
-                return True
-            else:
-                raise ValidationError({"verification_error": _("OTP has expired. Please request a new OTP.")})
-        else:
-            raise ValidationError({"verification_error": _("Invalid OTP. Try again.")})
+        from users.otp import OTPError, verify_otp
+
+        try:
+            verify_otp(self, security_code)
+        except OTPError as e:
+            raise ValidationError({"verification_error": e.message})
+        self.is_verified = True
+        self.save(update_fields=["is_verified"])
+        return True
         
         
 
@@ -329,8 +328,23 @@ class Profile(AuditModel):
     weight = models.FloatField(help_text="Weight in kg", null=True, blank=True)
     blood_pressure = models.JSONField(null=True, blank=True, default=dict, help_text='{"systolic": 120, "diastolic": 80, "unit": "mmHg"}')
     lmp_date = models.DateField(null=True, blank=True, help_text="Last Menstrual Period")
+    bmi_value = models.GeneratedField(
+        expression=bmi_value_expression(),
+        output_field=models.FloatField(),
+        db_persist=True,
+        help_text="Unrounded BMI kept by the database for filtering and sorting",
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ProfileQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["lmp_date"], name="profile_lmp_date_idx"),
+            models.Index(fields=["date_of_birth"], name="profile_date_of_birth_idx"),
+            models.Index(fields=["bmi_value"], name="profile_bmi_value_idx"),
+        ]
     
     @property
     def age(self):
@@ -424,6 +438,10 @@ class MealPortion(AuditModel):
     serving_unit = models.CharField(max_length=100, null=True, blank=True)
     serving_qty = models.FloatField(null=True, blank=True)
     ai_generated = models.BooleanField(default=False)
+    nutrition_lookup = models.ForeignKey(
+        "NutritionLookup", on_delete=models.SET_NULL, null=True, blank=True, related_name="pending_portions",
+        help_text="Lookup this portion is waiting for; cleared once its result is applied",
+    )
     
     def __str__(self):
         return self.name
@@ -750,3 +768,340 @@ class UserLegalConsent(AuditModel):
 
     class Meta:
         unique_together = ("user", "content_type", "version")
+
+
+######################################################################## Dashboard Snapshot Model ################################################################################################
+
+class DashboardSnapshot(models.Model):
+    """
+    Precomputed dashboard payload for one doctor, one patient or the admin panel.
+    Rows are marked stale by the writes that affect them; patient rows are rebuilt on
+    the next read, admin and doctor rows by the rebuild_dashboards task.
+    """
+    SCOPE_CHOICES = [
+        ("admin", "Admin"),
+        ("doctor", "Doctor"),
+        ("patient", "Patient"),
+    ]
+
+    scope = models.CharField(max_length=10, choices=SCOPE_CHOICES)
+    owner = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=True, blank=True, related_name="dashboard_snapshots")
+    snapshot_date = models.DateField()
+    data = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    is_stale = models.BooleanField(default=False)
+    stale_since = models.DateTimeField(null=True, blank=True)
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("scope", "owner")
+
+    def __str__(self):
+        return f"{self.scope} dashboard for {self.owner_id or 'all'} on {self.snapshot_date}"
+
+
+######################################################################## Sync Operation Model ################################################################################################
+
+class SyncOperation(models.Model):
+    """
+    Idempotency record for one log operation sent to the patient sync endpoint.
+    A retried operation with the same key gets the stored result instead of being applied twice.
+    """
+    STATUS_CHOICES = [
+        ("applied", "Applied"),
+        ("rejected", "Rejected"),
+    ]
+
+    patient = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="sync_operations")
+    key = models.CharField(max_length=64)
+    op_type = models.CharField(max_length=30)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES)
+    error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = ("patient", "key")
+
+    def __str__(self):
+        return f"{self.patient_id} {self.op_type} {self.key}: {self.status}"
+
+
+class SyncTombstone(models.Model):
+    """
+    Id of a deleted patient record, so the sync delta can tell the app to drop it.
+    Kept PATIENT_SYNC_TOMBSTONE_DAYS, which is also how long a sync token stays valid.
+    """
+    patient = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="sync_tombstones")
+    entity = models.CharField(max_length=30)
+    object_id = models.PositiveBigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["patient", "deleted_at"], name="synctombstone_patient_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.patient_id} {self.entity} {self.object_id}"
+
+
+######################################################################## OTP Delivery Model ################################################################################################
+
+class OTPDelivery(models.Model):
+    """
+    One OTP SMS. The request thread tries it right away; failed sends are retried by the
+    beat task with a fresh code, so only the hash of the code in flight is stored.
+    """
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("processing", "Processing"),
+        ("sent", "Sent"),
+        ("failed", "Failed"),
+    ]
+
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="otp_deliveries")
+    code_hash = models.CharField(max_length=128)  # Matches security_code while this code is current
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField()
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "next_attempt_at"], name="otpdelivery_due_idx"),
+        ]
+
+    def __str__(self):
+        return f"OTP for {self.user_id}: {self.status}"
+
+
+######################################################################## Audio Variant Model ################################################################################################
+
+class AudioVariant(models.Model):
+    """
+    Compressed speech copy of an uploaded voice note, keyed by the storage name of the original.
+    Rows are created pending on upload and filled in by the background transcoder.
+    """
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("processing", "Processing"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    ]
+
+    source_name = models.CharField(max_length=255, unique=True)
+    compressed = models.FileField(upload_to="audio/compressed/", null=True, blank=True)
+    codec = models.CharField(max_length=20, null=True, blank=True)
+    bitrate_kbps = models.PositiveIntegerField(null=True, blank=True)
+    duration_seconds = models.FloatField(null=True, blank=True)
+    source_size = models.PositiveBigIntegerField(null=True, blank=True)
+    compressed_size = models.PositiveBigIntegerField(null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "id"], name="audiovariant_status_id_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.source_name} ({self.status})"
+
+
+######################################################################## Questionnaire Snapshot Model ################################################################################################
+
+class QuestionnaireSnapshot(models.Model):
+    """
+    Compiled question tree of one category as served to patients. `version` is bumped
+    whenever a question or option changes and doubles as the ETag of the payload.
+    """
+    category = models.CharField(max_length=50, unique=True)
+    data = models.JSONField(default=list, encoder=DjangoJSONEncoder)
+    is_stale = models.BooleanField(default=False)
+    version = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.category} questionnaire v{self.version}"
+
+
+######################################################################## Questionnaire Cadence Model ################################################################################################
+
+class QuestionnaireCadence(models.Model):
+    """
+    Where a patient stands in the recurring questionnaire: when the initial and the last
+    "other" round were completed and when the next round opens. Updated on every submission.
+    """
+    patient = models.OneToOneField(CustomUser, on_delete=models.CASCADE, related_name="questionnaire_cadence")
+    initial_completed_at = models.DateTimeField(null=True, blank=True)
+    last_other_completed_at = models.DateTimeField(null=True, blank=True)
+    next_due_date = models.DateField(null=True, blank=True)
+    round_number = models.PositiveIntegerField(default=0)
+    last_reminded_on = models.DateField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["next_due_date"], name="cadence_next_due_idx"),
+        ]
+
+    def is_due(self, on_date):
+        return self.next_due_date is not None and on_date >= self.next_due_date
+
+    def __str__(self):
+        return f"{self.patient_id} round {self.round_number} due {self.next_due_date}"
+
+
+######################################################################## Patient Cohort Model ################################################################################################
+
+class PatientCohort(models.Model):
+    """
+    One row per doctor and patient with a diet plan between them, carrying the fields
+    doctor screens filter on. Kept in sync by users.cohorts from DietPlan, Profile and
+    HealthStatus writes; the date-based buckets are refreshed daily.
+    """
+    DUE_BUCKETS = [
+        ("later", "Later"),
+        ("due_soon", "Due within 30 days"),
+        ("overdue", "Past due date"),
+    ]
+
+    doctor = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="doctor_cohort")
+    patient = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="patient_cohorts")
+    lmp_date = models.DateField(null=True, blank=True)
+    trimester = models.PositiveSmallIntegerField(null=True, blank=True)
+    due_bucket = models.CharField(max_length=10, choices=DUE_BUCKETS, null=True, blank=True)
+    health_status = models.CharField(max_length=20, null=True, blank=True)
+    buckets_on = models.DateField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("doctor", "patient")
+        indexes = [
+            models.Index(fields=["doctor", "trimester"], name="cohort_doctor_trimester_idx"),
+            models.Index(fields=["doctor", "health_status"], name="cohort_doctor_status_idx"),
+            models.Index(fields=["doctor", "due_bucket"], name="cohort_doctor_due_idx"),
+        ]
+
+    def __str__(self):
+        return f"Patient {self.patient_id} of doctor {self.doctor_id}"
+
+
+######################################################################## Daily Adherence Model ################################################################################################
+
+class DailyAdherence(models.Model):
+    """
+    Per patient and day rollup of planned versus completed meals and exercises, with the
+    diet and exercise streaks ending on that day. Maintained by users.adherence as
+    statuses are written; days nobody touched are closed by the nightly task.
+    """
+    patient = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="daily_adherence")
+    date = models.DateField()
+    meals_planned = models.PositiveSmallIntegerField(default=0)
+    meals_completed = models.PositiveSmallIntegerField(default=0)
+    meals_skipped = models.PositiveSmallIntegerField(default=0)
+    exercises_planned = models.PositiveSmallIntegerField(default=0)
+    exercises_completed = models.PositiveSmallIntegerField(default=0)
+    exercises_skipped = models.PositiveSmallIntegerField(default=0)
+    diet_streak = models.PositiveIntegerField(default=0)
+    exercise_streak = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("patient", "date")
+
+    @property
+    def diet_followed(self):
+        return self.meals_planned > 0 and self.meals_completed >= self.meals_planned
+
+    @property
+    def exercise_followed(self):
+        return self.exercises_planned > 0 and self.exercises_completed >= self.exercises_planned
+
+    def __str__(self):
+        return f"Adherence of {self.patient_id} on {self.date}"
+
+
+######################################################################## Step Aggregate Model ################################################################################################
+
+class StepAggregate(models.Model):
+    """
+    DailyStepCount rolled up per patient into calendar weeks (from Monday), calendar
+    months and pregnancy trimesters (from the LMP). Buckets touched by a step write are
+    recomputed by users.steps, so charts read one row per bucket.
+    """
+    PERIOD_CHOICES = [
+        ("week", "Week"),
+        ("month", "Month"),
+        ("trimester", "Trimester"),
+    ]
+
+    patient = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="step_aggregates")
+    period = models.CharField(max_length=10, choices=PERIOD_CHOICES)
+    bucket_start = models.DateField()
+    bucket_end = models.DateField(help_text="Last day of the bucket")
+    trimester = models.PositiveSmallIntegerField(null=True, blank=True)
+    days = models.PositiveIntegerField(default=0, help_text="Days with a step count")
+    total_steps = models.PositiveBigIntegerField(default=0)
+    max_steps = models.PositiveIntegerField(default=0)
+    goal_hit_days = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("patient", "period", "bucket_start")
+        indexes = [
+            models.Index(fields=["period", "bucket_start"], name="step_agg_period_start_idx"),
+        ]
+
+    @property
+    def mean_steps(self):
+        return round(self.total_steps / self.days) if self.days else 0
+
+    @property
+    def goal_hit_rate(self):
+        return round(self.goal_hit_days / self.days, 2) if self.days else 0
+
+    def __str__(self):
+        return f"{self.period} steps of {self.patient_id} from {self.bucket_start}"
+
+
+######################################################################## Nutrition Lookup Model ################################################################################################
+class NutritionLookup(models.Model):
+    """
+    Cached OpenFoodFacts result per normalized food name. Unknown names are queued
+    pending and resolved by the background enricher; results (including "not found")
+    are reused until `expires_at`.
+    """
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("processing", "Processing"),
+        ("found", "Found"),
+        ("not_found", "Not Found"),
+        ("failed", "Failed"),
+    ]
+
+    name = models.CharField(max_length=255, unique=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    data = models.JSONField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    fetched_at = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "next_attempt_at"], name="nutrition_status_next_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.status})"
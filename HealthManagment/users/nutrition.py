@@ -0,0 +1,203 @@
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import MealPortion, NutritionLookup
+from .nutrition_service import fetch_nutrition_data
+from .outbound import OutboundError, backoff_delay
+
+logger = logging.getLogger(__name__)
+
+RESOLVED_STATUSES = ("found", "not_found", "failed")
+
+
+def normalize_food_name(name):
+    """Cache key of a food name: lower case, punctuation dropped, single spaces."""
+    return " ".join(re.sub(r"[^\w\s]", " ", (name or "").lower()).split())[:255]
+
+
+######## Queueing ########
+
+def _apply(lookup, portion_ids=None):
+    """Copies a found lookup's nutrients onto its waiting portions (or the given ones)."""
+    portions = MealPortion.objects.filter(id__in=portion_ids) if portion_ids is not None else lookup.pending_portions.all()
+    if lookup.status == "found":
+        return portions.update(**lookup.data, nutrition_lookup=None, updated_at=timezone.now())
+    return portions.update(nutrition_lookup=None)
+
+
+def queue_nutrition_enrichment(portions):
+    """
+    Fills the portions from the lookup cache when their name has a fresh entry;
+    unknown and expired names get a pending lookup the portions wait for.
+    Returns the number of portions left waiting.
+    """
+    by_name = {}
+    for portion in portions:
+        name = normalize_food_name(portion.name)
+        if name:
+            by_name.setdefault(name, []).append(portion.id)
+    if not by_name:
+        return 0
+
+    now = timezone.now()
+    NutritionLookup.objects.bulk_create(
+        [NutritionLookup(name=name, next_attempt_at=now) for name in by_name],
+        ignore_conflicts=True,
+    )
+    waiting, linked = 0, {}
+    for lookup in NutritionLookup.objects.filter(name__in=by_name):
+        portion_ids = by_name[lookup.name]
+        if lookup.status in RESOLVED_STATUSES and lookup.expires_at > now:
+            _apply(lookup, portion_ids)
+            continue
+        if lookup.status in RESOLVED_STATUSES:
+            NutritionLookup.objects.filter(id=lookup.id, status=lookup.status).update(
+                status="pending", attempts=0, next_attempt_at=now
+            )
+        MealPortion.objects.filter(id__in=portion_ids).update(nutrition_lookup=lookup)
+        linked[lookup.id] = portion_ids
+        waiting += len(portion_ids)
+
+    # A lookup the enricher resolved between the read above and the link has already
+    # applied its result, without these portions.
+    for lookup in NutritionLookup.objects.filter(id__in=linked, status__in=RESOLVED_STATUSES):
+        _apply(lookup, linked[lookup.id])
+        waiting -= len(linked[lookup.id])
+    return waiting
+
+
+def schedule_nutrition_enrichment(portions):
+    """Queues the portions once the surrounding transaction commits."""
+    portions = list(portions)
+    if portions:
+        transaction.on_commit(lambda: queue_nutrition_enrichment(portions))
+
+
+######## Enrichment ########
+
+def _claim_batch(batch_size):
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            NutritionLookup.objects
+            .select_for_update(skip_locked=True)
+            .filter(status="pending", next_attempt_at__lte=now)
+            .order_by("next_attempt_at", "id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        NutritionLookup.objects.filter(id__in=ids).update(
+            status="processing", claimed_at=now, attempts=F("attempts") + 1
+        )
+    return list(NutritionLookup.objects.filter(id__in=ids).order_by("id"))
+
+
+def _release_stuck_lookups():
+    """
+    Returns lookups claimed by a worker that died mid-batch to the queue, or fails
+    them (releasing their portions) once they have used up NUTRITION_MAX_ATTEMPTS.
+    """
+    now = timezone.now()
+    stuck = NutritionLookup.objects.filter(
+        status="processing",
+        claimed_at__lt=now - timedelta(seconds=settings.NUTRITION_CLAIM_TIMEOUT),
+    )
+    exhausted = list(stuck.filter(attempts__gte=settings.NUTRITION_MAX_ATTEMPTS).values_list("id", flat=True))
+    if exhausted:
+        NutritionLookup.objects.filter(id__in=exhausted).update(
+            status="failed", error="Claim timed out", updated_at=now,
+            expires_at=now + timedelta(days=settings.NUTRITION_NEGATIVE_TTL_DAYS),
+        )
+        MealPortion.objects.filter(nutrition_lookup_id__in=exhausted).update(nutrition_lookup=None)
+    stuck.update(status="pending", next_attempt_at=now)
+
+
+def _fetch(name):
+    try:
+        return fetch_nutrition_data(name), None
+    except OutboundError as e:
+        return None, str(e)
+    except ValueError as e:
+        # A 200 whose body is not JSON (e.g. an HTML error page); retried like an outage.
+        return None, f"Invalid response: {e}"
+
+
+def enrich_pending_nutrition(batch_size=None, concurrency=None):
+    """
+    Resolves one batch of due lookups, at most `concurrency` OpenFoodFacts calls at a
+    time, and applies the results to the waiting portions. Failed calls are retried
+    with backoff on a later run. Returns counters for logging.
+    """
+    batch_size = batch_size or settings.NUTRITION_ENRICH_BATCH_SIZE
+    concurrency = concurrency or settings.NUTRITION_ENRICH_CONCURRENCY
+
+    _release_stuck_lookups()
+    lookups = _claim_batch(batch_size)
+    stats = {"lookups": len(lookups), "found": 0, "not_found": 0, "retry": 0, "failed": 0, "portions": 0}
+    if not lookups:
+        return stats
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(_fetch, [lookup.name for lookup in lookups]))
+
+    now = timezone.now()
+    for lookup, (data, error) in zip(lookups, results):
+        if error is None:
+            lookup.status = "found" if data else "not_found"
+            lookup.data = data
+            lookup.error = None
+            lookup.fetched_at = now
+            lookup.expires_at = now + timedelta(
+                days=settings.NUTRITION_CACHE_TTL_DAYS if data else settings.NUTRITION_NEGATIVE_TTL_DAYS
+            )
+        elif lookup.attempts >= settings.NUTRITION_MAX_ATTEMPTS:
+            logger.warning("Giving up on the nutrition lookup of %r: %s", lookup.name, error)
+            lookup.status = "failed"
+            lookup.error = error
+            lookup.expires_at = now + timedelta(days=settings.NUTRITION_NEGATIVE_TTL_DAYS)
+        else:
+            lookup.status = "pending"
+            lookup.error = error
+            lookup.next_attempt_at = now + timedelta(seconds=backoff_delay(lookup.attempts, base=60, cap=3600))
+        stats["retry" if lookup.status == "pending" else lookup.status] += 1
+
+    NutritionLookup.objects.bulk_update(
+        lookups, ["status", "data", "error", "fetched_at", "expires_at", "next_attempt_at", "updated_at"]
+    )
+    for lookup in lookups:
+        if lookup.status in RESOLVED_STATUSES:
+            stats["portions"] += _apply(lookup)
+    return stats
+
+
+def backfill_missing_nutrition(chunk_size=500, batch_size=None, concurrency=None):
+    """
+    Queues every portion without nutrients, then resolves the due lookups batch by
+    batch. Lookups waiting for a retry are left to the scheduled enricher.
+    """
+    missing = (
+        MealPortion.objects.filter(calories__isnull=True)
+        .exclude(nutrition_lookup__status__in=("pending", "processing"))
+        .only("id", "name")
+    )
+    queued, chunk = 0, []
+    for portion in missing.iterator(chunk_size=chunk_size):
+        chunk.append(portion)
+        if len(chunk) == chunk_size:
+            queued += queue_nutrition_enrichment(chunk)
+            chunk = []
+    queued += queue_nutrition_enrichment(chunk)
+
+    totals = {"queued": queued, "lookups": 0, "found": 0, "not_found": 0, "retry": 0, "failed": 0, "portions": 0}
+    while True:
+        stats = enrich_pending_nutrition(batch_size=batch_size, concurrency=concurrency)
+        for key, value in stats.items():
+            totals[key] += value
+        if not stats["lookups"]:
+            return totals
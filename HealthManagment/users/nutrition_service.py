@@ -1,39 +1,26 @@
-import time
-import requests
+from .outbound import get_client
 
-
-OPENFOOD_API = "https://world.openfoodfacts.org/cgi/search.pl"
+OPENFOOD_SEARCH_PATH = "/cgi/search.pl"
 HEADERS = {
     "User-Agent": "MHealth-Backend/1.0 (admin@aimedatsolutions.com)"
 }
-MAX_RETRIES = 3
-RETRY_DELAY = 1  # seconds
 
 
 def fetch_nutrition_data(food_name: str) -> dict | None:
+    """
+    One OpenFoodFacts search through the shared outbound client. Returns None when
+    nothing matches; raises OutboundError when the provider is slow, failing or its
+    circuit is open (users.nutrition schedules the retry).
+    """
     params = {
         "search_terms": food_name,
         "json": 1,
         "page_size": 1,
     }
-
-    for attempt in range(MAX_RETRIES):
-        try:
-            response = requests.get(
-                OPENFOOD_API, params=params, headers=HEADERS, timeout=10
-            )
-            if response.status_code == 200:
-                return _parse_response(response.json())
-            if response.status_code == 503 and attempt < MAX_RETRIES - 1:
-                time.sleep(RETRY_DELAY * (attempt + 1))
-                continue
-        except requests.RequestException:
-            if attempt < MAX_RETRIES - 1:
-                time.sleep(RETRY_DELAY * (attempt + 1))
-                continue
-            return None
-
-    return None
+    response = get_client("openfoodfacts").get(OPENFOOD_SEARCH_PATH, params=params, headers=HEADERS)
+    if response.status_code != 200:
+        return None
+    return _parse_response(response.json())
 
 
 def _parse_response(data: dict) -> dict | None:
@@ -0,0 +1,131 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare, get_random_string, salted_hmac
+
+from .models import CustomUser, OTPDelivery
+from .sms import deliver_otp, send_otp_async
+
+
+class OTPError(Exception):
+    """Raised when an OTP cannot be issued or verified; carries the HTTP status to answer with."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def _hash(user, code):
+    return salted_hmac("users.otp", f"{user.pk}:{code}", algorithm="sha256").hexdigest()
+
+
+def _new_code():
+    return get_random_string(settings.OTP_LENGTH, allowed_chars="0123456789")
+
+
+def issue_otp(user):
+    """
+    Generates a code for `user`, stores only its hash on the user row and queues
+    the SMS. Returns the OTPDelivery. The row is written with a conditional update,
+    so the resend throttle holds across workers.
+    """
+    now = timezone.now()
+    code = _new_code()
+    code_hash = _hash(user, code)
+    issued = CustomUser.objects.filter(pk=user.pk).filter(
+        Q(sent__isnull=True) | Q(sent__lte=now - timedelta(seconds=settings.OTP_RESEND_SECONDS))
+    ).update(security_code=code_hash, sent=now, otp_attempts=0)
+    if not issued:
+        raise OTPError("Please wait before requesting a new OTP.", 429)
+    # Left to the retry task if the first send has not claimed it by then.
+    delivery = OTPDelivery.objects.create(
+        user=user, code_hash=code_hash, next_attempt_at=now + timedelta(seconds=settings.SMS_CLAIM_TIMEOUT)
+    )
+    phone_number = str(user.phone_number)
+    transaction.on_commit(lambda: send_otp_async(delivery.pk, phone_number, code))
+    return delivery
+
+
+def verify_otp(user, code):
+    """
+    Checks `code` against the hash stored by issue_otp. A code can be used once;
+    after OTP_MAX_ATTEMPTS wrong guesses a new one has to be requested.
+    """
+    issued = CustomUser.objects.filter(pk=user.pk).values("security_code", "sent").first()
+    if (
+        not issued or not issued["security_code"]
+        or issued["sent"] <= timezone.now() - timedelta(minutes=settings.OTP_EXPIRE_MINUTES)
+    ):
+        raise OTPError("OTP has expired. Please request a new OTP.")
+
+    # Every guess is counted before it is checked; the conditional increment caps
+    # the guesses per code however many workers answer them.
+    pending = CustomUser.objects.filter(pk=user.pk, security_code=issued["security_code"])
+    if not pending.filter(otp_attempts__lt=settings.OTP_MAX_ATTEMPTS).update(otp_attempts=F("otp_attempts") + 1):
+        pending.update(security_code=None)
+        raise OTPError("Too many attempts. Please request a new OTP.", 429)
+    if not constant_time_compare(issued["security_code"], _hash(user, str(code))):
+        raise OTPError("Invalid OTP. Try again.")
+
+    if not pending.update(security_code=None):
+        # Used (or replaced) by a concurrent request in the meantime.
+        raise OTPError("OTP has expired. Please request a new OTP.")
+    return True
+
+
+######## SMS retries ########
+
+def _claim_due_deliveries(batch_size):
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            OTPDelivery.objects
+            .select_for_update(skip_locked=True)
+            .filter(status="pending", next_attempt_at__lte=now)
+            .order_by("next_attempt_at", "id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        OTPDelivery.objects.filter(id__in=ids).update(
+            status="processing", claimed_at=now, attempts=F("attempts") + 1
+        )
+    return list(OTPDelivery.objects.filter(id__in=ids).select_related("user").order_by("id"))
+
+
+def _release_stuck_deliveries():
+    """Returns deliveries claimed by a worker that died mid-send to the queue, or fails them."""
+    now = timezone.now()
+    stuck = OTPDelivery.objects.filter(
+        status="processing",
+        claimed_at__lt=now - timedelta(seconds=settings.SMS_CLAIM_TIMEOUT),
+    )
+    stuck.filter(attempts__gte=settings.SMS_MAX_ATTEMPTS).update(status="failed", last_error="Claim timed out")
+    stuck.update(status="pending", next_attempt_at=now)
+
+
+def retry_otp_deliveries(batch_size=100):
+    """
+    Resends the due OTPs whose earlier send failed. Only hashes are stored, so each
+    retry sends a fresh code in place of the one in flight; deliveries whose code was
+    used, replaced or has expired meanwhile are dropped. Returns counters for logging.
+    """
+    _release_stuck_deliveries()
+    stats = {"retried": 0, "sent": 0, "dropped": 0}
+    expired_before = timezone.now() - timedelta(minutes=settings.OTP_EXPIRE_MINUTES)
+    for delivery in _claim_due_deliveries(batch_size):
+        code = _new_code()
+        code_hash = _hash(delivery.user, code)
+        replaced = delivery.created_at > expired_before and CustomUser.objects.filter(
+            pk=delivery.user_id, security_code=delivery.code_hash
+        ).update(security_code=code_hash, otp_attempts=0)
+        if not replaced:
+            OTPDelivery.objects.filter(pk=delivery.pk).update(status="failed", last_error="Code used, replaced or expired")
+            stats["dropped"] += 1
+            continue
+        OTPDelivery.objects.filter(pk=delivery.pk).update(code_hash=code_hash)
+        stats["retried"] += 1
+        stats["sent"] += deliver_otp(delivery.pk, delivery.attempts, str(delivery.user.phone_number), code)
+    return stats
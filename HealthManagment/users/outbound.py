@@ -0,0 +1,213 @@
+import logging
+import random
+import threading
+import time
+from bisect import bisect_left
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (ms) of the latency histogram buckets; slower calls land in the last one.
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+PROVIDER_DEFAULTS = {
+    "base_url": "",
+    "connect_timeout": 3.05,
+    "read_timeout": 10,
+    "max_concurrency": 10,
+    "acquire_timeout": 0.5,
+    "failure_threshold": 5,
+    "reset_timeout": 30,
+}
+
+
+class OutboundError(Exception):
+    """Base class of the errors raised by outbound clients."""
+
+
+class ProviderUnavailable(OutboundError):
+    """Raised without calling the provider: its circuit is open or all its slots are busy."""
+
+
+class ProviderError(OutboundError):
+    """Raised when a provider call failed (timeout, connection error or 5xx/429 answer)."""
+
+    def __init__(self, message, status_code=None, timeout=False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.timeout = timeout
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and fails fast for
+    `reset_timeout` seconds, then lets a single trial call through (half-open).
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def allow(self):
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._trial_running = False
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.warning("Circuit opened after %s failures", self.failures)
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self._trial_running = False
+
+
+class LatencyHistogram:
+    """
+    Thread-safe call counters per outcome with a latency histogram for the calls
+    that reached the provider.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = {"ok": 0, "error": 0, "timeout": 0, "rejected": 0}
+            self.buckets = {"ok": [0] * (len(LATENCY_BUCKETS_MS) + 1), "error": [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+
+    def record(self, outcome, seconds=None):
+        with self._lock:
+            self.counts[outcome] += 1
+            if seconds is not None:
+                series = "ok" if outcome == "ok" else "error"
+                self.buckets[series][bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+
+    def snapshot(self):
+        labels = [f"le_{bound}ms" for bound in LATENCY_BUCKETS_MS] + [f"gt_{LATENCY_BUCKETS_MS[-1]}ms"]
+        with self._lock:
+            return {
+                **self.counts,
+                "latency": {series: dict(zip(labels, counts)) for series, counts in self.buckets.items()},
+            }
+
+
+class OutboundClient:
+    """
+    Calls to one third-party provider: a pooled session, connect/read timeouts,
+    at most `max_concurrency` calls in flight per process, a circuit breaker and
+    a latency histogram. `call` wraps SDK calls the same way `request` wraps HTTP.
+    """
+
+    def __init__(self, name, base_url, connect_timeout, read_timeout, max_concurrency,
+                 acquire_timeout, failure_threshold, reset_timeout):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.acquire_timeout = acquire_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.histogram = LatencyHistogram()
+
+    def call(self, func, *args, **kwargs):
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            self.histogram.record("rejected")
+            raise ProviderUnavailable(f"{self.name}: all connections are busy")
+        try:
+            if not self.breaker.allow():
+                self.histogram.record("rejected")
+                raise ProviderUnavailable(f"{self.name}: circuit is open")
+            started = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                timed_out = getattr(e, "timeout", False) or isinstance(e, requests.Timeout)
+                self.histogram.record("timeout" if timed_out else "error", time.monotonic() - started)
+                self.breaker.record_failure()
+                raise
+            self.histogram.record("ok", time.monotonic() - started)
+            self.breaker.record_success()
+            return result
+        finally:
+            self._slots.release()
+
+    def _send(self, method, url, **kwargs):
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.Timeout as e:
+            raise ProviderError(f"{self.name}: {e}", timeout=True) from e
+        except requests.RequestException as e:
+            raise ProviderError(f"{self.name}: {e}") from e
+        if response.status_code >= 500 or response.status_code == 429:
+            raise ProviderError(f"{self.name} answered {response.status_code}", status_code=response.status_code)
+        return response
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.call(self._send, method, f"{self.base_url}{path}", **kwargs)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def snapshot(self):
+        return {
+            "circuit": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            **self.histogram.snapshot(),
+        }
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(name):
+    """The process-wide client of provider `name`, configured from OUTBOUND_PROVIDERS."""
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                config = {**PROVIDER_DEFAULTS, **settings.OUTBOUND_PROVIDERS.get(name, {})}
+                client = _clients[name] = OutboundClient(name, **config)
+    return client
+
+
+def outbound_stats():
+    return {name: client.snapshot() for name, client in sorted(_clients.items())}
+
+
+def backoff_delay(attempt, base=1, cap=300):
+    """Exponential backoff with full jitter before retry number `attempt` (1-based), in seconds."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
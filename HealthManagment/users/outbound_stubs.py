@@ -0,0 +1,98 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers the MSG91 OTP and OpenFoodFacts search endpoints like the real providers."""
+
+    def _respond(self):
+        server = self.server
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        server.requests.append({"method": self.command, "path": url.path, "params": params})
+
+        if server.latency:
+            time.sleep(server.latency)
+        if server.failure_rate and random.random() < server.failure_rate:
+            return self._json(503, {"type": "error", "message": "stubbed failure"})
+
+        if url.path == "/api/v5/otp":
+            return self._json(200, {"type": "success", "request_id": f"stub-{len(server.requests)}"})
+        if url.path == "/cgi/search.pl":
+            name = params.get("search_terms", "")
+            products = [] if name.startswith("unknown") else [{
+                "product_name": name,
+                "nutriments": {
+                    "energy-kcal_100g": 100 + len(name),
+                    "proteins_100g": 3.5,
+                    "carbohydrates_100g": 20,
+                    "fat_100g": 1.2,
+                    "fiber_100g": 2,
+                    "sugars_100g": 0.5,
+                },
+            }]
+            return self._json(200, {"count": len(products), "products": products})
+        return self._json(404, {"type": "error", "message": "unknown endpoint"})
+
+    def _json(self, status, payload):
+        body = json.dumps(payload).encode()
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up (timed out) while the stub was sleeping.
+            pass
+
+    do_GET = _respond
+    do_POST = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer:
+    """
+    Local stand-in for the outbound providers, e.g. for tests:
+
+        with StubServer(latency=0.2, failure_rate=0.5) as stub:
+            settings.OUTBOUND_PROVIDERS["openfoodfacts"]["base_url"] = stub.base_url
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, failure_rate=0):
+        self.httpd = ThreadingHTTPServer((host, port), StubHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.failure_rate = failure_rate
+        self.httpd.requests = []
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
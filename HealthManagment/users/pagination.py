@@ -1,6 +1,26 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import PageNumberPagination, CursorPagination
 
 class Pagination(PageNumberPagination):
     page_size = 25
     page_size_query_param = 'page_size'
-    max_page_size = 1000
\ No newline at end of file
+    max_page_size = 1000
+
+
+class DateCursorPagination(CursorPagination):
+    """
+    Keyset pagination on `date` for date-ordered lists. Only used when the client
+    sends `cursor` or `page_size`, so plain requests keep returning a list.
+    """
+    page_size = 7
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = ('date', 'id')
+
+    def is_requested(self, request):
+        params = request.query_params
+        return self.cursor_query_param in params or self.page_size_query_param in params
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.is_requested(request):
+            return None
+        return super().paginate_queryset(queryset, request, view)
@@ -1,12 +1,155 @@
+import threading
+import time
+from collections import OrderedDict
 from rest_framework.permissions import BasePermission
 from rest_framework import permissions
-from django.contrib.auth.models import Permission
+from django.conf import settings
+from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache
 from rest_framework import permissions
 from rest_framework.exceptions import NotAuthenticated, PermissionDenied
 
+PERMISSION_VERSION_KEY = "permissions:version"
+PERMISSION_USER_KEY = "permissions:user:{}"
+
 def is_superuser_or_admin(user):
     return user.is_superuser or user.is_staff
 
+
+class PermissionCacheStats:
+    """
+    Thread-safe hit/miss counters for the resolved permission cache.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.local_hits = 0
+            self.shared_hits = 0
+            self.misses = 0
+
+    def record(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def snapshot(self):
+        with self._lock:
+            hits = self.local_hits + self.shared_hits
+            total = hits + self.misses
+            return {
+                "local_hits": self.local_hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "lookups": total,
+                "hit_rate": round(hits / total, 4) if total else None,
+            }
+
+
+permission_cache_stats = PermissionCacheStats()
+_local_permissions = OrderedDict()  # user id -> (expires at, resolved), least recently used first
+_local_lock = threading.Lock()
+
+
+def _permission_version():
+    version = cache.get(PERMISSION_VERSION_KEY)
+    if version is None:
+        cache.add(PERMISSION_VERSION_KEY, 1, timeout=None)
+        version = cache.get(PERMISSION_VERSION_KEY, 1)
+    return version
+
+
+def _resolve_permissions(user_id):
+    """Load the user's group names and their permission codenames in one query."""
+    groups, codenames = set(), set()
+    rows = Group.objects.filter(user__id=user_id).values_list("name", "permissions__codename")
+    for name, codename in rows:
+        groups.add(name)
+        if codename:
+            codenames.add(codename)
+    return {"groups": frozenset(groups), "codenames": frozenset(codenames)}
+
+
+def get_user_permissions(user):
+    """
+    Returns {"groups": frozenset, "codenames": frozenset} for the user.
+
+    Looks in the per-process LRU first (short TTL), then in the shared cache
+    (tagged with the global permission version), and only then hits the database.
+    Invalidation only reaches other workers through the shared cache, so without
+    SHARED_CACHE that layer is skipped and a change shows up everywhere within
+    PERMISSION_CACHE_LOCAL_TTL.
+    """
+    user_id = user.pk
+    now = time.monotonic()
+
+    with _local_lock:
+        entry = _local_permissions.get(user_id)
+        if entry and entry[0] > now:
+            _local_permissions.move_to_end(user_id)
+    if entry and entry[0] > now:
+        permission_cache_stats.record("local_hits")
+        return entry[1]
+
+    if not settings.SHARED_CACHE:
+        permission_cache_stats.record("misses")
+        resolved = _resolve_permissions(user_id)
+        _remember(user_id, now, resolved)
+        return resolved
+
+    user_key = PERMISSION_USER_KEY.format(user_id)
+    cached = cache.get_many([PERMISSION_VERSION_KEY, user_key])
+    version = cached.get(PERMISSION_VERSION_KEY) or _permission_version()
+    shared = cached.get(user_key)
+
+    if shared and shared["version"] == version:
+        permission_cache_stats.record("shared_hits")
+        resolved = {"groups": frozenset(shared["groups"]), "codenames": frozenset(shared["codenames"])}
+    else:
+        permission_cache_stats.record("misses")
+        resolved = _resolve_permissions(user_id)
+        cache.set(
+            user_key,
+            {"version": version, "groups": list(resolved["groups"]), "codenames": list(resolved["codenames"])},
+            timeout=getattr(settings, "PERMISSION_CACHE_TIMEOUT", 300),
+        )
+
+    _remember(user_id, now, resolved)
+    return resolved
+
+
+def _remember(user_id, now, resolved):
+    with _local_lock:
+        _local_permissions[user_id] = (now + getattr(settings, "PERMISSION_CACHE_LOCAL_TTL", 30), resolved)
+        _local_permissions.move_to_end(user_id)
+        while len(_local_permissions) > getattr(settings, "PERMISSION_CACHE_LOCAL_SIZE", 10000):
+            _local_permissions.popitem(last=False)
+
+
+def user_in_group(user, group_name):
+    # Token-authenticated users carry their groups as a claim.
+    groups = getattr(user, "token_groups", None)
+    if groups is None:
+        groups = get_user_permissions(user)["groups"]
+    return group_name in groups
+
+
+def invalidate_user_permissions(user_id):
+    with _local_lock:
+        _local_permissions.pop(user_id, None)
+    cache.delete(PERMISSION_USER_KEY.format(user_id))
+
+
+def invalidate_all_permissions():
+    """Called when a group or permission changes; every cached entry becomes outdated."""
+    with _local_lock:
+        _local_permissions.clear()
+    try:
+        cache.incr(PERMISSION_VERSION_KEY)
+    except ValueError:
+        cache.set(PERMISSION_VERSION_KEY, 2, timeout=None)
+
 class PermissionsManager(permissions.BasePermission):
 
     def has_permission(self, request, view):
@@ -24,12 +167,8 @@ class PermissionsManager(permissions.BasePermission):
         if prefixer is None:
             return True
         request_codename = f"{prefixer}_{view.codename}"
-        user_groups = request.user.groups.all()
-
-        for group in user_groups:
-            group_permissions = Permission.objects.filter(group__name=group.name)
-            if group_permissions.filter(codename=request_codename).exists():
-                return True
+        if request_codename in get_user_permissions(request.user)["codenames"]:
+            return True
         raise PermissionDenied(detail=f"You do not have permission to {prefixer} {view.codename}.")
     
 class IsSuperAdmin(permissions.BasePermission):
@@ -60,7 +199,7 @@ class IsDoctorUser(permissions.BasePermission):
     """
 
     def has_permission(self, request, view):
-        return request.user and request.user.is_authenticated and request.user.groups.filter(name='doctor').exists() 
+        return request.user and request.user.is_authenticated and user_in_group(request.user, 'doctor') 
     
 class IsDoctorOrAdmin(permissions.BasePermission):
     """Allows access to doctors, admins, and superadmins."""
@@ -69,7 +208,7 @@ class IsDoctorOrAdmin(permissions.BasePermission):
             return False
         return (
             request.user.role in ["admin", "superadmin"] or
-            request.user.groups.filter(name='doctor').exists()
+            user_in_group(request.user, 'doctor')
         ) 
     
 class IsPatientUser(permissions.BasePermission):
@@ -78,4 +217,4 @@ class IsPatientUser(permissions.BasePermission):
     """
 
     def has_permission(self, request, view):
-        return request.user and request.user.is_authenticated and request.user.groups.filter(name='patient').exists()
\ No newline at end of file
+        return request.user and request.user.is_authenticated and user_in_group(request.user, 'patient')
\ No newline at end of file
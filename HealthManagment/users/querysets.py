@@ -0,0 +1,208 @@
+from datetime import date, timedelta
+
+from dateutil.relativedelta import relativedelta
+from django.db import models
+from django.db.models import Case, Count, F, FloatField, IntegerField, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, ExtractYear
+
+# HealthStatus.health_status values treated as high risk on triage screens and dashboards.
+HIGH_RISK_STATUSES = ("Poor", "Critical")
+
+# Gestational weeks are computed up to this value; later LMP dates read as the cap.
+GESTATIONAL_WEEKS_CAP = 45
+
+# Upper bounds of Profile.bmi_category on the *rounded* BMI, shifted by half a cent so
+# the unrounded stored value falls in the same bucket as round(bmi, 2) does.
+BMI_CATEGORY_BOUNDS = (
+    (18.495, "Underweight"),
+    (24.895, "Normal weight"),
+    (24.995, "Obese"),
+    (29.895, "Overweight"),
+)
+
+
+def count_subquery(queryset, group_by):
+    """
+    Correlated COUNT(*) of `queryset` (already filtered on an OuterRef) as an
+    annotation, so counting related rows neither joins nor multiplies the outer rows.
+    """
+    counts = queryset.order_by().values(group_by).annotate(total=Count("pk")).values("total")
+    return Coalesce(Subquery(counts[:1], output_field=IntegerField()), Value(0))
+
+
+######## Profile metrics ########
+# The Profile properties (age, bmi, pregnancy_month, ...) as SQL. Everything that
+# depends on "today" is turned into date comparisons against constants computed here,
+# so the expressions are plain CASE/WHEN and behave the same on SQLite and PostgreSQL.
+
+def _lmp_days_q(prefix, min_days=None, max_days=None, today=None):
+    """Q for patients whose LMP was between min_days and max_days days ago (inclusive)."""
+    today = today or date.today()
+    q = Q(**{f"{prefix}lmp_date__isnull": False})
+    if min_days is not None:
+        q &= Q(**{f"{prefix}lmp_date__lte": today - timedelta(days=min_days)})
+    if max_days is not None:
+        q &= Q(**{f"{prefix}lmp_date__gte": today - timedelta(days=max_days)})
+    return q
+
+
+def pregnancy_month_expression(prefix="", today=None):
+    """Profile.pregnancy_month: (days since LMP // 28) + 1, at most 9. Future LMP dates read as 0."""
+    today = today or date.today()
+    lmp = f"{prefix}lmp_date"
+    return Case(
+        When(**{f"{lmp}__isnull": True}, then=None),
+        When(**{f"{lmp}__gt": today}, then=Value(0)),
+        *[When(**{f"{lmp}__gt": today - timedelta(days=28 * month)}, then=Value(month)) for month in range(1, 9)],
+        default=Value(9),
+        output_field=IntegerField(),
+    )
+
+
+def gestational_weeks_expression(prefix="", today=None):
+    """
+    Whole weeks since LMP (the weeks of Profile.gestational_age), capped at
+    GESTATIONAL_WEEKS_CAP. Future LMP dates read as 0.
+    """
+    today = today or date.today()
+    lmp = f"{prefix}lmp_date"
+    return Case(
+        When(**{f"{lmp}__isnull": True}, then=None),
+        When(**{f"{lmp}__gt": today}, then=Value(0)),
+        *[When(**{f"{lmp}__gt": today - timedelta(days=7 * (week + 1))}, then=Value(week)) for week in range(GESTATIONAL_WEEKS_CAP)],
+        default=Value(GESTATIONAL_WEEKS_CAP),
+        output_field=IntegerField(),
+    )
+
+
+def trimester_expression(prefix="", today=None):
+    """users.services.get_trimester: months 1-3, 4-6 and 7-9 of pregnancy_month (84 and 168 days)."""
+    return Case(
+        When(~_lmp_days_q(prefix, min_days=0, today=today), then=None),
+        When(_lmp_days_q(prefix, max_days=83, today=today), then=Value(1)),
+        When(_lmp_days_q(prefix, max_days=167, today=today), then=Value(2)),
+        default=Value(3),
+        output_field=IntegerField(),
+    )
+
+
+def due_bucket_expression(prefix="", today=None):
+    """
+    PatientCohort.due_bucket: "overdue" once Profile.edd has passed, "due_soon" from
+    240 days after LMP (the doctor dashboard's due-soon rule), otherwise "later".
+    """
+    today = today or date.today()
+    lmp = f"{prefix}lmp_date"
+    return Case(
+        When(**{f"{lmp}__isnull": True}, then=None),
+        When(**{f"{lmp}__lt": today - relativedelta(months=9, days=7)}, then=Value("overdue")),
+        When(**{f"{lmp}__lte": today - timedelta(days=240)}, then=Value("due_soon")),
+        default=Value("later"),
+        output_field=models.CharField(),
+    )
+
+
+def trimester_q(trimester, prefix="", today=None):
+    """Index-friendly filter on lmp_date for one trimester."""
+    bounds = {1: (0, 83), 2: (84, 167), 3: (168, None)}[int(trimester)]
+    return _lmp_days_q(prefix, *bounds, today=today)
+
+
+def gestational_weeks_q(prefix="", min_weeks=None, max_weeks=None, today=None):
+    """Index-friendly filter on lmp_date for a range of gestational weeks."""
+    return _lmp_days_q(
+        prefix,
+        min_days=None if min_weeks is None else int(min_weeks) * 7,
+        max_days=None if max_weeks is None else int(max_weeks) * 7 + 6,
+        today=today,
+    )
+
+
+def age_expression(prefix="", today=None):
+    """Profile.age in whole years from date_of_birth."""
+    today = today or date.today()
+    dob = f"{prefix}date_of_birth"
+    birthday_ahead = Q(**{f"{dob}__month__gt": today.month}) | Q(
+        **{f"{dob}__month": today.month, f"{dob}__day__gt": today.day}
+    )
+    return Case(
+        When(**{f"{dob}__isnull": True}, then=None),
+        When(birthday_ahead, then=Value(today.year - 1) - ExtractYear(dob)),
+        default=Value(today.year) - ExtractYear(dob),
+        output_field=IntegerField(),
+    )
+
+
+def age_q(prefix="", min_age=None, max_age=None, today=None):
+    """Index-friendly filter on date_of_birth for an age range in whole years."""
+    today = today or date.today()
+
+    def years_ago(years):
+        try:
+            return today.replace(year=today.year - years)
+        except ValueError:  # 29 February
+            return today.replace(year=today.year - years, day=28)
+
+    q = Q(**{f"{prefix}date_of_birth__isnull": False})
+    if min_age is not None:
+        q &= Q(**{f"{prefix}date_of_birth__lte": years_ago(int(min_age))})
+    if max_age is not None:
+        q &= Q(**{f"{prefix}date_of_birth__gt": years_ago(int(max_age) + 1)})
+    return q
+
+
+def bmi_value_expression():
+    """weight / height(m)² as stored in the Profile.bmi_value generated column."""
+    return Case(
+        When(height__gt=0, weight__isnull=False, then=F("weight") * 10000.0 / (F("height") * F("height"))),
+        default=None,
+        output_field=FloatField(),
+    )
+
+
+def bmi_category_expression(prefix=""):
+    """Profile.bmi_category from the stored bmi_value."""
+    bmi = f"{prefix}bmi_value"
+    return Case(
+        When(**{f"{bmi}__isnull": True}, then=None),
+        *[When(**{f"{bmi}__lt": bound}, then=Value(name)) for bound, name in BMI_CATEGORY_BOUNDS],
+        default=Value("Obese"),
+        output_field=models.CharField(),
+    )
+
+
+def bmi_category_q(category, prefix=""):
+    """Index-friendly filter on bmi_value for one Profile.bmi_category."""
+    bmi = f"{prefix}bmi_value"
+    lower = None
+    q = Q(pk__in=[])
+    for bound, name in BMI_CATEGORY_BOUNDS:
+        if name == category:
+            part = Q(**{f"{bmi}__lt": bound})
+            if lower is not None:
+                part &= Q(**{f"{bmi}__gte": lower})
+            q |= part
+        lower = bound
+    if category == "Obese":
+        q |= Q(**{f"{bmi}__gte": lower})
+    return q
+
+
+def profile_metric_annotations(prefix="", today=None):
+    """
+    Annotations mirroring the Profile properties. Names differ from the properties
+    (age_years, pregnancy_month_num, ...) so they can be used on Profile querysets too.
+    """
+    today = today or date.today()
+    return {
+        "age_years": age_expression(prefix, today),
+        "pregnancy_month_num": pregnancy_month_expression(prefix, today),
+        "gestational_weeks": gestational_weeks_expression(prefix, today),
+        "trimester": trimester_expression(prefix, today),
+        "bmi_category_name": bmi_category_expression(prefix),
+    }
+
+
+class ProfileQuerySet(models.QuerySet):
+    def with_metrics(self, today=None):
+        return self.annotate(**profile_metric_annotations(today=today))
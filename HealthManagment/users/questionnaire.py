@@ -0,0 +1,176 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Max, Prefetch, Q
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import CustomUser, Option, PatientResponse, Question, QuestionnaireCadence, QuestionnaireSnapshot
+
+
+def _node(question, children):
+    return {
+        "id": question.id,
+        "question_image": question.question_image.url if question.question_image else None,
+        "question_text": question.question_text,
+        "category": question.category,
+        "type": question.type,
+        "placeholder": question.placeholder,
+        "max_length": question.max_length,
+        "condition_value": question.condition_value,
+        "options": [
+            {"id": option.id, "value": option.value, "type": option.type}
+            for option in question.options.all()
+        ],
+        "sub_questions": [_node(child, children) for child in children[question.id]],
+    }
+
+
+def compile_questionnaire(category):
+    """
+    Builds the nested tree of the root questions of `category` from two queries
+    (questions and options) instead of two queries per node.
+    """
+    questions = Question.objects.order_by("id").prefetch_related(
+        Prefetch("options", queryset=Option.objects.order_by("id"))
+    )
+    children, roots = defaultdict(list), []
+    for question in questions:
+        if question.parent_id is None:
+            if question.category == category:
+                roots.append(question)
+        else:
+            children[question.parent_id].append(question)
+    return [_node(question, children) for question in roots]
+
+
+def get_questionnaire(category):
+    """
+    Returns (version, tree) for the category from its snapshot row, compiling the
+    tree only when the row is missing or stale.
+    """
+    snapshot = QuestionnaireSnapshot.objects.filter(category=category).first()
+    if snapshot and not snapshot.is_stale:
+        return snapshot.version, snapshot.data
+
+    data = compile_questionnaire(category)
+    if snapshot is None:
+        snapshot, _ = QuestionnaireSnapshot.objects.get_or_create(category=category, defaults={"data": data})
+        return snapshot.version, snapshot.data
+
+    # Only store the compiled tree if nothing invalidated the row meanwhile.
+    QuestionnaireSnapshot.objects.filter(pk=snapshot.pk, version=snapshot.version).update(
+        data=data, is_stale=False
+    )
+    return snapshot.version, data
+
+
+def invalidate_questionnaires():
+    transaction.on_commit(
+        lambda: QuestionnaireSnapshot.objects.update(is_stale=True, version=F("version") + 1)
+    )
+
+
+def with_absolute_images(nodes, request):
+    """Copies the tree with `question_image` turned into absolute URLs for this request."""
+    return [
+        {
+            **node,
+            "question_image": request.build_absolute_uri(node["question_image"]) if node["question_image"] else None,
+            "sub_questions": with_absolute_images(node["sub_questions"], request),
+        }
+        for node in nodes
+    ]
+
+
+######## Cadence ########
+
+def questionnaire_interval():
+    return timedelta(days=int(getattr(settings, "QUESTIONS_DAYS", 10)))
+
+
+HISTORY_AGGREGATES = {
+    "last": Max("created_at"),
+    "rounds": Count(TruncDate("created_at"), distinct=True),
+}
+
+
+def _other_history(responses):
+    return responses.filter(question__category="other")
+
+
+def _cadence_from_history(patient_id, history, last_answered=None):
+    """Builds the cadence of a patient who answered before cadence rows were kept."""
+    cadence = QuestionnaireCadence(patient_id=patient_id, round_number=history.get("rounds") or 0)
+    if history.get("last"):
+        cadence.last_other_completed_at = history["last"]
+        cadence.next_due_date = history["last"].date() + questionnaire_interval()
+    else:
+        cadence.next_due_date = last_answered or timezone.now().date()
+    return cadence
+
+
+def get_questionnaire_cadence(user):
+    """
+    Returns the patient's cadence row. Rows missing for patients who answered before
+    cadence was tracked are rebuilt from their responses once.
+    """
+    cadence = QuestionnaireCadence.objects.filter(patient=user).first()
+    if cadence is None and user.initial_question_completed:
+        history = _other_history(PatientResponse.objects.filter(user=user)).aggregate(**HISTORY_AGGREGATES)
+        cadence = _cadence_from_history(user.id, history, user.last_question_answered_at)
+        cadence, _ = QuestionnaireCadence.objects.get_or_create(
+            patient=user,
+            defaults={f: getattr(cadence, f) for f in ("last_other_completed_at", "next_due_date", "round_number")},
+        )
+    return cadence or QuestionnaireCadence(patient=user)
+
+
+def record_questionnaire_submission(user, completed_initial, answered_other, when=None):
+    """Moves the cadence forward after a saved submission; call inside its transaction."""
+    when = when or timezone.now()
+    if completed_initial:
+        QuestionnaireCadence.objects.get_or_create(patient=user)
+    else:
+        get_questionnaire_cadence(user)
+    cadence = QuestionnaireCadence.objects.select_for_update().get(patient=user)
+
+    if completed_initial and cadence.initial_completed_at is None:
+        cadence.initial_completed_at = when
+        cadence.next_due_date = when.date()
+    if answered_other:
+        cadence.last_other_completed_at = when
+        cadence.round_number += 1
+        cadence.next_due_date = when.date() + questionnaire_interval()
+    cadence.save()
+    return cadence
+
+
+def due_questionnaire_cadences(on_date=None):
+    """Cadences whose next round is open on `on_date` and that were not reminded for it yet."""
+    on_date = on_date or timezone.now().date()
+    return QuestionnaireCadence.objects.filter(
+        Q(last_reminded_on__isnull=True) | Q(last_reminded_on__lt=F("next_due_date")),
+        next_due_date__lte=on_date,
+        patient__is_active=True,
+    )
+
+
+def backfill_questionnaire_cadences():
+    """Creates the missing cadence rows of patients who completed the initial questions."""
+    missing = CustomUser.objects.filter(initial_question_completed=True, questionnaire_cadence__isnull=True)
+    histories = {
+        row["user_id"]: row
+        for row in _other_history(PatientResponse.objects.filter(user__in=missing))
+        .values("user_id").annotate(**HISTORY_AGGREGATES)
+    }
+    created, batch = 0, []
+    for patient_id, last_answered in missing.values_list("id", "last_question_answered_at").iterator(chunk_size=2000):
+        batch.append(_cadence_from_history(patient_id, histories.get(patient_id, {}), last_answered))
+        if len(batch) >= 500:
+            created += len(QuestionnaireCadence.objects.bulk_create(batch, ignore_conflicts=True))
+            batch = []
+    created += len(QuestionnaireCadence.objects.bulk_create(batch, ignore_conflicts=True))
+    return created
@@ -0,0 +1,27 @@
+from storages.backends.s3 import S3Storage
+from storages.utils import clean_name
+
+
+class S3MediaStorage(S3Storage):
+    """
+    S3-compatible media storage (AWS S3, MinIO). Files saved through Django are streamed
+    to the bucket as multipart uploads; presigned_upload lets clients skip Django entirely.
+    """
+
+    def presigned_upload(self, key, content_type, max_size, expires):
+        post = self.bucket.meta.client.generate_presigned_post(
+            Bucket=self.bucket_name,
+            Key=self._normalize_name(clean_name(key)),
+            Fields={"Content-Type": content_type},
+            Conditions=[
+                {"Content-Type": content_type},
+                ["content-length-range", 1, max_size],
+            ],
+            ExpiresIn=expires,
+        )
+        return {
+            "url": post["url"],
+            "method": "POST",
+            "fields": post["fields"],
+            "headers": {},
+        }
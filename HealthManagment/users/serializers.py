@@ -3,8 +3,9 @@ from django.contrib.auth import authenticate
 from django.contrib.auth import get_user_model
 from phonenumber_field.serializerfields import PhoneNumberField
 from django.contrib.auth.models import Group, Permission
-from .utils import send_otp, verify_otp
-from .models import ( DailyStepCount,Question, Profile,DietPlan,Exercise, CustomUser, Option, PatientResponse,
+from .otp import OTPError, issue_otp, verify_otp
+from .audio import audio_url
+from .models import ( DailyStepCount, StepAggregate,Question, Profile,DietPlan,Exercise, CustomUser, Option, PatientResponse,
                     LabReport,DietPlanStatus,ExerciseDate,AppContent,UserLegalConsent,HealthEducation,HelpContent
                     )
 import re,os
@@ -49,8 +50,11 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
         if phone_number:
             user.phone_number = phone_number
             user.save()
-            send_otp(str(phone_number))
-            print(send_otp)
+            # The user is committed by now; a refused OTP is reported, not turned into a 400.
+            try:
+                issue_otp(user)
+            except OTPError as e:
+                self.context['otp_error'] = e.message
         
         return user
 
@@ -78,9 +82,10 @@ class UserLoginSerializer(serializers.Serializer):
                 raise serializers.ValidationError("User with this phone number does not exist.")
             if environment in ['production', 'staging']:
                 # Verify OTP in production and staging
-                response = verify_otp(str(phone_number), otp)
-                if response['type'] != 'success':
-                    raise serializers.ValidationError("OTP verification failed.")
+                try:
+                    verify_otp(user, otp)
+                except OTPError as e:
+                    raise serializers.ValidationError(e.message)
             else:
                 # In non-production environments, verify with random OTP `1234`
                 if otp != '123456':
@@ -206,7 +211,10 @@ class DoctorRegistrationSerializer(serializers.ModelSerializer):
             user = CustomUser.objects.get(phone_number=phone_number)
             print(user)
             if environment in ['production', 'staging']:
-                send_otp(str(phone_number))
+                try:
+                    issue_otp(user)
+                except OTPError as e:
+                    raise serializers.ValidationError({"phone_number": e.message})
                 self.context['otp_sent'] = True
             else:
                 self.context['otp_sent'] = False
@@ -236,10 +244,15 @@ class DoctorRegistrationSerializer(serializers.ModelSerializer):
             # Create profile if not exists
             Profile.objects.get_or_create(user=user)
 
-            # Send OTP in allowed envs
+            # Send OTP in allowed envs; the doctor is already created, so a refused
+            # OTP is reported rather than raised.
             if environment in ['production', 'staging']:
-                send_otp(str(phone_number))
-                self.context['otp_sent'] = True
+                try:
+                    issue_otp(user)
+                    self.context['otp_sent'] = True
+                except OTPError as e:
+                    self.context['otp_sent'] = False
+                    self.context['otp_error'] = e.message
             else:
                 self.context['otp_sent'] = False
 
@@ -295,7 +308,7 @@ class ExerciseDateSerializer(serializers.ModelSerializer):
                 "status": s.status,
                 "updated_at": s.updated_at,
                 "calories_burned": s.calories_burned,
-                "reason_audio": s.reason_audio.url if s.reason_audio else None,
+                "reason_audio": audio_url(s.reason_audio, variants=self.context.get("audio_variants")) if s.reason_audio else None,
             }
         return {
             "status": "pending",
@@ -549,3 +562,22 @@ class DailyStepSerializer(serializers.ModelSerializer):
             "status",
             "message",
         ]
+
+
+class StepAggregateSerializer(serializers.ModelSerializer):
+    mean_steps = serializers.IntegerField(read_only=True)
+    goal_hit_rate = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = StepAggregate
+        fields = [
+            "period",
+            "bucket_start",
+            "bucket_end",
+            "trimester",
+            "days",
+            "total_steps",
+            "mean_steps",
+            "max_steps",
+            "goal_hit_rate",
+        ]
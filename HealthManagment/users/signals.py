@@ -1,6 +1,22 @@
-from django.db.models.signals import post_save
+from datetime import date
+
+from django.contrib.auth.models import Group, Permission
+from django.db.models.signals import post_save, post_delete, post_init, m2m_changed
 from django.dispatch import receiver
-from .models import CustomUser, Profile
+from .models import (
+    CustomUser, Profile, DietPlan, DietPlanDate, DietPlanMeal, DietPlanStatus, ExerciseDate, ExerciseStatus,
+    HealthStatus, DailyStepCount, Exercise, Question, Option, SyncTombstone,
+)
+from .dashboard import invalidate_patient_dashboards, invalidate_doctor_dashboards, invalidate_admin_dashboard
+from .permissions import invalidate_user_permissions, invalidate_all_permissions
+from .audio import AUDIO_FIELDS, audio_names, queue_audio_transcode
+from .questionnaire import invalidate_questionnaires
+from .cohorts import sync_patient_cohorts, update_cohort_health_status
+from .adherence import schedule_adherence_refresh
+from .steps import refresh_step_aggregates, schedule_step_refresh
+from .identity import TOKEN_CLAIM_FIELDS, bump_token_version, invalidate_identity
+
+DASHBOARD_PROFILE_FIELDS = ("first_name", "last_name", "lmp_date", "height", "weight")
 
 @receiver(post_save, sender=CustomUser)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -10,3 +26,241 @@ def create_user_profile(sender, instance, created, **kwargs):
 @receiver(post_save, sender=CustomUser)
 def save_user_profile(sender, instance, **kwargs):
     instance.profile.save()
+
+
+######################################################################## Dashboard snapshots ########################################################################
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_dashboards_for_user(sender, instance, created=False, **kwargs):
+    if created or kwargs.get("signal") is post_delete:
+        invalidate_admin_dashboard()
+
+@receiver(post_init, sender=Profile)
+def remember_profile_dashboard_fields(sender, instance, **kwargs):
+    instance._dashboard_fields = tuple(instance.__dict__.get(f) for f in DASHBOARD_PROFILE_FIELDS)
+
+@receiver(post_save, sender=Profile)
+def invalidate_dashboards_for_profile(sender, instance, created, **kwargs):
+    current = tuple(instance.__dict__.get(f) for f in DASHBOARD_PROFILE_FIELDS)
+    if not created and current == getattr(instance, "_dashboard_fields", None):
+        return
+    instance._dashboard_fields = current
+    invalidate_patient_dashboards(instance.user_id)
+
+@receiver(post_save, sender=DietPlanStatus)
+@receiver(post_delete, sender=DietPlanStatus)
+@receiver(post_save, sender=HealthStatus)
+@receiver(post_delete, sender=HealthStatus)
+@receiver(post_save, sender=DailyStepCount)
+@receiver(post_delete, sender=DailyStepCount)
+@receiver(post_save, sender=ExerciseDate)
+@receiver(post_delete, sender=ExerciseDate)
+def invalidate_dashboards_for_patient_record(sender, instance, **kwargs):
+    invalidate_patient_dashboards(instance.patient_id)
+
+@receiver(post_save, sender=ExerciseStatus)
+@receiver(post_delete, sender=ExerciseStatus)
+def invalidate_dashboards_for_exercise_status(sender, instance, **kwargs):
+    invalidate_patient_dashboards(instance.user_id)
+
+@receiver(post_save, sender=DietPlan)
+@receiver(post_delete, sender=DietPlan)
+def invalidate_dashboards_for_diet_plan(sender, instance, **kwargs):
+    invalidate_patient_dashboards(instance.patient_id)
+    invalidate_doctor_dashboards(instance.doctor_id)
+
+def diet_plan_patient_id(instance):
+    if type(instance).diet_plan.is_cached(instance):
+        return instance.diet_plan.patient_id
+    return DietPlan.objects.filter(pk=instance.diet_plan_id).values_list("patient_id", flat=True).first()
+
+@receiver(post_save, sender=DietPlanDate)
+@receiver(post_delete, sender=DietPlanDate)
+def invalidate_dashboards_for_diet_date(sender, instance, **kwargs):
+    patient_id = diet_plan_patient_id(instance)
+    if patient_id:
+        invalidate_patient_dashboards(patient_id)
+
+@receiver(post_save, sender=Exercise)
+@receiver(post_delete, sender=Exercise)
+def invalidate_dashboards_for_exercise(sender, instance, **kwargs):
+    invalidate_admin_dashboard()
+
+
+######################################################################## Permission cache ########################################################################
+
+@receiver(m2m_changed, sender=CustomUser.groups.through)
+def invalidate_permissions_for_user_groups(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        invalidate_user_permissions(instance.pk)
+    elif pk_set:
+        for user_id in pk_set:
+            invalidate_user_permissions(user_id)
+    else:
+        invalidate_all_permissions()
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_permissions_for_group_permissions(sender, action, **kwargs):
+    if action.startswith("post_"):
+        invalidate_all_permissions()
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+def invalidate_permissions_for_group(sender, instance, **kwargs):
+    invalidate_all_permissions()
+
+@receiver(post_delete, sender=CustomUser)
+def invalidate_permissions_for_deleted_user(sender, instance, **kwargs):
+    invalidate_user_permissions(instance.pk)
+
+
+######################################################################## Identity cache ########################################################################
+
+@receiver(post_init, sender=CustomUser)
+def remember_token_claim_fields(sender, instance, **kwargs):
+    instance._token_claims = {f: instance.__dict__[f] for f in TOKEN_CLAIM_FIELDS if f in instance.__dict__}
+
+@receiver(post_save, sender=CustomUser)
+def refresh_identity_for_user(sender, instance, created, **kwargs):
+    claims = {f: instance.__dict__[f] for f in TOKEN_CLAIM_FIELDS if f in instance.__dict__}
+    changed = any(claims.get(f, value) != value for f, value in instance._token_claims.items())
+    instance._token_claims = claims
+    if created:
+        return
+    if changed:
+        bump_token_version([instance.pk])
+        if "token_version" in instance.__dict__:
+            instance.token_version += 1
+    else:
+        invalidate_identity([instance.pk])
+
+@receiver(m2m_changed, sender=CustomUser.groups.through)
+def bump_token_version_for_user_groups(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear" and reverse:
+        instance._cleared_user_ids = list(instance.user_set.values_list("id", flat=True))
+    elif action.startswith("post_"):
+        if not reverse:
+            bump_token_version([instance.pk])
+        else:
+            bump_token_version(pk_set or getattr(instance, "_cleared_user_ids", []))
+
+@receiver(post_delete, sender=CustomUser)
+def invalidate_identity_for_deleted_user(sender, instance, **kwargs):
+    bump_token_version([instance.pk])
+
+
+######################################################################## Patient cohorts ########################################################################
+
+@receiver(post_save, sender=DietPlan)
+@receiver(post_delete, sender=DietPlan)
+def sync_cohorts_for_diet_plan(sender, instance, **kwargs):
+    sync_patient_cohorts(instance.patient_id)
+
+@receiver(post_init, sender=Profile)
+def remember_profile_lmp_date(sender, instance, **kwargs):
+    instance._saved_lmp_date = instance.__dict__.get("lmp_date")
+
+@receiver(post_save, sender=Profile)
+def sync_lmp_date_dependents(sender, instance, created, **kwargs):
+    if created or instance.lmp_date == instance._saved_lmp_date:
+        return
+    instance._saved_lmp_date = instance.lmp_date
+    sync_patient_cohorts(instance.user_id)
+    refresh_step_aggregates(instance.user_id, periods=("trimester",))
+
+@receiver(post_save, sender=HealthStatus)
+@receiver(post_delete, sender=HealthStatus)
+def sync_cohorts_for_health_status(sender, instance, **kwargs):
+    update_cohort_health_status(instance.patient_id)
+
+
+######################################################################## Daily adherence ########################################################################
+
+@receiver(post_save, sender=DietPlanStatus)
+@receiver(post_delete, sender=DietPlanStatus)
+@receiver(post_save, sender=ExerciseDate)
+@receiver(post_delete, sender=ExerciseDate)
+def refresh_adherence_for_patient_record(sender, instance, **kwargs):
+    schedule_adherence_refresh(instance.patient_id, [instance.date])
+
+@receiver(post_save, sender=ExerciseStatus)
+@receiver(post_delete, sender=ExerciseStatus)
+def refresh_adherence_for_exercise_status(sender, instance, **kwargs):
+    if ExerciseStatus.exercise.is_cached(instance):
+        day = instance.exercise.date
+    else:
+        # Gone when the assigned date itself was deleted; its own signal covers the day.
+        day = ExerciseDate.objects.filter(pk=instance.exercise_id).values_list("date", flat=True).first()
+    schedule_adherence_refresh(instance.user_id, [day])
+
+@receiver(post_save, sender=DietPlanDate)
+@receiver(post_delete, sender=DietPlanDate)
+def refresh_adherence_for_diet_date(sender, instance, **kwargs):
+    schedule_adherence_refresh(diet_plan_patient_id(instance), [instance.date])
+
+@receiver(post_save, sender=DietPlanMeal)
+@receiver(post_delete, sender=DietPlanMeal)
+def refresh_adherence_for_diet_meal(sender, instance, created=True, **kwargs):
+    if not created:
+        return
+    patient_id = diet_plan_patient_id(instance)
+    dates = DietPlanDate.objects.filter(diet_plan_id=instance.diet_plan_id, date__lte=date.today()).values_list("date", flat=True)
+    schedule_adherence_refresh(patient_id, list(dates))
+
+
+######################################################################## Step aggregates ########################################################################
+
+@receiver(post_save, sender=DailyStepCount)
+@receiver(post_delete, sender=DailyStepCount)
+def refresh_step_aggregates_for_count(sender, instance, **kwargs):
+    schedule_step_refresh(instance.patient_id, [instance.date])
+
+
+######################################################################## Sync tombstones ########################################################################
+
+def _deleted_with(origin, model):
+    """Whether the delete was started on `model` (an instance or a queryset of it)."""
+    return isinstance(origin, model) or getattr(origin, "model", None) is model
+
+def record_sync_tombstone(entity, patient_id, object_id, origin):
+    # Everything of a deleted patient goes with them.
+    if patient_id and not _deleted_with(origin, CustomUser):
+        SyncTombstone.objects.create(patient_id=patient_id, entity=entity, object_id=object_id)
+
+@receiver(post_delete, sender=DietPlan)
+def record_deleted_diet_plan(sender, instance, origin=None, **kwargs):
+    record_sync_tombstone("diet_plans", instance.patient_id, instance.pk, origin)
+
+@receiver(post_delete, sender=DietPlanDate)
+def record_deleted_diet_date(sender, instance, origin=None, **kwargs):
+    # The dates of a deleted plan are covered by the plan's tombstone.
+    if not _deleted_with(origin, DietPlan):
+        record_sync_tombstone("diet_dates", diet_plan_patient_id(instance), instance.pk, origin)
+
+@receiver(post_delete, sender=ExerciseDate)
+def record_deleted_exercise_date(sender, instance, origin=None, **kwargs):
+    record_sync_tombstone("exercise_dates", instance.patient_id, instance.pk, origin)
+
+
+######################################################################## Questionnaire snapshots ########################################################################
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+@receiver(post_save, sender=Option)
+@receiver(post_delete, sender=Option)
+def invalidate_questionnaire_snapshots(sender, instance, **kwargs):
+    invalidate_questionnaires()
+
+
+######################################################################## Voice note transcoding ########################################################################
+
+def queue_voice_notes(sender, instance, **kwargs):
+    queue_audio_transcode(audio_names(instance))
+
+for audio_model in AUDIO_FIELDS:
+    post_save.connect(queue_voice_notes, sender=audio_model, dispatch_uid=f"queue_voice_notes_{audio_model.__name__}")
@@ -0,0 +1,116 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import OTPDelivery
+from .outbound import OutboundError, backoff_delay, get_client
+
+logger = logging.getLogger(__name__)
+
+
+class MSG91Gateway:
+    """Delivers codes generated by users.otp through the MSG91 OTP template."""
+
+    def send_otp(self, phone_number, code):
+        response = get_client("msg91").post(
+            "/api/v5/otp",
+            params={"template_id": settings.MSG91_OTP_TEMPLATE_ID, "mobile": phone_number, "otp": code},
+            headers={"accept": "application/json", "authkey": settings.MSG91_API_KEY},
+        )
+        data = response.json()
+        if data.get("type") != "success":
+            logger.error("MSG91 rejected the OTP for %s: %s", phone_number, data.get("message"))
+            return False
+        return True
+
+
+class FakeSMSGateway:
+    """In-memory stand-in for MSG91 used in tests and local development."""
+    sent = []
+
+    def send_otp(self, phone_number, code):
+        self.sent.append({"phone_number": phone_number, "code": code})
+        return True
+
+    @classmethod
+    def last_code(cls, phone_number):
+        codes = [sms["code"] for sms in cls.sent if sms["phone_number"] == phone_number]
+        return codes[-1] if codes else None
+
+    @classmethod
+    def reset(cls):
+        cls.sent = []
+
+
+_gateway = None
+_executor = None
+_lock = threading.Lock()
+
+
+def get_sms_gateway():
+    """The process-wide gateway instance."""
+    global _gateway
+    if _gateway is None:
+        with _lock:
+            if _gateway is None:
+                _gateway = import_string(settings.SMS_GATEWAY_BACKEND)()
+    return _gateway
+
+
+def deliver_otp(delivery_id, attempt, phone_number, code):
+    """
+    Sends the code of a claimed OTPDelivery and records the outcome. Gateway errors are
+    retried by the beat task (users.otp.retry_otp_deliveries) with backoff until
+    SMS_MAX_ATTEMPTS; a rejected SMS fails right away. Returns True when sent.
+    """
+    error, retry = None, False
+    try:
+        if not get_sms_gateway().send_otp(phone_number, code):
+            error = "Rejected by the SMS gateway"
+    except OutboundError as e:
+        error, retry = str(e), True
+    except Exception as e:
+        logger.exception("Sending the OTP to %s failed", phone_number)
+        error, retry = str(e), True
+
+    if error is None:
+        fields = {"status": "sent", "last_error": None}
+    elif retry and attempt < settings.SMS_MAX_ATTEMPTS:
+        logger.warning("Sending the OTP to %s failed, retrying: %s", phone_number, error)
+        fields = {
+            "status": "pending",
+            "last_error": error,
+            "next_attempt_at": timezone.now() + timedelta(seconds=backoff_delay(attempt, base=2, cap=60)),
+        }
+    else:
+        logger.error("Giving up on the OTP for %s after %s attempts: %s", phone_number, attempt, error)
+        fields = {"status": "failed", "last_error": error}
+    OTPDelivery.objects.filter(pk=delivery_id).update(**fields)
+    return error is None
+
+
+def _send(delivery_id, phone_number, code):
+    try:
+        # Claimed like a retry, so the beat task cannot send the same delivery meanwhile.
+        claimed = OTPDelivery.objects.filter(pk=delivery_id, status="pending", attempts=0).update(
+            status="processing", claimed_at=timezone.now(), attempts=1
+        )
+        return bool(claimed) and deliver_otp(delivery_id, 1, phone_number, code)
+    finally:
+        close_old_connections()
+
+
+def send_otp_async(delivery_id, phone_number, code):
+    """Hands the first send to a small worker pool so the request does not wait on the gateway."""
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=settings.SMS_GATEWAY_WORKERS, thread_name_prefix="sms")
+    return _executor.submit(_send, delivery_id, phone_number, code)
@@ -0,0 +1,220 @@
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from dateutil.relativedelta import relativedelta
+from django.db import transaction
+from django.db.models import Case, Count, DateField, F, Max, Q, Sum, Value, When
+from django.db.models.functions import TruncMonth, TruncWeek
+
+from .models import DailyStepCount, PatientCohort, Profile, StepAggregate
+
+PERIODS = ("week", "month", "trimester")
+
+# Trimester buckets as days since LMP, matching users.services.get_trimester (84 and
+# 168 days); the third trimester is closed at 42 weeks.
+TRIMESTER_DAYS = ((1, 0, 84), (2, 84, 168), (3, 168, 294))
+
+
+######## Buckets ########
+
+def _trimesters(lmp_date):
+    return [
+        (number, lmp_date + timedelta(days=start), lmp_date + timedelta(days=end - 1))
+        for number, start, end in TRIMESTER_DAYS
+    ]
+
+
+def bucket_for(period, day, lmp_date=None):
+    """(start, last day, trimester) of the bucket holding `day`, or None outside any trimester."""
+    if period == "week":
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=6), None
+    if period == "month":
+        start = day.replace(day=1)
+        return start, start + relativedelta(months=1, days=-1), None
+    if lmp_date:
+        for number, start, end in _trimesters(lmp_date):
+            if start <= day <= end:
+                return start, end, number
+    return None
+
+
+def _bucket_expression(period, lmp_date=None):
+    if period == "week":
+        return TruncWeek("date")
+    if period == "month":
+        return TruncMonth("date")
+    return Case(
+        *[When(date__range=(start, end), then=Value(start)) for _, start, end in _trimesters(lmp_date)],
+        default=None,
+        output_field=DateField(),
+    )
+
+
+def _totals():
+    return dict(
+        days=Count("id"),
+        total_steps=Sum("steps"),
+        max_steps=Max("steps"),
+        goal_hit_days=Count("id", filter=Q(steps__gte=F("goal_steps"))),
+    )
+
+
+######## Writes ########
+
+def refresh_step_aggregates(patient_id, dates=None, periods=PERIODS):
+    """
+    Recomputes the patient's buckets holding `dates` (all of them when None) with one
+    grouped query per period, and drops buckets that no longer have a step count.
+    """
+    lmp_date = Profile.objects.filter(user_id=patient_id).values_list("lmp_date", flat=True).first()
+    for period in periods:
+        existing = StepAggregate.objects.filter(patient_id=patient_id, period=period)
+        if period == "trimester" and lmp_date is None:
+            existing.delete()
+            continue
+
+        steps = DailyStepCount.objects.filter(patient_id=patient_id).order_by()
+        if dates is not None:
+            buckets = {bucket_for(period, day, lmp_date) for day in dates} - {None}
+            if not buckets:
+                continue
+            steps = steps.filter(reduce(or_, (Q(date__range=(start, end)) for start, end, _ in buckets)))
+            existing = existing.filter(bucket_start__in=[start for start, _, _ in buckets])
+
+        grouped = (
+            steps.annotate(bucket=_bucket_expression(period, lmp_date))
+            .exclude(bucket=None)
+            .values("bucket")
+            .annotate(**_totals())
+        )
+        rows = []
+        for row in grouped:
+            start, end, trimester = bucket_for(period, row["bucket"], lmp_date)
+            rows.append(StepAggregate(
+                patient_id=patient_id,
+                period=period,
+                bucket_start=start,
+                bucket_end=end,
+                trimester=trimester,
+                days=row["days"],
+                total_steps=row["total_steps"],
+                max_steps=row["max_steps"],
+                goal_hit_days=row["goal_hit_days"],
+            ))
+        existing.exclude(bucket_start__in=[row.bucket_start for row in rows]).delete()
+        StepAggregate.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=["patient", "period", "bucket_start"],
+            update_fields=["bucket_end", "trimester", "days", "total_steps", "max_steps", "goal_hit_days", "updated_at"],
+        )
+
+
+def schedule_step_refresh(patient_id, dates):
+    """Refreshes the buckets once the surrounding transaction commits."""
+    dates = set(dates)
+    if patient_id and dates:
+        transaction.on_commit(lambda: refresh_step_aggregates(patient_id, dates))
+
+
+def rebuild_step_aggregates():
+    """Rebuilds every patient's buckets from the daily counts (backfill / repair)."""
+    patient_ids = list(DailyStepCount.objects.order_by().values_list("patient_id", flat=True).distinct())
+    StepAggregate.objects.exclude(patient_id__in=patient_ids).delete()
+    for patient_id in patient_ids:
+        refresh_step_aggregates(patient_id)
+    return len(patient_ids)
+
+
+######## Reads ########
+
+def step_history(patient_id, period, start=None, end=None):
+    """The patient's buckets of `period` overlapping start..end, oldest first."""
+    buckets = StepAggregate.objects.filter(patient_id=patient_id, period=period)
+    if start:
+        buckets = buckets.filter(bucket_end__gte=start)
+    if end:
+        buckets = buckets.filter(bucket_start__lte=end)
+    return buckets.order_by("bucket_start")
+
+
+def _summary(days, total_steps, max_steps, goal_hit_days):
+    return {
+        "days": days,
+        "total_steps": total_steps,
+        "mean_steps": round(total_steps / days) if days else 0,
+        "max_steps": max_steps,
+        "goal_hit_rate": round(goal_hit_days / days, 2) if days else 0,
+    }
+
+
+def step_window_summary(patient_id, start, end):
+    """
+    Totals over an arbitrary window: whole calendar months come from the month buckets,
+    only the days at the edges are read from DailyStepCount.
+    """
+    first_month = start if start.day == 1 else start.replace(day=1) + relativedelta(months=1)
+    after_months = (end + timedelta(days=1)).replace(day=1)
+    parts = []
+    if first_month < after_months:
+        parts.append(
+            StepAggregate.objects.filter(
+                patient_id=patient_id, period="month", bucket_start__gte=first_month, bucket_start__lt=after_months
+            ).aggregate(
+                days=Sum("days"), total_steps=Sum("total_steps"),
+                max_steps=Max("max_steps"), goal_hit_days=Sum("goal_hit_days"),
+            )
+        )
+        edges = Q(date__gte=start, date__lt=first_month) | Q(date__gte=after_months, date__lte=end)
+    else:
+        edges = Q(date__range=(start, end))
+    daily = DailyStepCount.objects.filter(edges, patient_id=patient_id).order_by()
+    parts.append(daily.aggregate(**_totals()))
+
+    return {
+        "start": start,
+        "end": end,
+        **_summary(
+            sum(part["days"] or 0 for part in parts),
+            sum(part["total_steps"] or 0 for part in parts),
+            max((part["max_steps"] or 0 for part in parts), default=0),
+            sum(part["goal_hit_days"] or 0 for part in parts),
+        ),
+    }
+
+
+def cohort_step_summary(doctor, period, start=None, end=None):
+    """
+    The doctor's patients combined per bucket: calendar buckets by start date,
+    trimester buckets by trimester number.
+    """
+    buckets = StepAggregate.objects.filter(
+        period=period,
+        patient_id__in=PatientCohort.objects.filter(doctor=doctor).values("patient_id"),
+    )
+    if start:
+        buckets = buckets.filter(bucket_end__gte=start)
+    if end:
+        buckets = buckets.filter(bucket_start__lte=end)
+    group_by = "trimester" if period == "trimester" else "bucket_start"
+    rows = (
+        buckets.values(group_by)
+        .annotate(
+            patients=Count("patient", distinct=True),
+            days=Sum("days"),
+            total_steps=Sum("total_steps"),
+            max_steps=Max("max_steps"),
+            goal_hit_days=Sum("goal_hit_days"),
+        )
+        .order_by(group_by)
+    )
+    return [
+        {
+            group_by: row[group_by],
+            "patients": row["patients"],
+            **_summary(row["days"], row["total_steps"], row["max_steps"], row["goal_hit_days"]),
+        }
+        for row in rows
+    ]
@@ -0,0 +1,84 @@
+import os
+from uuid import uuid4
+
+from django.conf import settings
+from django.core import signing
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.urls import reverse
+
+DIRECT_UPLOAD_SALT = "users.storage.direct-upload"
+
+# Upload kinds the app may presign, mapped to the upload_to prefix of the field they end up in.
+UPLOAD_KINDS = {
+    "diet_status_audio": ("skkiped/audio/", "audio/"),
+    "exercise_status_audio": ("exercise/audio/", "audio/"),
+    "extra_meal_audio": ("extrameal/audio/", "audio/"),
+    "extra_meal_image": ("extrameal/images/", "image/"),
+    "diet_question_audio": ("diet_questions/audio/", "audio/"),
+}
+
+
+class InvalidUpload(Exception):
+    pass
+
+
+class LocalUploadStorage(FileSystemStorage):
+    """
+    MEDIA_ROOT storage exposing the same presigned upload interface as S3MediaStorage.
+    The upload URL points at DirectUploadView, which streams the request body to disk,
+    so local development and tests exercise the same client flow as the bucket.
+    """
+
+    def presigned_upload(self, key, content_type, max_size, expires):
+        token = signing.dumps(
+            {"key": key, "content_type": content_type, "max_size": max_size},
+            salt=DIRECT_UPLOAD_SALT,
+        )
+        return {
+            "url": reverse("direct-upload", args=[token]),
+            "method": "PUT",
+            "fields": {},
+            "headers": {"Content-Type": content_type},
+        }
+
+    def read_upload_token(self, token):
+        try:
+            return signing.loads(token, salt=DIRECT_UPLOAD_SALT, max_age=settings.PRESIGNED_UPLOAD_EXPIRES)
+        except signing.BadSignature:
+            raise InvalidUpload("Upload link is invalid or has expired.")
+
+
+def create_presigned_upload(user, kind, filename, content_type, size=None):
+    """
+    Reserves a storage key for a direct-to-storage upload and returns how to upload it.
+    The returned `key` is then sent instead of the file (e.g. `audio_reason_key`).
+    """
+    if kind not in UPLOAD_KINDS:
+        raise InvalidUpload(f"Unknown upload kind '{kind}'.")
+    prefix, type_prefix = UPLOAD_KINDS[kind]
+    if not content_type or not content_type.startswith(type_prefix):
+        raise InvalidUpload(f"Content type must be {type_prefix}*.")
+    max_size = settings.PRESIGNED_UPLOAD_MAX_SIZE
+    if size is not None and int(size) > max_size:
+        raise InvalidUpload(f"File is larger than {max_size} bytes.")
+
+    extension = os.path.splitext(filename or "")[1].lower()[:10]
+    key = f"{prefix}{user.id}/{uuid4().hex}{extension}"
+    expires = settings.PRESIGNED_UPLOAD_EXPIRES
+    upload = default_storage.presigned_upload(key, content_type, max_size, expires)
+    return {"key": key, "expires_in": expires, **upload}
+
+
+def claim_uploaded_file(user, kind, key):
+    """
+    Checks that `key` was issued to this user for this kind of upload and that the upload
+    finished. Returns the storage name to assign to the FileField (no bytes are copied).
+    """
+    if kind not in UPLOAD_KINDS:
+        raise InvalidUpload(f"Unknown upload kind '{kind}'.")
+    prefix = f"{UPLOAD_KINDS[kind][0]}{user.id}/"
+    if not isinstance(key, str) or not key.startswith(prefix) or ".." in key:
+        raise InvalidUpload("Upload key does not belong to this user.")
+    if not default_storage.exists(key):
+        raise InvalidUpload("Upload has not been completed.")
+    return key
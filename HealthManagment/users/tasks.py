@@ -0,0 +1,50 @@
+from celery import shared_task
+from .audio import transcode_pending_audio
+from .cohorts import refresh_cohort_buckets
+from .dashboard import rebuild_stale_dashboards
+from .adherence import close_day
+from .blacklist import prune_expired_tokens
+from .nutrition import enrich_pending_nutrition
+from .otp import retry_otp_deliveries
+
+
+@shared_task
+def transcode_voice_notes():
+    """Transcodes pending voice notes (scheduled by celery beat)."""
+    return transcode_pending_audio()
+
+
+@shared_task
+def rebuild_dashboards():
+    """Rebuilds the admin and doctor dashboard snapshots invalidated since the last run (scheduled by celery beat)."""
+    return rebuild_stale_dashboards()
+
+
+@shared_task
+def refresh_patient_cohorts():
+    """Moves cohort rows into today's trimester and due-date buckets (scheduled daily)."""
+    return refresh_cohort_buckets()
+
+
+@shared_task
+def close_adherence_day():
+    """Writes yesterday's adherence rollup for every patient with something planned (scheduled daily)."""
+    return close_day()
+
+
+@shared_task
+def prune_token_blacklist():
+    """Deletes a bounded number of expired outstanding/blacklisted refresh tokens (scheduled hourly)."""
+    return prune_expired_tokens()
+
+
+@shared_task
+def enrich_meal_portions():
+    """Resolves due nutrition lookups and fills the waiting meal portions (scheduled by celery beat)."""
+    return enrich_pending_nutrition()
+
+
+@shared_task
+def retry_otp_sms():
+    """Resends OTP SMS whose earlier send failed (scheduled by celery beat)."""
+    return retry_otp_deliveries()
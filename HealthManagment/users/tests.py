@@ -1,3 +1,815 @@
-from django.test import TestCase
+from datetime import date, timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+from dateutil.relativedelta import relativedelta
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+from notification.models import Notification
+from patient.services import MealStatusError, apply_meal_status_updates, parse_meal_update
+from patient.sync import InvalidSyncToken, apply_sync_operations, build_sync_delta, issue_sync_token, read_sync_token
+
+from .adherence import refresh_patient_adherence
+from .cohorts import doctor_cohort, rebuild_patient_cohorts
+from .dashboard import _mark_stale, build_doctor_dashboard, get_dashboard_snapshot, rebuild_stale_dashboards
+from .blacklist import FilteredRefreshToken, is_blacklisted, notify_blacklisted, revocation_filter
+from .identity import TOKEN_VERSION_CLAIM, identity_token_for
+from .jwt_auth import CookieTokenRefreshSerializer, StatelessJWTAuthentication
+from .models import (
+    CustomUser, DailyAdherence, DailyStepCount, DashboardSnapshot, DietPlan, DietPlanCompletedPortion, DietPlanDate,
+    DietPlanMeal, DietPlanStatus, HealthStatus, MealPortion, Profile, NutritionLookup, OTPDelivery, PatientCohort, SyncOperation,
+)
+from .nutrition import _release_stuck_lookups, enrich_pending_nutrition, queue_nutrition_enrichment
+from .permissions import invalidate_all_permissions
+from .querysets import GESTATIONAL_WEEKS_CAP, age_q, bmi_category_q, gestational_weeks_q, trimester_q
+from .services import get_trimester
+from .steps import refresh_step_aggregates, step_window_summary
+from .otp import OTPError, issue_otp, retry_otp_deliveries, verify_otp
+from .outbound import CircuitBreaker, OutboundClient, ProviderError, ProviderUnavailable
+from .outbound_stubs import StubServer
+from .sms import FakeSMSGateway, deliver_otp
+
+
+def make_user(phone_number="+919999900001", **fields):
+    return CustomUser.objects.create(username=phone_number, phone_number=phone_number, **fields)
+
+
+@override_settings(SHARED_CACHE=True)
+class RevocationFilterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        revocation_filter.reset()
+        self.user = make_user()
+
+    def tearDown(self):
+        revocation_filter.reset()
+
+    def issue(self):
+        return FilteredRefreshToken.for_user(self.user)
+
+    def blacklist(self, token):
+        with self.captureOnCommitCallbacks(execute=True):
+            token.blacklist()
+
+    def test_blacklisted_token_is_revoked(self):
+        token = self.issue()
+        self.blacklist(token)
+        self.assertTrue(is_blacklisted(token["jti"]))
+
+    def test_token_blacklisted_after_load_is_revoked_on_reload(self):
+        token = self.issue()
+        self.assertFalse(is_blacklisted(token["jti"]))
+
+        self.blacklist(token)
+        self.assertTrue(is_blacklisted(token["jti"]))
+
+    def test_row_committed_late_is_picked_up_within_the_overlap(self):
+        first, late = self.issue(), self.issue()
+        self.blacklist(first)
+        self.assertFalse(is_blacklisted(late["jti"]))
+
+        # Blacklisted before the newest row seen, but committed after the filter loaded.
+        row = BlacklistedToken.objects.create(token=OutstandingToken.objects.get(jti=late["jti"]))
+        BlacklistedToken.objects.filter(pk=row.pk).update(
+            blacklisted_at=BlacklistedToken.objects.get(token__jti=first["jti"]).blacklisted_at - timedelta(seconds=5)
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            notify_blacklisted()
+        self.assertTrue(is_blacklisted(late["jti"]))
+        self.assertTrue(is_blacklisted(first["jti"]))
+
+    def test_filter_is_rebuilt_past_its_capacity(self):
+        tokens = [self.issue() for _ in range(3)]
+        with override_settings(TOKEN_BLACKLIST_FILTER_CAPACITY=1):
+            for token in tokens:
+                self.blacklist(token)
+                self.assertTrue(is_blacklisted(token["jti"]))
+        self.assertFalse(is_blacklisted(self.issue()["jti"]))
+
+    @override_settings(SHARED_CACHE=False)
+    def test_without_shared_cache_every_check_reads_the_blacklist(self):
+        token = self.issue()
+        self.assertFalse(is_blacklisted(token["jti"]))
+
+        # No generation change reaches this process; the database still has the row.
+        BlacklistedToken.objects.create(token=OutstandingToken.objects.get(jti=token["jti"]))
+        self.assertTrue(is_blacklisted(token["jti"]))
+
+
+class IdentityClaimTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = make_user(role="doctor")
+
+    def authenticate(self, token):
+        auth = StatelessJWTAuthentication()
+        return auth.get_user(auth.get_validated_token(str(token)))
+
+    def refresh(self, token):
+        request = Request(APIRequestFactory().post("/token/refresh/", {"refresh": str(token)}, format="json"), parsers=[JSONParser()])
+        serializer = CookieTokenRefreshSerializer(data={}, context={"request": request})
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data
+
+    def test_current_token_is_trusted_without_loading_the_user(self):
+        access = identity_token_for(self.user).access_token
+        with self.assertNumQueries(1):
+            user = self.authenticate(access)
+        self.assertEqual(user.role, "doctor")
+
+    def test_claim_change_outdates_issued_tokens(self):
+        access = identity_token_for(self.user).access_token
+        self.user.role = "admin"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+
+        self.assertEqual(CustomUser.objects.get(pk=self.user.pk).token_version, access[TOKEN_VERSION_CLAIM] + 1)
+        self.assertEqual(self.authenticate(access).role, "admin")
+
+    def test_onboarding_flags_do_not_outdate_tokens(self):
+        version = self.user.token_version
+        self.user.is_first_login = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertEqual(CustomUser.objects.get(pk=self.user.pk).token_version, version)
+
+    def test_refresh_issues_the_current_claims(self):
+        refresh = identity_token_for(self.user)
+        self.user.is_staff = True
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+
+        access = AccessToken(self.refresh(refresh)["access"])
+        current = CustomUser.objects.get(pk=self.user.pk)
+        self.assertEqual(access[TOKEN_VERSION_CLAIM], current.token_version)
+        self.assertTrue(access["is_staff"])
+
+    def test_inactive_user_cannot_refresh(self):
+        refresh = identity_token_for(self.user)
+        CustomUser.objects.filter(pk=self.user.pk).update(is_active=False)
+        with self.assertRaises(AuthenticationFailed):
+            self.refresh(refresh)
+
+
+@override_settings(OTP_MAX_ATTEMPTS=3, OTP_RESEND_SECONDS=30, OTP_EXPIRE_MINUTES=10)
+class OTPTests(TestCase):
+    def setUp(self):
+        self.user = make_user()
+
+    def issue(self, code="123456"):
+        with mock.patch("users.otp._new_code", return_value=code):
+            return issue_otp(self.user)
+
+    def allow_resend(self):
+        CustomUser.objects.filter(pk=self.user.pk).update(sent=None)
+
+    def test_issued_code_verifies_once(self):
+        delivery = self.issue()
+        self.assertEqual(delivery.status, "pending")
+        self.assertNotEqual(CustomUser.objects.get(pk=self.user.pk).security_code, "123456")
+
+        self.assertTrue(verify_otp(self.user, "123456"))
+        with self.assertRaisesMessage(OTPError, "OTP has expired"):
+            verify_otp(self.user, "123456")
+
+    def test_code_is_checked_against_the_database_not_the_instance(self):
+        self.issue()
+        # Another worker loads its own instance of the user.
+        self.assertTrue(verify_otp(CustomUser.objects.get(pk=self.user.pk), "123456"))
+
+    def test_expired_code_is_refused(self):
+        self.issue()
+        CustomUser.objects.filter(pk=self.user.pk).update(sent=self.user.date_joined - timedelta(minutes=11))
+        with self.assertRaisesMessage(OTPError, "OTP has expired"):
+            verify_otp(self.user, "123456")
+
+    def test_wrong_guesses_are_limited_per_code(self):
+        self.issue()
+        for _ in range(3):
+            with self.assertRaisesMessage(OTPError, "Invalid OTP"):
+                verify_otp(self.user, "000000")
+        with self.assertRaises(OTPError) as raised:
+            verify_otp(self.user, "123456")
+        self.assertEqual(raised.exception.status_code, 429)
+        # The code is gone; only a new one helps.
+        with self.assertRaisesMessage(OTPError, "OTP has expired"):
+            verify_otp(self.user, "123456")
+
+        self.allow_resend()
+        self.issue("654321")
+        self.assertTrue(verify_otp(self.user, "654321"))
+
+    def test_resend_is_throttled(self):
+        self.issue()
+        with self.assertRaises(OTPError) as raised:
+            self.issue("654321")
+        self.assertEqual(raised.exception.status_code, 429)
+        self.assertEqual(OTPDelivery.objects.filter(user=self.user).count(), 1)
+        self.assertTrue(verify_otp(self.user, "123456"))
+
+    def test_new_code_replaces_the_previous_one(self):
+        self.issue()
+        self.allow_resend()
+        self.issue("654321")
+        with self.assertRaisesMessage(OTPError, "Invalid OTP"):
+            verify_otp(self.user, "123456")
+        self.assertTrue(verify_otp(self.user, "654321"))
+
+    def test_full_save_of_a_stale_instance_keeps_the_otp_state(self):
+        stale = CustomUser.objects.get(pk=self.user.pk)
+        self.issue()
+        stale.first_name = "Asha"
+        stale.save()
+        self.assertTrue(verify_otp(self.user, "123456"))
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("users.outbound.time.monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+
+    def fail(self, times):
+        for _ in range(times):
+            self.breaker.record_failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail(2)
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertTrue(self.breaker.allow())
+        self.fail(1)
+        self.assertEqual(self.breaker.state, "open")
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets_the_failure_count(self):
+        self.fail(2)
+        self.breaker.record_success()
+        self.fail(2)
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_half_open_lets_one_trial_through(self):
+        self.fail(3)
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, "half_open")
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_trial_opens_the_circuit_again(self):
+        self.fail(3)
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.fail(1)
+        self.assertEqual(self.breaker.state, "open")
+        self.now += 29
+        self.assertFalse(self.breaker.allow())
+        self.now += 1
+        self.assertTrue(self.breaker.allow())
+
+
+class OutboundClientTests(SimpleTestCase):
+    def make_client(self, stub):
+        return OutboundClient(
+            "stub", stub.base_url, connect_timeout=1, read_timeout=1, max_concurrency=2,
+            acquire_timeout=0.1, failure_threshold=2, reset_timeout=60,
+        )
+
+    def test_failing_provider_trips_the_breaker(self):
+        with StubServer(failure_rate=1) as stub:
+            client = self.make_client(stub)
+            for _ in range(2):
+                with self.assertRaises(ProviderError):
+                    client.get("/cgi/search.pl")
+            with self.assertRaises(ProviderUnavailable):
+                client.get("/cgi/search.pl")
+            self.assertEqual(len(stub.requests), 2)
+
+        snapshot = client.snapshot()
+        self.assertEqual(snapshot["circuit"], "open")
+        self.assertEqual((snapshot["error"], snapshot["rejected"]), (2, 1))
+
+    def test_successful_calls_are_counted(self):
+        with StubServer() as stub:
+            client = self.make_client(stub)
+            self.assertEqual(client.get("/cgi/search.pl", params={"search_terms": "rice"}).status_code, 200)
+        self.assertEqual(client.snapshot()["ok"], 1)
+
+
+class FailingSMSGateway:
+    def send_otp(self, phone_number, code):
+        raise ProviderUnavailable("msg91: circuit is open")
+
+
+@override_settings(SMS_MAX_ATTEMPTS=3)
+class OTPDeliveryRetryTests(TestCase):
+    def setUp(self):
+        FakeSMSGateway.reset()
+        self.user = make_user()
+        self.delivery = issue_otp(self.user)
+        # What the request's worker pool does with the first attempt.
+        OTPDelivery.objects.filter(pk=self.delivery.pk).update(status="processing", attempts=1)
+
+    def use_gateway(self, gateway):
+        patcher = mock.patch("users.sms.get_sms_gateway", return_value=gateway)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_due(self):
+        OTPDelivery.objects.filter(pk=self.delivery.pk).update(next_attempt_at=timezone.now())
+
+    def test_failed_send_is_rescheduled_with_backoff(self):
+        self.use_gateway(FailingSMSGateway())
+        self.assertFalse(deliver_otp(self.delivery.pk, 1, "+919999900001", "123456"))
+        self.delivery.refresh_from_db()
+        self.assertEqual(self.delivery.status, "pending")
+        self.assertGreaterEqual(self.delivery.next_attempt_at, self.delivery.created_at)
+        self.assertIn("circuit is open", self.delivery.last_error)
+
+        # Not due yet.
+        self.assertEqual(retry_otp_deliveries()["retried"], 0)
+
+    def test_retry_sends_a_fresh_code_that_verifies(self):
+        self.use_gateway(FailingSMSGateway())
+        deliver_otp(self.delivery.pk, 1, "+919999900001", "123456")
+        self.use_gateway(FakeSMSGateway())
+        self.make_due()
+
+        self.assertEqual(retry_otp_deliveries(), {"retried": 1, "sent": 1, "dropped": 0})
+        self.delivery.refresh_from_db()
+        self.assertEqual((self.delivery.status, self.delivery.attempts), ("sent", 2))
+        self.assertTrue(verify_otp(self.user, FakeSMSGateway.last_code("+919999900001")))
+
+    def test_gives_up_after_max_attempts(self):
+        self.use_gateway(FailingSMSGateway())
+        deliver_otp(self.delivery.pk, 1, "+919999900001", "123456")
+        for _ in range(2):
+            self.make_due()
+            retry_otp_deliveries()
+        self.delivery.refresh_from_db()
+        self.assertEqual((self.delivery.status, self.delivery.attempts), ("failed", 3))
+        self.make_due()
+        self.assertEqual(retry_otp_deliveries()["retried"], 0)
+
+    def test_retry_of_a_replaced_code_is_dropped(self):
+        self.use_gateway(FailingSMSGateway())
+        deliver_otp(self.delivery.pk, 1, "+919999900001", "123456")
+        CustomUser.objects.filter(pk=self.user.pk).update(sent=None)
+        issue_otp(self.user)
+        self.make_due()
+        stats = retry_otp_deliveries()
+        self.assertEqual((stats["retried"], stats["dropped"]), (0, 1))
+
+
+@override_settings(NUTRITION_MAX_ATTEMPTS=3)
+class NutritionEnrichmentTests(TestCase):
+    def setUp(self):
+        self.portion = MealPortion.objects.create(name="Brown Rice")
+        queue_nutrition_enrichment([self.portion])
+        self.lookup = NutritionLookup.objects.get()
+
+    def test_found_lookup_fills_waiting_portions(self):
+        with mock.patch("users.nutrition.fetch_nutrition_data", return_value={"calories": 111.0}):
+            stats = enrich_pending_nutrition()
+        self.assertEqual((stats["found"], stats["portions"]), (1, 1))
+        self.portion.refresh_from_db()
+        self.assertEqual((self.portion.calories, self.portion.nutrition_lookup), (111.0, None))
+
+    def test_invalid_response_is_retried_with_backoff(self):
+        with mock.patch("users.nutrition.fetch_nutrition_data", side_effect=ValueError("Expecting value")):
+            self.assertEqual(enrich_pending_nutrition()["retry"], 1)
+        self.lookup.refresh_from_db()
+        self.assertEqual((self.lookup.status, self.lookup.attempts), ("pending", 1))
+        self.assertTrue(self.lookup.error.startswith("Invalid response"))
+        self.assertGreater(self.lookup.next_attempt_at, timezone.now())
+        self.assertEqual(enrich_pending_nutrition()["lookups"], 0)
+
+    def test_lookup_resolved_while_portions_are_linked_is_applied(self):
+        portion = MealPortion.objects.create(name="brown rice!")
+        resolved = []
+
+        def enricher_lands_first(execute, sql, params, many, context):
+            # The enricher resolves the lookup right before the new portion is linked to it.
+            if not resolved and sql.startswith('UPDATE "users_mealportion" SET "nutrition_lookup_id"'):
+                resolved.append(True)
+                NutritionLookup.objects.filter(pk=self.lookup.pk).update(
+                    status="found", data={"calories": 111.0}, expires_at=timezone.now() + timedelta(days=1)
+                )
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(enricher_lands_first):
+            self.assertEqual(queue_nutrition_enrichment([portion]), 0)
+        portion.refresh_from_db()
+        self.assertEqual((portion.calories, portion.nutrition_lookup), (111.0, None))
+
+    def test_stuck_lookups_are_released_or_failed(self):
+        claimed_at = timezone.now() - timedelta(hours=1)
+        NutritionLookup.objects.filter(pk=self.lookup.pk).update(status="processing", attempts=1, claimed_at=claimed_at)
+        _release_stuck_lookups()
+        self.lookup.refresh_from_db()
+        self.assertEqual(self.lookup.status, "pending")
+
+        NutritionLookup.objects.filter(pk=self.lookup.pk).update(status="processing", attempts=3, claimed_at=claimed_at)
+        _release_stuck_lookups()
+        self.lookup.refresh_from_db()
+        self.assertEqual(self.lookup.status, "failed")
+        self.assertGreater(self.lookup.expires_at, timezone.now())
+        self.assertFalse(MealPortion.objects.filter(nutrition_lookup=self.lookup).exists())
+
+
+class AdherenceStreakTests(TestCase):
+    def setUp(self):
+        self.patient = make_user(role="patient")
+        plan = DietPlan.objects.create(patient=self.patient, doctor=make_user("+919999900002", role="doctor"))
+        self.meal = DietPlanMeal.objects.create(diet_plan=plan, meal_type="breakfast")
+        self.days = [date.today() - timedelta(days=offset) for offset in (2, 1, 0)]
+        for day in self.days:
+            DietPlanDate.objects.create(diet_plan=plan, date=day)
+
+    def complete(self, day):
+        DietPlanStatus.objects.create(patient=self.patient, diet_plan=self.meal, date=day, status="completed")
+
+    def streaks(self):
+        return list(DailyAdherence.objects.filter(patient=self.patient).order_by("date").values_list("diet_streak", flat=True))
+
+    def test_refresh_of_days_apart_carries_the_days_between(self):
+        first, middle, last = self.days
+        for day in (middle, last):
+            self.complete(day)
+        refresh_patient_adherence(self.patient.id, [middle, last])
+        self.assertEqual(self.streaks(), [1, 2])
+
+        self.complete(first)
+        refresh_patient_adherence(self.patient.id, [first, last])
+        self.assertEqual(self.streaks(), [1, 2, 3])
+
+
+class DashboardSnapshotTests(TestCase):
+    def setUp(self):
+        self.doctor = make_user("+919999900002", role="doctor")
+        self.admin = make_user("+919999900003", role="admin")
+        self.patient = make_user(role="patient")
+        with self.captureOnCommitCallbacks(execute=True):
+            plan = DietPlan.objects.create(patient=self.patient, doctor=self.doctor)
+        self.meal = DietPlanMeal.objects.create(diet_plan=plan, meal_type="breakfast")
+        for user in (self.doctor, self.admin, self.patient):
+            get_dashboard_snapshot(user)
+
+    def snapshot(self, scope):
+        return DashboardSnapshot.objects.get(scope=scope)
+
+    def skip_meal(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            DietPlanStatus.objects.create(
+                patient=self.patient, diet_plan=self.meal, date=timezone.now().date(), status="skipped"
+            )
+
+    def test_patient_write_marks_the_affected_rows_stale(self):
+        versions = {scope: self.snapshot(scope).version for scope in ("admin", "doctor", "patient")}
+        self.skip_meal()
+        for scope, version in versions.items():
+            snapshot = self.snapshot(scope)
+            self.assertTrue(snapshot.is_stale)
+            self.assertIsNotNone(snapshot.stale_since)
+            self.assertEqual(snapshot.version, version + 1)
+
+    def test_stale_doctor_row_is_served_until_the_task_rebuilds_it(self):
+        self.skip_meal()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_dashboard_snapshot(self.doctor)["diet_missed_today"], 0)
+
+        self.assertEqual(rebuild_stale_dashboards(), 2)
+        self.assertFalse(self.snapshot("doctor").is_stale)
+        self.assertEqual(get_dashboard_snapshot(self.doctor)["diet_missed_today"], 1)
+        self.assertEqual(rebuild_stale_dashboards(), 0)
+
+    def test_stale_patient_row_is_rebuilt_on_read(self):
+        self.skip_meal()
+        self.assertEqual(get_dashboard_snapshot(self.patient)["today_meals"], {"skipped": 1})
+        self.assertFalse(self.snapshot("patient").is_stale)
+
+    def test_row_invalidated_during_the_rebuild_stays_stale(self):
+        self.skip_meal()
+
+        def build_while_written(user):
+            data = build_doctor_dashboard(user)
+            _mark_stale(Q(scope="doctor"))
+            return data
+
+        with mock.patch.dict("users.dashboard.SNAPSHOT_BUILDERS", doctor=build_while_written):
+            rebuild_stale_dashboards()
+        snapshot = self.snapshot("doctor")
+        self.assertTrue(snapshot.is_stale)
+        self.assertEqual(snapshot.data["diet_missed_today"], 1)
+
+        rebuild_stale_dashboards()
+        self.assertFalse(self.snapshot("doctor").is_stale)
+
+    @override_settings(DASHBOARD_STALE_SECONDS=60)
+    def test_request_rebuilds_a_row_the_task_left_behind(self):
+        self.skip_meal()
+        DashboardSnapshot.objects.filter(scope="doctor").update(stale_since=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(get_dashboard_snapshot(self.doctor)["diet_missed_today"], 1)
+        self.assertFalse(self.snapshot("doctor").is_stale)
+
+
+class PatientSyncTests(TestCase):
+    def setUp(self):
+        invalidate_all_permissions()
+        group = Group.objects.create(name="patient")
+        group.permissions.set(Permission.objects.filter(codename="add_dietplanstatus"))
+        self.patient = make_user(role="patient")
+        self.patient.groups.add(group)
+        self.today = timezone.now().date()
+        self.plan = DietPlan.objects.create(patient=self.patient, doctor=make_user("+919999900002", role="doctor"))
+        self.meal = DietPlanMeal.objects.create(diet_plan=self.plan, meal_type="breakfast")
+        self.plan_date = DietPlanDate.objects.create(diet_plan=self.plan, date=self.today)
+
+    def tearDown(self):
+        invalidate_all_permissions()
+
+    def steps(self, key, steps):
+        return {"key": key, "type": "steps", "data": {"date": str(self.today), "steps": steps, "source": "manual"}}
+
+    def test_replayed_key_returns_the_stored_outcome(self):
+        [first] = apply_sync_operations(self.patient, [self.steps("k1", 4200)])
+        self.assertEqual(first, {"key": "k1", "status": "applied"})
+
+        [replayed] = apply_sync_operations(self.patient, [self.steps("k1", 9000)])
+        self.assertEqual(replayed, {"key": "k1", "status": "applied", "replayed": True})
+        self.assertEqual(DailyStepCount.objects.get(patient=self.patient).steps, 4200)
+
+    def test_same_key_twice_in_a_batch_is_applied_once(self):
+        results = apply_sync_operations(self.patient, [self.steps("k1", 4200), self.steps("k1", 9000)])
+        self.assertEqual([r["status"] for r in results], ["applied", "applied"])
+        self.assertTrue(results[1]["replayed"])
+        self.assertEqual(DailyStepCount.objects.get(patient=self.patient).steps, 4200)
+        self.assertEqual(SyncOperation.objects.filter(patient=self.patient).count(), 1)
+
+    def test_rejected_operation_is_stored_and_does_not_block_the_batch(self):
+        bad = {"key": "k2", "type": "diet_status", "data": {"diet_plan": 999, "status": "completed", "date": str(self.today)}}
+        good = {"key": "k3", "type": "diet_status", "data": {"diet_plan": self.meal.id, "status": "skipped", "date": str(self.today)}}
+        rejected, applied = apply_sync_operations(self.patient, [bad, good])
+        self.assertEqual((rejected["status"], rejected["error"]), ("rejected", "Meal ID 999 not found."))
+        self.assertEqual(applied["status"], "applied")
+        self.assertEqual(DietPlanStatus.objects.get(patient=self.patient).status, "skipped")
+
+        [replayed] = apply_sync_operations(self.patient, [bad])
+        self.assertEqual((replayed["status"], replayed["error"], replayed["replayed"]), ("rejected", "Meal ID 999 not found.", True))
+
+    def test_delta_lists_records_deleted_since_the_token(self):
+        since = timezone.now()
+        other_date = DietPlanDate.objects.create(diet_plan=self.plan, date=self.today + timedelta(days=1))
+        notification = Notification.objects.create(user=self.patient, title="Title", message="Message")
+        date_id, notification_id, plan_id = other_date.pk, notification.pk, self.plan.pk
+        other_date.delete()
+        notification.delete()
+        deleted = build_sync_delta(self.patient, since)["deleted"]
+        self.assertEqual(deleted["diet_dates"], [date_id])
+        self.assertEqual(deleted["notifications"], [notification_id])
+
+        # The plan's remaining dates go with it and are only listed through the plan.
+        self.plan.delete()
+        deleted = build_sync_delta(self.patient, since)["deleted"]
+        self.assertEqual(deleted["diet_plans"], [plan_id])
+        self.assertEqual(deleted["diet_dates"], [date_id])
+        self.assertEqual(build_sync_delta(self.patient, timezone.now())["deleted"]["diet_plans"], [])
+
+    @override_settings(PATIENT_SYNC_TOMBSTONE_DAYS=30)
+    def test_token_older_than_the_tombstones_is_refused(self):
+        moment = timezone.now()
+        self.assertEqual(read_sync_token(issue_sync_token(moment)), moment)
+
+        with mock.patch("django.core.signing.time.time", return_value=(moment - timedelta(days=31)).timestamp()):
+            token = issue_sync_token(moment - timedelta(days=31))
+        with self.assertRaisesMessage(InvalidSyncToken, "Sync token has expired"):
+            read_sync_token(token)
+        with self.assertRaisesMessage(InvalidSyncToken, "Invalid sync token."):
+            read_sync_token(token + "x")
+
+
+class MealStatusUpdateTests(TestCase):
+    def setUp(self):
+        self.patient = make_user(role="patient")
+        self.today = timezone.now().date()
+        plan = DietPlan.objects.create(patient=self.patient, doctor=make_user("+919999900002", role="doctor"))
+        DietPlanDate.objects.create(diet_plan=plan, date=self.today)
+        self.rice, self.dal, self.eggs = (MealPortion.objects.create(name=name) for name in ("Rice", "Dal", "Eggs"))
+        self.lunch = DietPlanMeal.objects.create(diet_plan=plan, meal_type="lunch")
+        self.lunch.meal_portions.set([self.rice, self.dal])
+        self.breakfast = DietPlanMeal.objects.create(diet_plan=plan, meal_type="breakfast")
+        self.breakfast.meal_portions.set([self.eggs])
+
+    def update(self, meal, status="completed", portions=(), day=None):
+        data = {"diet_plan": meal.id, "status": status, "date": str(day or self.today), "selected_portions": list(portions)}
+        return parse_meal_update(data, {}, self.patient)
+
+    def test_batch_writes_every_meal_with_its_portions(self):
+        apply_meal_status_updates(self.patient, [
+            self.update(self.lunch, portions=[self.rice.id, self.dal.id]),
+            self.update(self.breakfast, portions=[self.eggs.id]),
+        ])
+        self.assertEqual(DietPlanStatus.objects.filter(patient=self.patient, status="completed").count(), 2)
+        completed = DietPlanCompletedPortion.objects.filter(patient=self.patient)
+        self.assertEqual(
+            set(completed.values_list("diet_plan_meal_id", "portion_id")),
+            {(self.lunch.id, self.rice.id), (self.lunch.id, self.dal.id), (self.breakfast.id, self.eggs.id)},
+        )
+
+    def test_batch_rejects_a_portion_of_another_meal(self):
+        with self.assertRaisesMessage(MealStatusError, f"Portion ID {self.eggs.id} is not part of meal {self.lunch.id}."):
+            apply_meal_status_updates(self.patient, [
+                self.update(self.breakfast, portions=[self.eggs.id]),
+                self.update(self.lunch, portions=[self.rice.id, self.eggs.id]),
+            ])
+        self.assertFalse(DietPlanStatus.objects.exists())
+        self.assertFalse(DietPlanCompletedPortion.objects.exists())
+
+    def test_resubmitted_meal_replaces_its_status_and_portions(self):
+        apply_meal_status_updates(self.patient, [self.update(self.lunch, portions=[self.rice.id, self.dal.id])])
+        apply_meal_status_updates(self.patient, [
+            self.update(self.lunch, portions=[self.rice.id]),
+            self.update(self.lunch, status="skipped"),
+        ])
+        self.assertEqual(DietPlanStatus.objects.get(diet_plan=self.lunch).status, "skipped")
+
+        apply_meal_status_updates(self.patient, [self.update(self.lunch, portions=[self.dal.id])])
+        self.assertEqual(list(DietPlanCompletedPortion.objects.values_list("portion_id", flat=True)), [self.dal.id])
+
+    def test_meal_must_be_assigned_on_the_date(self):
+        with self.assertRaises(MealStatusError) as raised:
+            apply_meal_status_updates(self.patient, [self.update(self.lunch, day=self.today - timedelta(days=1))])
+        self.assertEqual(raised.exception.status_code, 403)
+
+    def test_old_dates_cannot_be_edited(self):
+        with self.assertRaises(MealStatusError) as raised:
+            self.update(self.lunch, day=self.today - timedelta(days=3))
+        self.assertEqual(raised.exception.status_code, 403)
+
+
+class PatientCohortTests(TestCase):
+    def setUp(self):
+        self.patient = make_user(role="patient")
+        self.doctors = [make_user(f"+91999990000{i}", role="doctor") for i in (2, 3)]
+
+    def cohort(self):
+        return dict(PatientCohort.objects.filter(patient=self.patient).values_list("doctor_id", "trimester"))
+
+    def set_lmp(self, days_ago):
+        profile = self.patient.profile
+        profile.lmp_date = date.today() - timedelta(days=days_ago)
+        profile.save()
+
+    def test_rows_follow_diet_plans(self):
+        first, second = self.doctors
+        plans = [DietPlan.objects.create(patient=self.patient, doctor=first) for _ in range(2)]
+        DietPlan.objects.create(patient=self.patient, doctor=second)
+        self.assertEqual(set(self.cohort()), {first.id, second.id})
+
+        plans[0].delete()
+        self.assertEqual(set(self.cohort()), {first.id, second.id})
+        plans[1].delete()
+        self.assertEqual(set(self.cohort()), {second.id})
+
+    def test_rows_follow_lmp_and_health_status(self):
+        self.set_lmp(100)
+        DietPlan.objects.create(patient=self.patient, doctor=self.doctors[0])
+        self.assertEqual(self.cohort(), {self.doctors[0].id: 2})
+
+        self.set_lmp(10)
+        HealthStatus.objects.create(patient=self.patient, health_status="Critical")
+        row = PatientCohort.objects.get(patient=self.patient)
+        self.assertEqual((row.trimester, row.due_bucket, row.health_status), (1, "later", "Critical"))
+
+    def test_doctor_cohort_moves_rows_into_todays_buckets(self):
+        self.set_lmp(83)
+        DietPlan.objects.create(patient=self.patient, doctor=self.doctors[0])
+        PatientCohort.objects.update(buckets_on=date.today() - timedelta(days=1), trimester=None)
+        self.assertEqual(doctor_cohort(self.doctors[0]).get().trimester, 1)
+        self.assertEqual(doctor_cohort(self.doctors[0], date.today() + timedelta(days=1)).get().trimester, 2)
+
+    def test_rebuild_matches_the_diet_plans(self):
+        self.set_lmp(200)
+        DietPlan.objects.create(patient=self.patient, doctor=self.doctors[0])
+        PatientCohort.objects.all().delete()
+        PatientCohort.objects.create(patient=self.patient, doctor=self.doctors[1])
+
+        rebuild_patient_cohorts()
+        self.assertEqual(self.cohort(), {self.doctors[0].id: 3})
+
+
+class ProfileMetricTests(TestCase):
+    """The SQL expressions in users.querysets against the Profile properties, at their bucket edges."""
+
+    def profiles(self, field_values):
+        ids = []
+        for i, fields in enumerate(field_values):
+            user = make_user(f"+9199999{i:05d}", role="patient")
+            Profile.objects.filter(user=user).update(**fields)
+            ids.append(user.profile.pk)
+        return list(Profile.objects.filter(pk__in=ids).with_metrics().order_by("pk"))
+
+    def test_pregnancy_month_and_trimester(self):
+        offsets = [-1, 0, 27, 28, 55, 56, 83, 84, 111, 112, 167, 168, 223, 224, 400]
+        today = date.today()
+        for profile in self.profiles({"lmp_date": today - timedelta(days=days)} for days in offsets):
+            with self.subTest(lmp_date=profile.lmp_date):
+                self.assertEqual(profile.pregnancy_month_num, max(profile.pregnancy_month, 0))
+                self.assertEqual(profile.trimester, get_trimester(profile))
+                for trimester in (1, 2, 3):
+                    in_bucket = Profile.objects.filter(trimester_q(trimester), pk=profile.pk).exists()
+                    self.assertEqual(in_bucket, get_trimester(profile) == trimester)
+
+    def test_gestational_weeks(self):
+        offsets = [0, 6, 7, 13, 14, 7 * GESTATIONAL_WEEKS_CAP - 1, 7 * GESTATIONAL_WEEKS_CAP, 7 * GESTATIONAL_WEEKS_CAP + 30]
+        today = date.today()
+        for profile in self.profiles({"lmp_date": today - timedelta(days=days)} for days in offsets):
+            weeks = int(profile.gestational_age.split()[0])
+            with self.subTest(lmp_date=profile.lmp_date):
+                self.assertEqual(profile.gestational_weeks, min(weeks, GESTATIONAL_WEEKS_CAP))
+                in_range = Profile.objects.filter(gestational_weeks_q(min_weeks=1, max_weeks=2), pk=profile.pk).exists()
+                self.assertEqual(in_range, 1 <= weeks <= 2)
+
+    def test_age(self):
+        today = date.today()
+        born = [today - relativedelta(years=30) + timedelta(days=days) for days in (-1, 0, 1)]
+        for profile in self.profiles({"date_of_birth": day} for day in born):
+            with self.subTest(date_of_birth=profile.date_of_birth):
+                self.assertEqual(profile.age_years, profile.age)
+                in_range = Profile.objects.filter(age_q(min_age=30, max_age=30), pk=profile.pk).exists()
+                self.assertEqual(in_range, profile.age == 30)
+
+    def test_bmi_category(self):
+        # A height of 1 m makes the BMI equal to the weight.
+        weights = [18.49, 18.5, 24.89, 24.9, 24.99, 25.0, 29.89, 29.9, 40.0]
+        values = [{"height": 100, "weight": weight} for weight in weights]
+        for profile in self.profiles(values + [{"height": 162, "weight": 48.5}, {"height": None, "weight": 60}]):
+            with self.subTest(height=profile.height, weight=profile.weight):
+                self.assertEqual(profile.bmi_category_name, profile.bmi_category)
+                for category in ("Underweight", "Normal weight", "Overweight", "Obese"):
+                    in_bucket = Profile.objects.filter(bmi_category_q(category), pk=profile.pk).exists()
+                    self.assertEqual(in_bucket, profile.bmi_category == category)
+
+
+class StepWindowSummaryTests(TestCase):
+    def setUp(self):
+        self.patient = make_user(role="patient")
+        first = date(2026, 1, 20)
+        DailyStepCount.objects.bulk_create([
+            DailyStepCount(
+                patient=self.patient, date=first + timedelta(days=i), steps=3000 + 97 * i, goal_steps=6000, source="manual"
+            )
+            for i in range(81)
+        ])
+        refresh_step_aggregates(self.patient.id)
+
+    def expected(self, start, end):
+        steps = list(
+            DailyStepCount.objects.filter(patient=self.patient, date__range=(start, end)).values_list("steps", "goal_steps")
+        )
+        total, hits = sum(s for s, _ in steps), sum(s >= goal for s, goal in steps)
+        return {
+            "start": start,
+            "end": end,
+            "days": len(steps),
+            "total_steps": total,
+            "mean_steps": round(total / len(steps)),
+            "max_steps": max(s for s, _ in steps),
+            "goal_hit_rate": round(hits / len(steps), 2),
+        }
+
+    def test_windows_split_at_month_edges(self):
+        windows = [
+            (date(2026, 1, 25), date(2026, 3, 31)),  # leading days, then whole months
+            (date(2026, 2, 1), date(2026, 2, 28)),   # exactly one month
+            (date(2026, 2, 10), date(2026, 2, 20)),  # inside a month
+            (date(2026, 1, 31), date(2026, 3, 1)),   # one day on either side of a month
+            (date(2026, 3, 15), date(2026, 4, 5)),   # across a month end, no whole month
+        ]
+        for start, end in windows:
+            with self.subTest(start=start, end=end):
+                self.assertEqual(step_window_summary(self.patient.id, start, end), self.expected(start, end))
+
+    def test_whole_months_are_read_from_the_month_buckets(self):
+        DailyStepCount.objects.filter(patient=self.patient, date=date(2026, 2, 14)).update(steps=50000)
+        stale = step_window_summary(self.patient.id, date(2026, 1, 31), date(2026, 3, 1))
+        self.assertLess(stale["max_steps"], 50000)
+
+        refresh_step_aggregates(self.patient.id, [date(2026, 2, 14)])
+        summary = step_window_summary(self.patient.id, date(2026, 1, 31), date(2026, 3, 1))
+        self.assertEqual(summary, self.expected(date(2026, 1, 31), date(2026, 3, 1)))
+        self.assertEqual(summary["max_steps"], 50000)
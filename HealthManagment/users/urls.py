@@ -3,8 +3,9 @@ from rest_framework.routers import DefaultRouter
 from .views import ( ExerciseListCreateView,ExerciseDetailView,HealthEducationViewSet,
  SendOrResendSMSAPIView,AdminCreateView,DoctorListCreateView,DoctorDetailView,
  UserListCreateView, UserDetailView,QuestionListCreateView, QuestionDetailView, ProfileAPIView,
- CustomLoginView,SyncStepsView, TodayStepsView, WeeklyStepsView,AppContentView,HelpContentViewSet,
- AcceptLegalView,AdminDietPlanListView,AdminDoctorDietPlansView,AdminDoctorPatientsView,DashboardView
+ CustomLoginView,SyncStepsView, TodayStepsView, WeeklyStepsView, StepHistoryView, StepSummaryView, CohortStepsView,AppContentView,HelpContentViewSet,
+ AcceptLegalView,AdminDietPlanListView,AdminDoctorDietPlansView,AdminDoctorPatientsView,DashboardView,
+ PermissionCacheStatsView, OutboundStatsView
 )
 from doctor.views import MealPortionViewSet
 app_name = 'users'
@@ -31,11 +32,17 @@ urlpatterns = [
     path('exercises/<int:pk>/', ExerciseDetailView.as_view(), name='exercise-detail'),
     
     
+    path('permissions/cache-stats/', PermissionCacheStatsView.as_view(), name='permission-cache-stats'),
+    path('outbound/stats/', OutboundStatsView.as_view(), name='outbound-stats'),
+
     path("legal-accept/", AcceptLegalView.as_view()),
     path("app-content/", AppContentView.as_view()),
     path("steps/sync/", SyncStepsView.as_view()),
     path("steps/today/", TodayStepsView.as_view()),
     path("steps/weekly/", WeeklyStepsView.as_view()),
+    path("steps/history/", StepHistoryView.as_view()),
+    path("steps/summary/", StepSummaryView.as_view()),
+    path("steps/cohort/", CohortStepsView.as_view()),
     
     path('dietplans/', AdminDietPlanListView.as_view(), name='admin-dietplan-list'),
     path('doctors/<int:doctor_id>/dietplans/', AdminDoctorDietPlansView.as_view(), name='admin-doctor-dietplans'),
@@ -8,15 +8,14 @@ from .serializers import ( ExerciseSerializer, ProfileSerializer, HealthEducatio
                         PhoneNumberSerializer,HelpContentSerializer,LegalConsentSerializer,DoctorPatientResponseSerializer,DoctorQuestionResponseSerializer
                         )
 from doctor.serializers import DietPlanReadSerializer, DietPlanCreateSerializer
-from django.db.models import Count,Avg,F
+from django.db.models import Count,Avg,F,Max,Q
 from django.contrib.auth.models import Group
 from rest_framework import views, status
 from rest_framework.response import Response
 from rest_framework.generics import GenericAPIView
 from rest_framework.permissions import AllowAny
 from dj_rest_auth.views import LoginView
-from datetime import date
-from rest_framework_simplejwt.tokens import RefreshToken
+from datetime import date, datetime, time
 from rest_framework.authentication import authenticate
 from .decryption import decrypt_password
 from rest_framework.views import APIView
@@ -24,14 +23,19 @@ from django.conf import settings
 from django.contrib.auth import logout as django_logout
 from django.core.exceptions import ObjectDoesNotExist
 from drf_spectacular.utils import extend_schema
-from users.permissions import PermissionsManager,IsSuperAdmin, IsAdmin, IsAdminOrSuperAdmin
+from users.permissions import PermissionsManager,IsSuperAdmin, IsAdmin, IsAdminOrSuperAdmin, IsDoctorUser, permission_cache_stats
 from rest_framework import viewsets
 from django.contrib.auth.hashers import make_password
 from django.utils.crypto import get_random_string
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.exceptions import NotAuthenticated
-from .utils import send_otp, verify_otp
+from rest_framework.exceptions import NotAuthenticated, ValidationError
+from .otp import OTPError, issue_otp
+from .outbound import outbound_stats
 from .pagination import Pagination
+from .identity import identity_token_for
+from .storage import InvalidUpload, create_presigned_upload
+from django.core.files import File
+from django.core.files.storage import default_storage
 from django_filters.rest_framework import DjangoFilterBackend
 from .filters import CustomUserFilter, DietPlanFilter,ExerciseFilter
 import os
@@ -39,10 +43,14 @@ from rest_framework.decorators import action
 from django.shortcuts import get_object_or_404
 from dotenv import load_dotenv
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from datetime import timedelta
+from dateutil.relativedelta import relativedelta
 
 from .models import DailyStepCount
-from .serializers import StepSyncSerializer, DailyStepSerializer,AppContentSerializer
+from .serializers import StepSyncSerializer, DailyStepSerializer, StepAggregateSerializer, AppContentSerializer
+from .steps import PERIODS, cohort_step_summary, step_history, step_window_summary
+from .dashboard import get_dashboard_snapshot
 from .services import (
     get_trimester,
     has_diabetes,
@@ -53,6 +61,8 @@ from .services import (
 )
 load_dotenv()  # reads .env file
 
+STEP_HISTORY_BUCKETS = 12
+
 class UserRegistrationAPIView(APIView):
     serializer_class = UserRegistrationSerializer
     def post(self, request):
@@ -62,12 +72,14 @@ class UserRegistrationAPIView(APIView):
         serializer = UserRegistrationSerializer(data=request.data)
         if serializer.is_valid():
             user = serializer.save()
-            refresh = RefreshToken.for_user(user)
+            refresh = identity_token_for(user)
             access_token = str(refresh.access_token)
             refresh_token = str(refresh)
             response_data = serializer.data
             response_data['access_token'] = access_token
             response_data['refresh_token'] = refresh_token
+            if 'otp_error' in serializer.context:
+                response_data['otp_error'] = serializer.context['otp_error']
             return Response(response_data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -86,7 +98,7 @@ class CustomLoginView(LoginView):
         if user.initial_question_completed and user.is_first_login:
             user.is_first_login = False
             user.save(update_fields=["is_first_login"])
-        refresh = RefreshToken.for_user(user)
+        refresh = identity_token_for(user)
         access_token = str(refresh.access_token)
         refresh_token = str(refresh)
         response_data = {
@@ -131,8 +143,8 @@ class LogoutAPIView(APIView):
 
         if getattr(settings, 'REST_USE_JWT', False):
             from rest_framework_simplejwt.exceptions import TokenError
-            from rest_framework_simplejwt.tokens import RefreshToken
 
+            from .blacklist import FilteredRefreshToken
             from .jwt_auth import unset_jwt_cookies
             cookie_name = getattr(settings, 'JWT_AUTH_COOKIE', None)
 
@@ -140,7 +152,7 @@ class LogoutAPIView(APIView):
 
             if 'rest_framework_simplejwt.token_blacklist' in settings.INSTALLED_APPS:
                 try:
-                    token = RefreshToken(request.data['refresh'])
+                    token = FilteredRefreshToken(request.data['refresh'])
                     token.blacklist()
                 except KeyError:
                     response.data = {'detail': _(
@@ -183,7 +195,11 @@ class SendOrResendSMSAPIView(GenericAPIView):
             user = CustomUser.objects.get(phone_number=phone_number)
 
             if environment in ['production', 'staging']:
-                send_otp(str(phone_number))  # Send OTP only in production or staging
+                # Send OTP only in production or staging
+                try:
+                    issue_otp(user)
+                except OTPError as e:
+                    return Response({"error": e.message}, status=e.status_code)
                 return Response({"message": "OTP sent for login.", "is_new_user": user.is_first_login}, status=status.HTTP_200_OK)
             else:
                 return Response({"message": "OTP sending is disabled in this environment."}, status=status.HTTP_200_OK)
@@ -205,7 +221,11 @@ class SendOrResendSMSAPIView(GenericAPIView):
                 Profile.objects.create(user=user)
 
             if environment in ['production', 'staging']:
-                send_otp(str(phone_number))  # Send OTP only in production or staging
+                # Send OTP only in production or staging
+                try:
+                    issue_otp(user)
+                except OTPError as e:
+                    return Response({"error": e.message}, status=e.status_code)
                 return Response({"message": "OTP sent for registration.", "is_new_user": user.is_first_login}, status=status.HTTP_200_OK)
             else:
                 return Response({"message": "OTP sending is disabled in this environment."}, status=status.HTTP_200_OK)
@@ -304,10 +324,13 @@ class DoctorRegistrationAPIView(APIView):
             user = serializer.save()
             # Use the serializer to represent the user data
             user_data = DoctorRegistrationSerializer(user).data
-            return Response({
+            response_data = {
                 "message": "Doctor registered successfully.",
                 "user_details": user_data
-            }, status=status.HTTP_201_CREATED)
+            }
+            if 'otp_error' in serializer.context:
+                response_data['otp_error'] = serializer.context['otp_error']
+            return Response(response_data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 class QuestionListCreateView(generics.ListCreateAPIView):
@@ -383,58 +406,95 @@ class QuestionAnswerListCreateView(APIView):
             serializer = QuestionAnswerSerializer(answers, many=True, context={'request': request})
             return Response(serializer.data, status=status.HTTP_200_OK)
         elif user.role == "doctor":
-            patient_ids = CustomUser.objects.filter(
-                role="patient",
-                assigned_diets__doctor=user
-            ).values_list("id", flat=True).distinct()
-
-            answers = PatientResponse.objects.filter(
-                user_id__in=patient_ids
-            ).select_related('question', 'user', 'selected_option', 'question__parent').order_by('user_id', 'question__parent_id', 'question_id', 'created_at')
-
-            patient_id_filter = request.query_params.get("patient_id")
-            if patient_id_filter:
-                answers = answers.filter(user_id=patient_id_filter)
-
-            date_filter = request.query_params.get("date")
-            if date_filter:
-                answers = answers.filter(created_at__date=date_filter)
-
-            grouped_by_patient = defaultdict(list)
-            for answer in answers:
-                grouped_by_patient[answer.user.id].append(answer)
-
-            result = []
-            for patient_id, responses in grouped_by_patient.items():
-                patient = responses[0].user
-                profile = getattr(patient, "profile", None)
-                first_name = getattr(profile, "first_name", "") or ""
-                last_name = getattr(profile, "last_name", "") or ""
-
-                top_level = [r for r in responses if r.question.parent_id is None]
-                sub_responses = defaultdict(list)
-                for r in responses:
-                    if r.question.parent_id is not None:
-                        sub_responses[r.question.parent_id].append(r)
-
-                serialized_responses = []
-                for response in top_level:
-                    response_context = {'request': request, 'sub_responses': sub_responses}
-                    serialized_responses.append(
-                        DoctorQuestionResponseSerializer(response, context=response_context).data
-                    )
-
-                result.append({
-                    "patient_id": patient_id,
-                    "patient_name": f"{first_name} {last_name}".strip() or patient.username,
-                    "phone_number": str(patient.phone_number) if patient.phone_number else "",
-                    "responses": serialized_responses,
-                })
-
-            return Response(result, status=status.HTTP_200_OK)
+            return self.doctor_review(request)
         else:
             return Response({"detail": "Unauthorized user."}, status=status.HTTP_403_FORBIDDEN)
 
+    def answer_filters(self, request, prefix=""):
+        """
+        Filters on PatientResponse from `date` (answers of that day) and `since`
+        (answers created after that moment, for incremental fetches).
+        """
+        filters = Q()
+        date_filter = request.query_params.get("date")
+        if date_filter:
+            filters &= Q(**{f"{prefix}created_at__date": date_filter})
+        since = request.query_params.get("since", "").replace(" ", "+")
+        if since:
+            moment = parse_datetime(since)
+            if moment is None and parse_date(since):
+                moment = datetime.combine(parse_date(since), time.min)
+            if moment is None:
+                raise ValidationError({"since": "Use an ISO date or datetime."})
+            if timezone.is_naive(moment):
+                moment = timezone.make_aware(moment)
+            filters &= Q(**{f"{prefix}created_at__gt": moment})
+        return filters
+
+    def doctor_review(self, request):
+        """
+        Answers of the doctor's patients, one page of patients at a time. Patients are
+        counted and ordered in SQL; only the answers of the patients on the page are loaded.
+        """
+        patients = CustomUser.objects.filter(
+            role="patient",
+            patient_cohorts__doctor=request.user,
+        )
+        patient_id_filter = request.query_params.get("patient_id")
+        if patient_id_filter:
+            patients = patients.filter(id=patient_id_filter)
+
+        answered = self.answer_filters(request, prefix="answer_responses__")
+        patients = (
+            patients
+            .annotate(
+                response_count=Count("answer_responses", filter=answered),
+                last_answered_at=Max("answer_responses__created_at", filter=answered),
+            )
+            .filter(response_count__gt=0)
+            .select_related("profile")
+            .order_by("id")
+        )
+
+        paginator = Pagination()
+        page = paginator.paginate_queryset(patients, request, view=self)
+
+        answers = (
+            PatientResponse.objects
+            .filter(self.answer_filters(request), user_id__in=[patient.id for patient in page])
+            .select_related("question", "selected_option")
+            .prefetch_related("question__options")
+            .order_by("user_id", "question__parent_id", "question_id", "created_at")
+        )
+        grouped_by_patient = defaultdict(list)
+        for answer in answers:
+            grouped_by_patient[answer.user_id].append(answer)
+
+        result = []
+        for patient in page:
+            responses = grouped_by_patient[patient.id]
+            profile = getattr(patient, "profile", None)
+            first_name = getattr(profile, "first_name", "") or ""
+            last_name = getattr(profile, "last_name", "") or ""
+
+            top_level = [r for r in responses if r.question.parent_id is None]
+            sub_responses = defaultdict(list)
+            for r in responses:
+                if r.question.parent_id is not None:
+                    sub_responses[r.question.parent_id].append(r)
+
+            response_context = {'request': request, 'sub_responses': sub_responses}
+            result.append({
+                "patient_id": patient.id,
+                "patient_name": f"{first_name} {last_name}".strip() or patient.username,
+                "phone_number": str(patient.phone_number) if patient.phone_number else "",
+                "response_count": patient.response_count,
+                "last_answered_at": patient.last_answered_at,
+                "responses": DoctorQuestionResponseSerializer(top_level, many=True, context=response_context).data,
+            })
+
+        return paginator.get_paginated_response(result)
+
     def post(self, request):
         """
         Submit answers for specific questions.
@@ -459,295 +519,27 @@ class DashboardView(APIView):
         if not role:
             return Response({"error": "User role not found"}, status=400)
 
-        response_data = {"role": role, "username": user.profile.first_name if hasattr(user, "profile") else user.username}
-
-        if role == "doctor":
-
-            today = timezone.now().date()
-
-            patients = CustomUser.objects.filter(
-                role="patient",
-                assigned_diets__doctor=user
-            ).distinct()
-
-            total_mothers = patients.count()
-
-            high_risk = HealthStatus.objects.filter(
-                patient__in=patients,
-                health_status__in=["Poor", "Critical"]
-            ).values("patient").distinct().count()
-
-            due_soon = Profile.objects.filter(
-                user__in=patients,
-                lmp_date__isnull=False,
-                lmp_date__lte=date.today() - timedelta(days=240)
-            ).count()
-
-            trimester = {"t1": 0, "t2": 0, "t3": 0}
-
-            for p in Profile.objects.filter(user__in=patients):
-                month = p.pregnancy_month
-                if month:
-                    if month <= 3:
-                        trimester["t1"] += 1
-                    elif month <= 6:
-                        trimester["t2"] += 1
-                    else:
-                        trimester["t3"] += 1
-
-            diet_qs = DietPlanStatus.objects.filter(
-                patient__in=patients,
-                date=today,
-                status="skipped"
-            )
-
-            diet_missed_patients = diet_qs.values("patient").distinct().count()
-            diet_missed_total = diet_qs.count()
-
-            exercise_qs = ExerciseStatus.objects.filter(
-                user__in=patients,
-                status="skipped",
-                updated_at__date=today
-            )
-
-            exercise_missed_patients = exercise_qs.values("user").distinct().count()
-            exercise_missed_total = exercise_qs.count()
-
-            total_diet_plans = DietPlan.objects.filter(doctor=user).count()
-            
-            diet_completed_today = DietPlanStatus.objects.filter(
-                patient__in=patients,
-                date=today,
-                status="completed"
-            ).count()
-
-            alerts = []
-
-            critical_cases = HealthStatus.objects.filter(
-                patient__in=patients,
-                health_status="Critical"
-            ).select_related("patient")
-
-            for c in critical_cases[:10]:
-                alerts.append({
-                    "name": c.patient.get_full_name(),
-                    "message": "Critical health condition",
-                    "type": "critical"
-                })
-
-            profiles = Profile.objects.filter(user__in=patients).select_related("user")
-            health_map = {
-                h.patient_id: h
-                for h in HealthStatus.objects.filter(patient__in=patients)
-            }
-
-            recent_mothers = []
-
-            for p in profiles[:10]:
-                user_obj = p.user
-                health = health_map.get(user_obj.id)
-
-                recent_mothers.append({
-                    "id": user_obj.id,
-                    "name": f"{p.first_name or ''} {p.last_name or ''}".strip(),
-                    "phone_number": str(user_obj.phone_number) if user_obj.phone_number else "",
-                    "gestational_age": p.gestational_age or "NA",
-                    "bp": getattr(health, "blood_pressure", "NA"),
-                    "sugar": getattr(health, "blood_sugar", "NA"),
-                    "edd": p.edd or "NA",
-                    "bmi": p.bmi or "NA",
-                    "health_status": getattr(health, "health_status", "Stable")
-                })
-
-            response_data.update({
-                "active_mothers": total_mothers,
-                "high_risk_cases": high_risk,
-                "due_in_30_days": due_soon,
-                "total_diet_plans": total_diet_plans,
-
-                "trimester_overview": trimester,
-
-                "diet_missed_today": diet_missed_patients,
-                "diet_missed_total": diet_missed_total,
-                "diet_completed_today": diet_completed_today,
-
-                "exercise_missed_today": exercise_missed_patients,
-                "exercise_missed_total": exercise_missed_total,
-
-                "alerts": alerts,
-
-                "recent_mothers": recent_mothers,
-            })
-
-        elif role == "patient":
-
-            today = timezone.now().date()
-
-            total_diets = DietPlan.objects.filter(patient=user).count()
-            total_exercises = ExerciseDate.objects.filter(patient=user).count()
-
-            latest_health_status = HealthStatus.objects.filter(
-                patient=user
-            ).order_by("-created_at").first()
-
-            avg_calories_burned = (
-                ExerciseStatus.objects
-                .filter(user=user, status="completed")
-                .aggregate(avg=Avg("calories_burned"))
-                .get("avg") or 0
-            )
-
-            completed_exercises = ExerciseStatus.objects.filter(user=user).count()
-
-            goal_achievement_rate = (
-                round((completed_exercises / total_exercises) * 100, 2)
-                if total_exercises else 0
-            )
-
-            profile = getattr(user, "profile", None)
-            pregnancy_details = {}
-            if profile:
-                pregnancy_details = {
-                    "gestational_age": profile.gestational_age,
-                    "edd": profile.edd,
-                    "pregnancy_month": profile.pregnancy_month,
-                    "bmi": profile.bmi,
-                    "bmi_category": profile.bmi_category,
-                }
-
-            today_diet_status = DietPlanStatus.objects.filter(
-                patient=user,
-                date=today
-            ).values("status").annotate(count=Count("id"))
-            
-            today_meals = {item["status"]: item["count"] for item in today_diet_status}
-
-            today_exercise_status = ExerciseStatus.objects.filter(
-                user=user,
-                updated_at__date=today
-            ).values("status").annotate(count=Count("id"))
-            
-            today_exercises = {item["status"]: item["count"] for item in today_exercise_status}
-
-            today_steps = DailyStepCount.objects.filter(
-                patient=user,
-                date=today
-            ).first()
-
-            upcoming_diet_plans = DietPlanDate.objects.filter(
-                diet_plan__patient=user,
-                date__gte=today
-            ).order_by("date")[:5]
-
-            response_data.update({
-                "total_diets": total_diets,
-                "total_exercises": total_exercises,
-                "latest_health_status": latest_health_status.health_status if latest_health_status else "No status",
-                "average_calories_burned_per_week": avg_calories_burned,
-                "goal_achievement_rate": goal_achievement_rate,
-                "pregnancy_details": pregnancy_details,
-                "today_meals": today_meals,
-                "today_exercises": today_exercises,
-                "today_steps": {
-                    "steps": today_steps.steps if today_steps else 0,
-                    "goal": today_steps.goal_steps if today_steps else 0,
-                    "status": today_steps.status if today_steps else "low",
-                } if today_steps else {"steps": 0, "goal": 0, "status": "low"},
-                "upcoming_diet_dates": [d.date for d in upcoming_diet_plans],
-            })
+        if role not in ["doctor", "patient", "admin", "superadmin"]:
+            return Response({"error": "Invalid role"}, status=403)
 
-        elif role in ["admin", "superadmin"]:
-
-            today = timezone.now().date()
-            this_month_start = today.replace(day=1)
-
-            total_patients = CustomUser.objects.filter(role="patient").count()
-            total_doctors = CustomUser.objects.filter(role="doctor").count()
-            total_diet_plans = DietPlan.objects.count()
-            total_exercises = Exercise.objects.count()
-            total_admins = CustomUser.objects.filter(role="admin").count()
-
-            new_patients_this_month = CustomUser.objects.filter(
-                role="patient",
-                date_joined__gte=this_month_start
-            ).count()
-            new_doctors_this_month = CustomUser.objects.filter(
-                role="doctor",
-                date_joined__gte=this_month_start
-            ).count()
-
-            diet_missed_today = DietPlanStatus.objects.filter(
-                date=today,
-                status="skipped"
-            ).count()
-            diet_completed_today = DietPlanStatus.objects.filter(
-                date=today,
-                status="completed"
-            ).count()
-            
-            exercise_missed_today = ExerciseStatus.objects.filter(
-                status="skipped",
-                updated_at__date=today
-            ).count()
-            exercise_completed_today = ExerciseStatus.objects.filter(
-                status="completed",
-                updated_at__date=today
-            ).count()
-
-            critical_cases = HealthStatus.objects.filter(
-                health_status="Critical"
-            ).select_related("patient").count()
-
-            diet_completion_rate = 0
-            total_diet_statuses_today = DietPlanStatus.objects.filter(date=today).count()
-            if total_diet_statuses_today > 0:
-                diet_completion_rate = round(
-                    (diet_completed_today / total_diet_statuses_today) * 100, 2
-                )
+        response_data = {"role": role, "username": user.profile.first_name if hasattr(user, "profile") else user.username}
+        response_data.update(get_dashboard_snapshot(user))
 
-            doctor_patient_counts = (
-                CustomUser.objects.filter(role="doctor")
-                .annotate(patient_count=Count("created_diets__patient", distinct=True))
-                .values("id", "username")
-                .annotate(
-                    first_name=F("profile__first_name"),
-                    last_name=F("profile__last_name")
-                )
-                .order_by("-patient_count")[:10]
-            )
+        return Response(response_data)
 
-            recent_patients = (
-                CustomUser.objects.filter(role="patient")
-                .select_related("profile")
-                .order_by("-date_joined")[:5]
-                .values(
-                    "id", "date_joined",
-                    "profile__first_name", "profile__last_name"
-                )
-            )
+class PermissionCacheStatsView(APIView):
+    """Hit/miss counters of the permission cache for this worker process."""
+    permission_classes = [IsAdminOrSuperAdmin]
 
-            response_data.update({
-                "total_patients": total_patients,
-                "total_doctors": total_doctors,
-                "total_diet_plans": total_diet_plans,
-                "total_exercises": total_exercises,
-                "total_admins": total_admins,
-                "new_patients_this_month": new_patients_this_month,
-                "new_doctors_this_month": new_doctors_this_month,
-                "diet_missed_today": diet_missed_today,
-                "diet_completed_today": diet_completed_today,
-                "exercise_missed_today": exercise_missed_today,
-                "exercise_completed_today": exercise_completed_today,
-                "critical_cases": critical_cases,
-                "diet_completion_rate": diet_completion_rate,
-                "top_doctors": list(doctor_patient_counts),
-                "recent_patients": list(recent_patients),
-            })
+    def get(self, request):
+        return Response(permission_cache_stats.snapshot())
 
-        else:
-            return Response({"error": "Invalid role"}, status=403)
+class OutboundStatsView(APIView):
+    """Circuit state, call counters and latency histograms of the outbound clients of this worker process."""
+    permission_classes = [IsAdminOrSuperAdmin]
 
-        return Response(response_data)
+    def get(self, request):
+        return Response(outbound_stats())
 
 class SyncStepsView(APIView):
     permission_classes = [IsAuthenticated]
@@ -833,6 +625,68 @@ class WeeklyStepsView(APIView):
         ])
 
 
+def step_query_params(request):
+    """`period`, `start` and `end` of the step analytics endpoints."""
+    period = request.query_params.get("period", "week")
+    if period not in PERIODS:
+        raise ValidationError({"period": f"Use one of {', '.join(PERIODS)}."})
+    window = {}
+    for name in ("start", "end"):
+        value = request.query_params.get(name)
+        if value:
+            window[name] = parse_date(value)
+            if window[name] is None:
+                raise ValidationError({name: "Use an ISO date (YYYY-MM-DD)."})
+    if window.get("start") and window.get("end") and window["start"] > window["end"]:
+        raise ValidationError({"start": "Must not be after end."})
+    return period, window.get("start"), window.get("end")
+
+
+class StepHistoryView(APIView):
+    """
+    Weekly, monthly or trimester step buckets of the patient (?period=week|month|trimester).
+    Without ?start/?end the latest STEP_HISTORY_BUCKETS buckets are returned.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = StepAggregateSerializer
+
+    def get(self, request):
+        period, start, end = step_query_params(request)
+        buckets = step_history(request.user.id, period, start, end)
+        if not start and not end:
+            buckets = reversed(list(buckets.reverse()[:STEP_HISTORY_BUCKETS]))
+        return Response(StepAggregateSerializer(buckets, many=True).data)
+
+
+class StepSummaryView(APIView):
+    """Steps of the patient over ?start..?end (the last 30 days by default)."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        _, start, end = step_query_params(request)
+        end = end or timezone.now().date()
+        start = start or end - timedelta(days=29)
+        if start > end:
+            raise ValidationError({"start": "Must not be after end."})
+        return Response(step_window_summary(request.user.id, start, end))
+
+
+class CohortStepsView(APIView):
+    """Steps of the doctor's patients combined per week, month or trimester."""
+    permission_classes = [IsDoctorUser]
+
+    def get(self, request):
+        period, start, end = step_query_params(request)
+        if not start and period == "week":
+            start = timezone.now().date() - timedelta(weeks=STEP_HISTORY_BUCKETS)
+        elif not start and period == "month":
+            start = timezone.now().date() - relativedelta(months=STEP_HISTORY_BUCKETS)
+        return Response({
+            "period": period,
+            "buckets": cohort_step_summary(request.user, period, start, end),
+        })
+
+
 
 class AppContentView(APIView):
     serializer_class = AppContentSerializer
@@ -972,5 +826,61 @@ class AdminDoctorPatientsView(generics.ListAPIView):
         doctor_id = self.kwargs.get('doctor_id')
         return CustomUser.objects.filter(
             role='patient',
-            assigned_diets__doctor_id=doctor_id
-        ).distinct().order_by("-id")
+            patient_cohorts__doctor_id=doctor_id
+        ).order_by("-id")
+
+
+class PresignedUploadView(APIView):
+    """
+    Returns a direct-to-storage upload for an audio/image attachment.
+
+    Body: {"kind": "diet_status_audio", "filename": "reason.m4a", "content_type": "audio/mp4", "size": 123456}
+    Upload the file to `url` with `method` (adding `fields` for POST forms), then send
+    `key` instead of the file, e.g. `audio_reason_key`.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        try:
+            upload = create_presigned_upload(
+                request.user,
+                request.data.get("kind"),
+                request.data.get("filename"),
+                request.data.get("content_type"),
+                request.data.get("size"),
+            )
+        except (InvalidUpload, ValueError, TypeError) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if upload["url"].startswith("/"):
+            upload["url"] = request.build_absolute_uri(upload["url"])
+        return Response(upload, status=status.HTTP_201_CREATED)
+
+
+class DirectUploadView(APIView):
+    """
+    Upload target for LocalUploadStorage presigned links. The signed token in the URL
+    authorises the upload; the body is streamed to storage in chunks.
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def put(self, request, token):
+        if not hasattr(default_storage, "read_upload_token"):
+            return Response({"error": "Direct uploads are not served by this storage."}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            grant = default_storage.read_upload_token(token)
+        except InvalidUpload as e:
+            return Response({"error": str(e)}, status=status.HTTP_403_FORBIDDEN)
+
+        length = int(request.META.get("CONTENT_LENGTH") or 0)
+        if not length:
+            return Response({"error": "Content-Length is required."}, status=status.HTTP_411_LENGTH_REQUIRED)
+        if length > grant["max_size"]:
+            return Response({"error": "File is too large."}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        if request.content_type != grant["content_type"]:
+            return Response({"error": "Content-Type does not match the upload link."}, status=status.HTTP_400_BAD_REQUEST)
+        if default_storage.exists(grant["key"]):
+            return Response({"error": "Upload already completed."}, status=status.HTTP_409_CONFLICT)
+
+        default_storage.save(grant["key"], File(request._request, name=grant["key"]))
+        return Response({"key": grant["key"]}, status=status.HTTP_201_CREATED)